@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+BENCHMARK DELLA PIPELINE SU UN RIG SINTETICO
+
+Genera un rig di N camere disposte ad anello attorno al campo, con K e
+distorsione presi (a rotazione) dalle camere reali di camera_data, e una
+sequenza di F frame di un soggetto con J giunti che si muove sul campo. Le
+proiezioni (con distorsione) più rumore gaussiano e occlusioni casuali
+diventano un file COCO come quelli reali (outN_frame_XXXX.png).
+
+Su ogni caso misura le fasi della pipeline:
+  json_load   parsing del file COCO
+  index       costruzione di AnnotationIndex
+  rectify     rectify_coco (analitica; 'map' con --rectify map)
+  triangulate build_observations + triangulate (per ogni --methods)
+  reproject   reproject con le metriche di errore
+con tempo (wall e CPU; un riscaldamento e --repeat ripetizioni, di cui si
+tengono minimo, mediana e dispersione), picco di memoria allocata (tracemalloc, in un
+secondo passaggio per non falsare i tempi) e accuratezza rispetto alla
+verità: errore 3D (mm), giunti triangolati, MPJPE di riproiezione (px).
+
+Si parte da un caso base e si fa variare una dimensione alla volta
+(--cameras, --frames, --joints, --noise, --occlusion). I risultati vanno in
+JSON; con --compare si confrontano con un run precedente e si esce con
+codice 1 se qualche fase è più lenta oltre --tolerance (confrontando i
+minimi, e solo se la differenza supera la dispersione tra le ripetizioni) o
+meno accurata.
+Tutto offline, solo CPU.
+
+Esempio:
+  python benchmark_pipeline.py --frames 100 1000 10000 --output bench_pipeline.json
+  python benchmark_pipeline.py --compare bench_pipeline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from camera_rig import CameraRig
+from coco_index import AnnotationIndex
+from instrumentation import traced
+from rectified_annotations import rectify_coco
+from reprojection import reproject
+from skeleton_io import KEYPOINTS, SKELETON, Skeleton
+from triangulation import build_observations, triangulate
+
+BASE_CASE = {'cameras': 4, 'frames': 1000, 'joints': 18, 'noise': 1.0, 'occlusion': 0.1}
+RING_RADIUS = 20000.0         # mm, distanza delle camere dal centro del campo
+RING_HEIGHT = 6500.0          # mm
+WALK_RADIUS = 5000.0          # mm, area in cui si muove il soggetto
+BODY_HEIGHT = 1800.0          # mm
+
+
+def synthetic_rig(num_cams, real_rig, seed=0):
+    """N camere ad anello che guardano il centro, intrinseci reali a rotazione."""
+    rng = np.random.default_rng(seed)
+    rvecs, tvecs, K, dist = [], [], [], []
+    for i in range(num_cams):
+        src = i % len(real_rig.cam_ids)
+        angle = 2 * np.pi * i / num_cams + rng.normal(0, 0.05)
+        center = np.array([RING_RADIUS * np.cos(angle), RING_RADIUS * np.sin(angle),
+                           RING_HEIGHT + rng.normal(0, 300)])
+        target = np.array([0.0, 0.0, BODY_HEIGHT / 2])
+        z = target - center
+        z /= np.linalg.norm(z)
+        x = np.cross(z, [0.0, 0.0, 1.0])
+        x /= np.linalg.norm(x)
+        y = np.cross(z, x)                          # asse y dell'immagine verso il basso
+        R = np.stack([x, y, z])
+        rvecs.append(cv2.Rodrigues(R)[0])
+        tvecs.append((-R @ center).reshape(3, 1))
+        K.append(real_rig.K[src])
+        dist.append(real_rig.dist[src])
+    sizes = [real_rig.image_sizes[i % len(real_rig.cam_ids)] for i in range(num_cams)]
+    return CameraRig(range(1, num_cams + 1), K, dist, rvecs, tvecs, sizes,
+                     calib_hash=f"synthetic-{num_cams}-{seed}-{real_rig.calib_hash}")
+
+
+def synthetic_motion(num_frames, num_joints, seed=0):
+    """Verità 3D (F, J, 3) in mm: una posa fissa che trasla sul campo e oscilla."""
+    rng = np.random.default_rng(seed)
+    template = rng.uniform([-300, -300, 0], [300, 300, BODY_HEIGHT], size=(num_joints, 3))
+    t = np.arange(num_frames) / 25.0
+    root = np.stack([WALK_RADIUS * np.sin(0.05 * t), WALK_RADIUS * np.sin(0.08 * t + 1.0),
+                     np.zeros_like(t)], axis=1)
+    phase = rng.uniform(0, 2 * np.pi, size=(num_joints, 1))
+    sway = 100.0 * np.sin(2 * np.pi * t[:, None, None] + phase[None])   # (F, J, 1)
+    return root[:, None, :] + template[None] + sway * np.array([1.0, 0.0, 0.2])
+
+
+def synthetic_coco(rig, points3d, noise=1.0, occlusion=0.1, seed=0):
+    """
+    COCO con le proiezioni distorte della verità: rumore gaussiano (px),
+    giunti occlusi con probabilità occlusion e fuori immagine con v=0.
+    """
+    rng = np.random.default_rng(seed)
+    F, J, _ = points3d.shape
+    if J == len(KEYPOINTS):
+        names, links = list(KEYPOINTS), [list(l) for l in SKELETON]
+    else:
+        names, links = [f"j{i}" for i in range(J)], [[i, i + 1] for i in range(1, J)]
+    data = {'info': {'description': 'synthetic'},
+            'categories': [{'id': 1, 'name': 'person', 'keypoints': names, 'skeleton': links}],
+            'images': [], 'annotations': []}
+    flat = points3d.reshape(-1, 3)
+    for c, cam_id in enumerate(rig.cam_ids):
+        K, dist, rvec, tvec = rig.camera(cam_id)
+        w, h = rig.image_sizes[c]
+        xy, _ = cv2.projectPoints(flat, rvec, tvec, K, dist)
+        xy = xy.reshape(F, J, 2) + rng.normal(0, noise, size=(F, J, 2))
+        depth = (points3d @ rig.R[c].T + rig.tvecs[c, :, 0])[..., 2]
+        vis = ((rng.random((F, J)) >= occlusion) & (depth > 0)
+               & (xy[..., 0] >= 0) & (xy[..., 0] < w) & (xy[..., 1] >= 0) & (xy[..., 1] < h))
+        for f in range(F):
+            if not vis[f].any():
+                continue
+            img_id = len(data['images'])
+            data['images'].append({'id': img_id, 'file_name': f"out{cam_id}_frame_{f + 1:04d}.png",
+                                   'width': int(w), 'height': int(h)})
+            kp = np.concatenate([xy[f], np.where(vis[f], 2.0, 0.0)[:, None]], axis=1)
+            kp[~vis[f], :2] = 0.0
+            lo, hi = xy[f][vis[f]].min(axis=0), xy[f][vis[f]].max(axis=0)
+            data['annotations'].append({'id': img_id, 'image_id': img_id, 'category_id': 1,
+                                        'keypoints': kp.ravel().tolist(), 'num_keypoints': int(vis[f].sum()),
+                                        'bbox': [*lo.tolist(), *(hi - lo).tolist()], 'iscrowd': 0,
+                                        'area': float(np.prod(hi - lo))})
+    return data
+
+
+def measure(fn, memory=True, repeat=5, setup=None):
+    """
+    Esegue fn() una volta di riscaldamento (il suo risultato è quello ritornato)
+    e poi repeat volte cronometrate. Ritorna (risultato, stats) con
+      wall_s         minimo dei tempi (il meno disturbato, usato nei confronti)
+      wall_median_s  mediana
+      wall_spread_s  max - min, la dispersione tra le ripetizioni
+      cpu_s          minimo del tempo CPU
+      peak_mb        picco di memoria, in un passaggio a parte con tracemalloc
+    Se c'è setup, ad ogni esecuzione si chiama fn(setup()) e setup resta fuori dalla misura.
+    """
+    fresh = (lambda: (setup(),)) if setup else tuple
+    result = fn(*fresh())
+    walls, cpus = [], []
+    for _ in range(max(repeat, 1)):
+        args = fresh()
+        wall, cpu = time.perf_counter(), time.process_time()
+        fn(*args)
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    stats = {'wall_s': min(walls), 'wall_median_s': float(np.median(walls)),
+             'wall_spread_s': max(walls) - min(walls), 'cpu_s': min(cpus), 'repeat': len(walls)}
+    if memory:
+        args = fresh()
+        tracemalloc.start()
+        fn(*args)
+        stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, stats
+
+
+def run_case(case, real_rig, methods=('svd',), rectify_mode='analytic', memory=True, tmp_dir=None, seed=0,
+             repeat=5):
+    rig = synthetic_rig(case['cameras'], real_rig, seed)
+    truth = synthetic_motion(case['frames'], case['joints'], seed)
+    data = synthetic_coco(rig, truth, case['noise'], case['occlusion'], seed)
+    path = os.path.join(tmp_dir or tempfile.gettempdir(), f"bench_pipeline_{os.getpid()}.json")
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    del data
+    stages, accuracy = {}, {}
+    try:
+        def load():
+            with open(path, 'r') as f:
+                return json.load(f)
+        raw, stages['json_load'] = measure(load, memory, repeat)
+        stages['json_load']['mb_on_disk'] = os.path.getsize(path) / 2**20
+    finally:
+        os.remove(path)
+    raw_index, stages['index'] = measure(lambda: AnnotationIndex(raw), memory, repeat)
+    text = json.dumps(raw)
+    # rectify_coco lavora in place: ogni passaggio su una copia fresca (fuori dalla misura)
+    rect, stages['rectify'] = measure(lambda data: rectify_coco(data, rig, rectify_mode), memory, repeat,
+                                      setup=lambda: json.loads(text))
+    rect_index = AnnotationIndex(rect)
+
+    frames, obs = build_observations(rect_index, rig.cam_ids)
+    gt = truth[frames - 1]
+    skeleton = None
+    for method in methods:
+        (points, _), stats = measure(lambda: triangulate(obs, rig.P, method), memory, repeat)
+        stages[f'triangulate_{method}'] = stats
+        ok = np.isfinite(points).all(axis=-1)
+        accuracy[f'{method}_error_mm'] = float(np.linalg.norm(points - gt, axis=-1)[ok].mean()) if ok.any() else None
+        accuracy[f'{method}_triangulated'] = float(ok.mean()) if ok.size else 0.0
+        if skeleton is None:
+            skeleton = Skeleton(points, frames)
+
+    # riproiezione (con distorsione) confrontata con le annotazioni originali
+    (_, _, err_stats), stages['reproject'] = measure(lambda: reproject(raw_index, skeleton, rig), memory, repeat)
+    accuracy['reproj_mpjpe_px'] = err_stats.overall()[1] if err_stats.count else None
+    accuracy['observations'] = int((obs[..., 2] > 0).sum())
+    return {'params': dict(case), 'stages': stages, 'accuracy': accuracy}
+
+
+def sweep(args):
+    """Caso base più un caso per ogni valore di ogni dimensione richiesta."""
+    base = {k: getattr(args, f'base_{k}') for k in BASE_CASE}
+    cases = [base]
+    for key in BASE_CASE:
+        for value in getattr(args, key) or []:
+            case = dict(base, **{key: value})
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+            'numpy': np.__version__, 'opencv': cv2.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, tolerance):
+    """Stampa le differenze con un run precedente; ritorna il numero di regressioni."""
+    old_cases = {json.dumps(c['params'], sort_keys=True): c for c in baseline['cases']}
+    regressions = 0
+    for case in results['cases']:
+        old = old_cases.get(json.dumps(case['params'], sort_keys=True))
+        if old is None:
+            continue
+        label = ' '.join(f"{k}={v}" for k, v in case['params'].items())
+        for stage, stats in case['stages'].items():
+            prev = old['stages'].get(stage)
+            if not prev or prev['wall_s'] <= 0:
+                continue
+            # confronto tra i minimi; la differenza deve superare anche la dispersione
+            # osservata tra le ripetizioni (dei due run) e il millisecondo
+            ratio = stats['wall_s'] / prev['wall_s']
+            noise = max(stats.get('wall_spread_s', 0.0), prev.get('wall_spread_s', 0.0), 1e-3)
+            if ratio > 1 + tolerance and stats['wall_s'] - prev['wall_s'] > noise:
+                regressions += 1
+                print(f"REGRESSIONE {label} {stage}: min {prev['wall_s']:.4f} s -> {stats['wall_s']:.4f} s "
+                      f"(x{ratio:.2f}, dispersione {noise:.4f} s)")
+        for key, value in case['accuracy'].items():
+            prev = old['accuracy'].get(key)
+            if value is None or prev is None or not key.endswith(('_mm', '_px')):
+                continue
+            if value > prev * (1 + tolerance) + 1e-6:
+                regressions += 1
+                print(f"REGRESSIONE {label} {key}: {prev:.3f} -> {value:.3f}")
+    print(f"Confronto con {baseline['environment'].get('commit') or 'baseline'}: {regressions} regressioni")
+    return regressions
+
+
+@traced('benchmark_pipeline')
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark della pipeline su un rig sintetico')
+    for key, value in BASE_CASE.items():
+        kind = type(value)
+        parser.add_argument(f'--base_{key}', type=kind, default=value, help=f'Caso base (default {value})')
+        parser.add_argument(f'--{key}', type=kind, nargs='*', default=None, help=f'Valori di {key} da provare')
+    parser.add_argument('--methods', nargs='*', default=['svd'], choices=['svd', 'normal', 'robust'],
+                        help='Metodi di triangolazione')
+    parser.add_argument('--rectify', choices=['analytic', 'map'], default='analytic',
+                        help="Modo di rettifica ('map' crea le mappe 4K in cache)")
+    parser.add_argument('--no_memory', action='store_true', help='Salta la misura della memoria')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Ripetizioni cronometrate per fase, dopo un riscaldamento (si confronta il minimo)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Salva i risultati in JSON')
+    parser.add_argument('--compare', default=None, help='JSON di un run precedente da confrontare')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Peggioramento relativo tollerato')
+    args = parser.parse_args()
+
+    real_rig = CameraRig.load()
+    results = {'environment': environment(), 'cases': []}
+    for case in sweep(args):
+        res = run_case(case, real_rig, args.methods, args.rectify, not args.no_memory, seed=args.seed,
+                       repeat=args.repeat)
+        results['cases'].append(res)
+        print("== " + ' '.join(f"{k}={v}" for k, v in case.items()))
+        for stage, stats in res['stages'].items():
+            mem = f"  picco {stats['peak_mb']:8.1f} MB" if 'peak_mb' in stats else ''
+            print(f"  {stage:20s} min {stats['wall_s']:8.3f} s  mediana {stats['wall_median_s']:8.3f} s"
+                  f"  ±{stats['wall_spread_s']:.3f}  cpu {stats['cpu_s']:8.3f} s{mem}")
+        print("  " + '  '.join(f"{k} {v:.3f}" if isinstance(v, float) else f"{k} {v}"
+                               for k, v in res['accuracy'].items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Risultati salvati in {args.output}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+BENCHMARK DEI PROFILI DI RETTIFICA
+
+Per ogni video campione (mocap_7_videos/out*.mp4) decodifica alcuni frame e
+misura, per ogni profilo di rectified_videos.RECTIFY_PROFILES:
+  - frames/sec di cv2.remap
+  - memoria delle mappe e picco di memoria allocata durante il remap
+  - errore medio rispetto al profilo 'exact' (livelli di grigio)
+
+Esempio: python benchmark_rectification.py --frames 20 --output bench_rect.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from camera_rig import CameraRig
+from instrumentation import traced
+from rectified_videos import RECTIFY_PROFILES, load_profile_maps
+
+
+def read_frames(video_path, n_frames):
+    """Decodifica i primi n_frames del video."""
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < n_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def benchmark_profile(frames, rig, cam_id, profile, repeats=1):
+    h, w = frames[0].shape[:2]
+    map1, map2, interpolation, roi = load_profile_maps(rig, cam_id, (w, h), profile)
+    map_bytes = map1.nbytes + (0 if map2 is None else map2.nbytes)
+    # forza il caricamento delle pagine delle mappe prima di misurare
+    cv2.remap(frames[0], map1, map2, interpolation=interpolation)
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        for f in frames:
+            cv2.remap(f, map1, map2, interpolation=interpolation)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # output fuori dalla misura, per il confronto con il profilo 'exact'
+    outputs = [cv2.remap(f, map1, map2, interpolation=interpolation) for f in frames]
+
+    n = len(frames) * repeats
+    return {
+        'fps':           n / elapsed if elapsed > 0 else 0.0,
+        'ms_per_frame':  1000.0 * elapsed / n,
+        'map_mb':        map_bytes / 2**20,
+        'peak_alloc_mb': peak / 2**20,
+        'roi':           list(roi),
+    }, outputs
+
+
+@traced('benchmark_rectification')
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dei profili di rettifica video')
+    parser.add_argument('--videos', default='mocap_7_videos/out*.mp4', help='Glob dei video campione')
+    parser.add_argument('--frames', type=int, default=20, help='Frame decodificati per video')
+    parser.add_argument('--repeats', type=int, default=1, help='Ripetizioni del remap')
+    parser.add_argument('--profiles', nargs='*', default=list(RECTIFY_PROFILES), help='Profili da misurare')
+    parser.add_argument('--output', default=None, help='Salva i risultati in JSON')
+    args = parser.parse_args()
+
+    rig = CameraRig.load()
+    results = {}
+    for video_path in sorted(glob.glob(args.videos)):
+        match = re.search(r'out(\d+)\.mp4', os.path.basename(video_path))
+        if not match or int(match.group(1)) not in rig:
+            continue
+        cam_id = int(match.group(1))
+        frames = read_frames(video_path, args.frames)
+        if not frames:
+            continue
+        print(f"== {video_path} ({len(frames)} frame {frames[0].shape[1]}x{frames[0].shape[0]})")
+
+        reference = None
+        results[video_path] = {}
+        for profile in args.profiles:
+            stats, outputs = benchmark_profile(frames, rig, cam_id, profile, args.repeats)
+            if profile == 'exact':
+                reference = outputs
+            if reference is not None and not RECTIFY_PROFILES[profile]['crop']:
+                stats['mean_abs_diff'] = float(np.mean([np.abs(a.astype(np.int16) - b).mean()
+                                                        for a, b in zip(outputs, reference)]))
+            del outputs
+            results[video_path][profile] = stats
+            diff = f"  diff {stats['mean_abs_diff']:.3f}" if 'mean_abs_diff' in stats else ''
+            print(f"  {profile:8s} {stats['fps']:7.1f} fps  {stats['ms_per_frame']:7.1f} ms/frame  "
+                  f"mappe {stats['map_mb']:6.1f} MB  picco {stats['peak_alloc_mb']:7.1f} MB{diff}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Risultati salvati in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
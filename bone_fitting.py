@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+FITTING DELLO SCHELETRO CON LUNGHEZZE DELLE OSSA COSTANTI
+
+La triangolazione risolve ogni frame in modo indipendente, quindi la
+lunghezza delle ossa oscilla da un frame all'altro. Questo stage:
+  1) stima una sola lunghezza per osso sull'intera sequenza (mediana,
+     opzionalmente media tra osso destro e sinistro),
+  2) riaggiusta i giunti di tutti i frame insieme con iterazioni di
+     proiezione dei vincoli (position based dynamics, in stile Jacobi):
+     ad ogni iterazione tutte le ossa di tutti i frame vengono corrette in
+     un'unica operazione vettorizzata e le correzioni di ogni giunto
+     vengono mediate.
+Le correzioni sono ripartite in base al peso dei giunti: se lo scheletro
+ha l'extra 'inliers' (triangolazione robusta) i giunti visti da più
+camere si spostano meno.
+
+L'output è nello stesso formato .npz degli scheletri triangolati.
+Esempio: python bone_fitting.py --symmetric --output fitted_3d_skeleton.npz
+"""
+
+import argparse
+import numpy as np
+
+from instrumentation import span, traced
+from skeleton_io import SKELETON_PATH, KEYPOINTS, SKELETON, Skeleton, load_skeleton, save_skeleton
+
+OUTPUT_PATH = 'fitted_3d_skeleton.npz'
+
+
+def skeleton_bones(sk3d):
+    """Ritorna (nomi dei giunti, ossa (B, 2) 0-based) dai meta o dalla topologia di default."""
+    names = sk3d.meta.get('keypoints') or KEYPOINTS
+    links = sk3d.meta.get('skeleton') or SKELETON
+    return list(names), np.array(links, dtype=np.int64).reshape(-1, 2) - 1
+
+
+def bone_vectors(points, bones):
+    """Vettori (F, B, 3) dal primo al secondo giunto di ogni osso."""
+    return points[:, bones[:, 1]] - points[:, bones[:, 0]]
+
+
+def mirror_pairs(names, bones):
+    """Coppie (i, k) di ossa destra/sinistra, riconosciute dai nomi R*/L* dei giunti."""
+    def mirror(name):
+        if name[:1] == 'R':
+            return 'L' + name[1:]
+        if name[:1] == 'L':
+            return 'R' + name[1:]
+        return name
+    key = {(names[a], names[b]): i for i, (a, b) in enumerate(bones)}
+    pairs = []
+    for i, (a, b) in enumerate(bones):
+        k = key.get((mirror(names[a]), mirror(names[b])))
+        if k is not None and i < k:
+            pairs.append((i, k))
+    return pairs
+
+
+def estimate_bone_lengths(points, bones, pairs=()):
+    """Lunghezza mediana di ogni osso sui frame in cui entrambi i giunti sono validi."""
+    lengths = np.nanmedian(np.linalg.norm(bone_vectors(points, bones), axis=-1), axis=0)
+    for i, k in pairs:
+        lengths[[i, k]] = np.nanmean(lengths[[i, k]])
+    return lengths
+
+
+def fit_bone_lengths(points, bones, lengths, weights=None, iterations=200, relaxation=1.0, tol=1e-3):
+    """
+    Proietta i giunti (F, J, 3) sui vincoli |p_b - p_a| = lengths, per tutti
+    i frame contemporaneamente. weights (F, J): fiducia nei giunti (default
+    1); la correzione di un osso è divisa in proporzione all'inverso dei
+    pesi. I giunti NaN restano NaN e le loro ossa vengono ignorate.
+    Ritorna (punti (F, J, 3), iterazioni eseguite).
+
+    Un giunto mancante non blocca la correzione dei vicini:
+    >>> pts = np.array([[[0, 0, 0], [2, 0, 0], [np.nan] * 3]])
+    >>> out, n = fit_bone_lengths(pts, np.array([[0, 1], [1, 2]]), np.array([1.0, 1.0]))
+    >>> out[0, :2, 0].round(3).tolist(), bool(np.isnan(out[0, 2]).all()), n < 200
+    ([0.5, 1.5], True, True)
+    """
+    pts = np.array(points, dtype=np.float64)
+    F, J, _ = pts.shape
+    if weights is None:
+        weights = np.ones((F, J))
+    inv_w = 1.0 / np.maximum(np.asarray(weights, dtype=np.float64), 1e-12)
+    a, b = bones[:, 0], bones[:, 1]
+    active = np.isfinite(pts[:, a]).all(-1) & np.isfinite(pts[:, b]).all(-1)    # (F, B)
+    share_a = inv_w[:, a] / (inv_w[:, a] + inv_w[:, b])                          # (F, B)
+
+    # numero di ossa attive per giunto, per mediare le correzioni (Jacobi)
+    degree = np.zeros((F, J))
+    np.add.at(degree, (slice(None), a), active)
+    np.add.at(degree, (slice(None), b), active)
+    degree = np.maximum(degree, 1)[..., None]
+
+    it = 0
+    for it in range(1, iterations + 1):
+        d = bone_vectors(pts, bones)                                           # (F, B, 3)
+        dist = np.linalg.norm(d, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            c = np.where(active & (dist > 0), (dist - lengths) / dist, 0.0)    # (F, B)
+        # residuo e correzioni solo sulle ossa attive: d è NaN su quelle con un giunto mancante
+        if np.abs(np.where(active, c * dist, 0.0)).max(initial=0) < tol:
+            break
+        corr = np.where(active[..., None], c[..., None] * d, 0.0)
+        delta = np.zeros_like(pts)
+        np.add.at(delta, (slice(None), a), share_a[..., None] * corr)
+        np.add.at(delta, (slice(None), b), -(1 - share_a)[..., None] * corr)
+        pts += relaxation * delta / degree
+    return pts, it
+
+
+def fit_sequence(sk3d, symmetric=False, iterations=200, relaxation=1.0):
+    """Stima le lunghezze delle ossa e riaggiusta tutta la sequenza; ritorna un nuovo Skeleton."""
+    names, bones = skeleton_bones(sk3d)
+    points = np.asarray(sk3d.points, dtype=np.float64)
+    lengths = estimate_bone_lengths(points, bones, mirror_pairs(names, bones) if symmetric else ())
+
+    weights = None
+    if 'inliers' in sk3d.extras:
+        weights = np.asarray(sk3d.extras['inliers']).sum(axis=-1).astype(np.float64)
+    with span('bone_fitting.fit', frames=len(points)) as s:
+        fitted, n_iter = fit_bone_lengths(points, bones, lengths, weights, iterations, relaxation)
+        s.add(iterations=n_iter)
+    meta = dict(sk3d.meta, bone_lengths=lengths.tolist(), bone_fit_iterations=n_iter,
+                symmetric_bones=bool(symmetric))
+    return Skeleton(fitted, sk3d.frames, meta=meta, **sk3d.extras)
+
+
+def bone_report(points, bones, lengths):
+    """(deviazione standard media delle ossa, errore medio assoluto rispetto a lengths)."""
+    bl = np.linalg.norm(bone_vectors(np.asarray(points), bones), axis=-1)
+    return float(np.nanmean(np.nanstd(bl, axis=0))), float(np.nanmean(np.abs(bl - lengths)))
+
+
+@traced('bone_fitting')
+def main():
+    parser = argparse.ArgumentParser(description='Fitting dello scheletro con lunghezze delle ossa costanti')
+    parser.add_argument('--skeleton', default=SKELETON_PATH, help='Scheletro 3D di input')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='Scheletro vincolato (.npz)')
+    parser.add_argument('--symmetric', action='store_true', help='Stessa lunghezza per ossa destra/sinistra')
+    parser.add_argument('--iterations', type=int, default=200, help='Iterazioni di proiezione dei vincoli')
+    parser.add_argument('--relaxation', type=float, default=1.0, help='Fattore di rilassamento (0-2)')
+    args = parser.parse_args()
+
+    sk3d = load_skeleton(args.skeleton)
+    fitted = fit_sequence(sk3d, args.symmetric, args.iterations, args.relaxation)
+
+    names, bones = skeleton_bones(sk3d)
+    lengths = np.array(fitted.meta['bone_lengths'])
+    std_before, err_before = bone_report(sk3d.points, bones, lengths)
+    std_after, err_after = bone_report(fitted.points, bones, lengths)
+    shift = np.nanmean(np.linalg.norm(fitted.points - np.asarray(sk3d.points), axis=-1))
+    print(f"Iterazioni: {fitted.meta['bone_fit_iterations']}")
+    print(f"Dev. std. lunghezza ossa: {std_before:.3f} -> {std_after:.3f}")
+    print(f"Errore medio sulle ossa:  {err_before:.3f} -> {err_after:.3f}")
+    print(f"Spostamento medio dei giunti: {shift:.3f}")
+    for (a, b), L in zip(bones, lengths):
+        print(f"  {names[a]:>10s} - {names[b]:<10s} {L:9.2f}")
+
+    save_skeleton(args.output, fitted)
+    print(f"Scheletro vincolato salvato in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+RAFFINAMENTO NON LINEARE (BUNDLE ADJUSTMENT) DI GIUNTI 3D ED ESTRINSECI
+
+Parte dallo scheletro triangolato con la DLT e minimizza l'errore di
+riproiezione attraverso il modello di distorsione (lo stesso misurato da
+reproject_2d_witherror.py) rispetto ai keypoints 2D rettificati.
+
+Variabili: tutti i giunti 3D validi e, con --extrinsics, rvec/tvec di ogni
+camera tranne quella di riferimento (che fissa il sistema di riferimento).
+Gli estrinseci hanno un prior debole verso camera_calib.json, che fissa
+anche la scala. Lo Jacobiano è passato a least_squares come matrice di
+sparsità a blocchi esplicita: ogni residuo dipende solo dai 3 parametri del
+suo giunto e dai 6 della sua camera, quindi il costo per iterazione cresce
+linearmente con il numero di frame.
+
+Esempio: python bundle_adjustment.py --extrinsics --output refined_3d_skeleton.npz
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import cv2
+from scipy.optimize import least_squares
+from scipy.sparse import coo_matrix
+
+from camera_rig import CameraRig
+from coco_index import AnnotationIndex
+from instrumentation import span, traced
+from reprojection import reproject
+from skeleton_io import SKELETON_PATH, Skeleton, load_skeleton, save_skeleton
+
+RECT_ANN_PATH   = '_annotations.coco.rectified.json'
+OUTPUT_PATH     = 'refined_3d_skeleton.npz'
+EXTRINSICS_PATH = 'refined_extrinsics.json'
+
+# deviazioni standard del prior sugli estrinseci (radianti, unità mondo)
+ROT_SIGMA   = 0.05
+TRANS_SIGMA = 100.0
+
+
+def gather_observations(coco, sk3d, rig, min_visibility=2):
+    """
+    Associa le annotazioni 2D ai giunti validi dello scheletro.
+
+    Ritorna (point_rows, point_joints, obs_point (M,), obs_cam (M,), obs_xy (M, 2)):
+    i punti da ottimizzare sono sk3d.points[point_rows, point_joints]; ogni
+    osservazione indica il suo punto e la sua camera (posizione nel rig).
+    """
+    valid = np.isfinite(np.asarray(sk3d.points)).all(axis=-1)            # (F, J)
+    point_rows, point_joints = np.nonzero(valid)
+    point_id = -np.ones(valid.shape, dtype=np.int64)
+    point_id[point_rows, point_joints] = np.arange(len(point_rows))
+
+    gt_frame_pos = {int(f): i for i, f in enumerate(coco.frames)}
+    obs_point, obs_cam, obs_xy = [], [], []
+    for c, cam_id in enumerate(rig.cam_ids):
+        if cam_id not in coco.cam_ids:
+            continue
+        cp = coco.cam_ids.index(cam_id)
+        for r, frame in enumerate(sk3d.frames):
+            f = gt_frame_pos.get(int(frame))
+            if f is None or not coco.annotated[f, cp]:
+                continue
+            kp = coco.keypoints[f, cp]                                    # (J, 3)
+            ok = (kp[:, 2] >= min_visibility) & (point_id[r] >= 0)
+            obs_point.append(point_id[r, ok])
+            obs_cam.append(np.full(ok.sum(), c))
+            obs_xy.append(kp[ok, :2])
+    if not obs_point:
+        return point_rows, point_joints, np.zeros(0, int), np.zeros(0, int), np.zeros((0, 2))
+    return (point_rows, point_joints, np.concatenate(obs_point), np.concatenate(obs_cam),
+            np.concatenate(obs_xy))
+
+
+class BundleProblem:
+    """
+    Residui e sparsità dello Jacobiano.
+
+    Vettore dei parametri: [punti (N*3) | estrinseci delle camere libere (L*6)].
+    Residui: 2 per osservazione (pixel) + 6 per camera libera (prior).
+    """
+
+    def __init__(self, rig, obs_point, obs_cam, obs_xy, num_points, free_cams=(),
+                 rot_sigma=ROT_SIGMA, trans_sigma=TRANS_SIGMA):
+        self.rig        = rig
+        self.obs_point  = obs_point
+        self.obs_cam    = obs_cam
+        self.obs_xy     = obs_xy
+        self.num_points = num_points
+        self.free_cams  = list(free_cams)                 # posizioni nel rig
+        self.free_pos   = {c: i for i, c in enumerate(self.free_cams)}
+        self.cam_obs    = [np.flatnonzero(obs_cam == c) for c in range(len(rig.cam_ids))]
+        self.extr0      = np.concatenate([np.concatenate((rig.rvecs[c, :, 0], rig.tvecs[c, :, 0]))
+                                          for c in self.free_cams]) if self.free_cams else np.zeros(0)
+        self.prior_scale = np.tile([1 / rot_sigma] * 3 + [1 / trans_sigma] * 3, len(self.free_cams))
+
+    def pack(self, points):
+        return np.concatenate((np.asarray(points, dtype=np.float64).ravel(), self.extr0))
+
+    def unpack(self, x):
+        n = self.num_points * 3
+        return x[:n].reshape(-1, 3), x[n:].reshape(-1, 6)
+
+    def extrinsics(self, extr):
+        """(rvecs, tvecs) (C, 3, 1) con i parametri delle camere libere sostituiti."""
+        rvecs, tvecs = self.rig.rvecs.copy(), self.rig.tvecs.copy()
+        for c, e in zip(self.free_cams, extr):
+            rvecs[c, :, 0], tvecs[c, :, 0] = e[:3], e[3:]
+        return rvecs, tvecs
+
+    def residuals(self, x):
+        points, extr = self.unpack(x)
+        rvecs, tvecs = self.extrinsics(extr)
+        res = np.empty((len(self.obs_point), 2))
+        for c, sel in enumerate(self.cam_obs):
+            if not len(sel):
+                continue
+            proj, _ = cv2.projectPoints(points[self.obs_point[sel]], rvecs[c], tvecs[c],
+                                        self.rig.K[c], self.rig.dist[c])
+            res[sel] = proj.reshape(-1, 2) - self.obs_xy[sel]
+        prior = (extr.ravel() - self.extr0) * self.prior_scale
+        return np.concatenate((res.ravel(), prior))
+
+    def jac_sparsity(self):
+        """Matrice di sparsità (residui x parametri) a blocchi 2x3 e 2x6."""
+        M, N, L = len(self.obs_point), self.num_points, len(self.free_cams)
+        obs = np.arange(M)
+        rows = [np.repeat(2 * obs[:, None] + np.arange(2), 3, axis=1).ravel()]
+        cols = [np.tile(3 * self.obs_point[:, None] + np.arange(3), (1, 2)).ravel()]
+
+        free = np.array([self.free_pos.get(int(c), -1) for c in self.obs_cam], dtype=np.int64)
+        on_free = np.flatnonzero(free >= 0)
+        if len(on_free):
+            rows.append(np.repeat(2 * on_free[:, None] + np.arange(2), 6, axis=1).ravel())
+            cols.append(np.tile(3 * N + 6 * free[on_free, None] + np.arange(6), (1, 2)).ravel())
+        # prior: ogni residuo dipende solo dal proprio parametro
+        rows.append(2 * M + np.arange(6 * L))
+        cols.append(3 * N + np.arange(6 * L))
+
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        return coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                          shape=(2 * M + 6 * L, 3 * N + 6 * L)).tocsr()
+
+
+def bundle_adjust(coco, sk3d, rig, refine_extrinsics=False, reference_cam=None, loss='linear',
+                  f_scale=10.0, max_nfev=50, min_visibility=2, verbose=0):
+    """
+    Raffina i giunti di sk3d (e opzionalmente gli estrinseci).
+    Ritorna (Skeleton raffinato, CameraRig con gli estrinseci raffinati, risultato least_squares).
+    """
+    point_rows, point_joints, obs_point, obs_cam, obs_xy = gather_observations(
+        coco, sk3d, rig, min_visibility)
+    free_cams = []
+    if refine_extrinsics:
+        ref = rig.index(reference_cam if reference_cam is not None else rig.cam_ids[0])
+        free_cams = [c for c in range(len(rig.cam_ids)) if c != ref and np.any(obs_cam == c)]
+
+    points0 = np.asarray(sk3d.points)[point_rows, point_joints]
+    problem = BundleProblem(rig, obs_point, obs_cam, obs_xy, len(points0), free_cams)
+    with span('bundle.solve', points=len(points0), observations=len(obs_xy)) as s:
+        result = least_squares(problem.residuals, problem.pack(points0), jac_sparsity=problem.jac_sparsity(),
+                               method='trf', x_scale='jac', loss=loss, f_scale=f_scale,
+                               max_nfev=max_nfev, verbose=verbose)
+        s.add(evaluations=result.nfev)
+
+    points, extr = problem.unpack(result.x)
+    refined = np.array(sk3d.points, dtype=np.float64)
+    refined[point_rows, point_joints] = points
+    rvecs, tvecs = problem.extrinsics(extr)
+    new_rig = CameraRig(rig.cam_ids, rig.K, rig.dist, rvecs, tvecs, rig.image_sizes)
+    meta = dict(sk3d.meta, refined=True, refine_extrinsics=bool(refine_extrinsics), loss=loss)
+    return Skeleton(refined, sk3d.frames, meta=meta, **sk3d.extras), new_rig, result
+
+
+@traced('bundle_adjustment')
+def main():
+    parser = argparse.ArgumentParser(description='Bundle adjustment di giunti 3D ed estrinseci')
+    parser.add_argument('--skeleton', default=SKELETON_PATH, help='Scheletro 3D iniziale')
+    parser.add_argument('--annotations', default=RECT_ANN_PATH, help='Annotazioni COCO rettificate')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='Scheletro raffinato (.npz)')
+    parser.add_argument('--extrinsics', action='store_true', help='Ottimizza anche rvec/tvec delle camere')
+    parser.add_argument('--reference_cam', type=int, default=None,
+                        help='Camera con estrinseci fissi (default: la prima)')
+    parser.add_argument('--extrinsics_output', default=EXTRINSICS_PATH,
+                        help='JSON con gli estrinseci raffinati (solo con --extrinsics)')
+    parser.add_argument('--loss', choices=['linear', 'huber', 'soft_l1', 'cauchy'], default='linear',
+                        help='Funzione di perdita robusta')
+    parser.add_argument('--f_scale', type=float, default=10.0, help='Scala (pixel) della perdita robusta')
+    parser.add_argument('--max_nfev', type=int, default=50, help='Massimo numero di valutazioni')
+    args = parser.parse_args()
+
+    coco = AnnotationIndex.load(args.annotations)
+    rig  = CameraRig.load()
+    sk3d = load_skeleton(args.skeleton)
+
+    _, _, before = reproject(coco, sk3d, rig)
+    t0 = time.perf_counter()
+    refined, new_rig, result = bundle_adjust(coco, sk3d, rig, args.extrinsics, args.reference_cam,
+                                             args.loss, args.f_scale, args.max_nfev)
+    elapsed = time.perf_counter() - t0
+    _, _, after = reproject(coco, refined, new_rig)
+
+    print(f"Parametri: {result.x.size}  residui: {result.fun.size}  valutazioni: {result.nfev}  "
+          f"tempo: {elapsed:.2f} s")
+    print(f"MPJPE prima: {before.overall()[1]:.3f} px   dopo: {after.overall()[1]:.3f} px")
+    print(f"MSE   prima: {before.overall()[0]:.3f} px²  dopo: {after.overall()[0]:.3f} px²")
+
+    save_skeleton(args.output, refined)
+    print(f"Scheletro raffinato salvato in {args.output}")
+    if args.extrinsics:
+        extr = {str(c): {'rvecs': new_rig.rvecs[i].tolist(), 'tvecs': new_rig.tvecs[i].tolist()}
+                for i, c in enumerate(new_rig.cam_ids)}
+        with open(args.extrinsics_output, 'w') as f:
+            json.dump(extr, f, indent=2)
+        print(f"Estrinseci raffinati salvati in {args.extrinsics_output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+CALIBRAZIONE ESTRINSECA DA calib/img_points.json
+
+Ogni camera ha in calib/img_points.json le corrispondenze tra punti del
+campo (real_corners, in metri sul piano z=0) e pixel (img_corners). Per
+tutte le camere in blocco risolve la PnP (opzionalmente con RANSAC) con gli
+intrinseci attuali, poi verifica la coerenza del rig: i punti del campo
+visti da almeno due camere vengono triangolati con i nuovi estrinseci e per
+ogni camera si riportano
+  - l'errore di riproiezione della PnP (pixel),
+  - l'errore di riproiezione dei punti triangolati (pixel),
+  - la distanza tra punti triangolati e coordinate note del campo (mm).
+Infine rvecs/tvecs in camera_calib.json vengono aggiornati in modo atomico.
+
+Esempio: python calibrate_extrinsics.py --ransac --dry_run
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+import cv2
+
+from camera_rig import CALIB_DIR, CameraRig, calib_files, update_calib_json
+from instrumentation import span, traced
+from triangulation import triangulate_batch
+
+# real_corners è in metri, il resto del progetto lavora in millimetri
+WORLD_SCALE      = 1000.0
+RANSAC_THRESHOLD = 20.0       # pixel
+
+
+def load_correspondences(calib_dir=CALIB_DIR, cam_ids=None):
+    """Ritorna dict cam_id -> (object_points (N, 3) mm, image_points (N, 2))."""
+    corrs = {}
+    for cam_id, (calib_file, _) in calib_files(calib_dir).items():
+        if cam_ids and cam_id not in cam_ids:
+            continue
+        path = os.path.join(os.path.dirname(calib_file), 'img_points.json')
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'r') as f:
+            data = json.load(f)
+        obj = np.asarray(data['real_corners'], dtype=np.float64).reshape(-1, 3) * WORLD_SCALE
+        img = np.asarray(data['img_corners'], dtype=np.float64).reshape(-1, 2)
+        corrs[cam_id] = (obj, img)
+    return corrs
+
+
+def solve_extrinsics(rig, corrs, ransac=False, threshold=RANSAC_THRESHOLD):
+    """
+    PnP per tutte le camere. Ritorna dict cam_id -> dict con rvec, tvec
+    (3, 1), inliers (N,) bool e residui di riproiezione (N,) in pixel.
+    """
+    results = {}
+    for cam_id, (obj, img) in sorted(corrs.items()):
+        K, dist, _, _ = rig.camera(cam_id)
+        inliers = np.ones(len(obj), dtype=bool)
+        if ransac:
+            ok, rvec, tvec, idx = cv2.solvePnPRansac(obj, img, K, dist, reprojectionError=threshold,
+                                                      flags=cv2.SOLVEPNP_ITERATIVE)
+            if ok and idx is not None and len(idx) >= 4:
+                inliers[:] = False
+                inliers[idx.ravel()] = True
+                # rifinitura sui soli inlier
+                ok, rvec, tvec = cv2.solvePnP(obj[inliers], img[inliers], K, dist, rvec, tvec,
+                                              useExtrinsicGuess=True)
+        else:
+            ok, rvec, tvec = cv2.solvePnP(obj, img, K, dist)
+        if not ok:
+            print(f"cam_{cam_id}: PnP fallita")
+            continue
+        proj, _ = cv2.projectPoints(obj, rvec, tvec, K, dist)
+        results[cam_id] = {'rvec': rvec.reshape(3, 1), 'tvec': tvec.reshape(3, 1), 'inliers': inliers,
+                           'residuals': np.linalg.norm(proj.reshape(-1, 2) - img, axis=1)}
+    return results
+
+
+def consistency_check(rig, corrs):
+    """
+    Triangola i punti del campo osservati da almeno 2 camere (chiave: le
+    coordinate note) e ritorna dict cam_id -> {'reproj_px', 'world_mm', 'points'}
+    più il numero di punti condivisi.
+    """
+    cam_ids = [c for c in rig.cam_ids if c in corrs]
+    keys = sorted({tuple(p) for c in cam_ids for p in corrs[c][0]})
+    pos = {k: i for i, k in enumerate(keys)}
+    obs = np.zeros((1, len(cam_ids), len(keys), 3))
+    for ci, c in enumerate(cam_ids):
+        obj, img = corrs[c]
+        K, dist, _, _ = rig.camera(c)
+        # la DLT usa P = K [R|t], quindi i pixel vanno prima non distorti
+        und = cv2.undistortPoints(img.reshape(-1, 1, 2), K, dist, P=K).reshape(-1, 2)
+        idx = [pos[tuple(p)] for p in obj]
+        obs[0, ci, idx, :2] = und
+        obs[0, ci, idx, 2] = 2
+    P = np.stack([rig.projection(c) for c in cam_ids])
+    X = triangulate_batch(obs, P)[0]                                   # (N, 3)
+    shared = np.isfinite(X).all(axis=1)
+    truth = np.array(keys)
+
+    report = {}
+    for ci, c in enumerate(cam_ids):
+        obj, img = corrs[c]
+        idx = np.array([pos[tuple(p)] for p in obj])
+        sel = shared[idx]
+        if not sel.any():
+            report[c] = {'points': 0}
+            continue
+        K, dist, rvec, tvec = rig.camera(c)
+        proj, _ = cv2.projectPoints(X[idx[sel]], rvec, tvec, K, dist)
+        report[c] = {
+            'points':    int(sel.sum()),
+            'reproj_px': float(np.linalg.norm(proj.reshape(-1, 2) - img[sel], axis=1).mean()),
+            'world_mm':  float(np.linalg.norm(X[idx[sel]] - truth[idx[sel]], axis=1).mean()),
+        }
+    return report, int(shared.sum())
+
+
+@traced('calibrate_extrinsics')
+def main():
+    parser = argparse.ArgumentParser(description='Estrinseci delle camere da calib/img_points.json')
+    parser.add_argument('--calib_dir', default=CALIB_DIR, help='Cartella con cam_N/calib')
+    parser.add_argument('--cams', type=int, nargs='*', default=None, help='Camere da ricalibrare (default: tutte)')
+    parser.add_argument('--ransac', action='store_true', help='Usa solvePnPRansac')
+    parser.add_argument('--threshold', type=float, default=RANSAC_THRESHOLD, help='Soglia RANSAC in pixel')
+    parser.add_argument('--dry_run', action='store_true', help='Non scrive camera_calib.json')
+    args = parser.parse_args()
+
+    rig = CameraRig.load(args.calib_dir)
+    corrs = load_correspondences(args.calib_dir, args.cams)
+    with span('calib.pnp', cameras=len(corrs)):
+        results = solve_extrinsics(rig, corrs, args.ransac, args.threshold)
+
+    # rig con i nuovi estrinseci per il controllo incrociato (tutte le camere)
+    rvecs, tvecs = rig.rvecs.copy(), rig.tvecs.copy()
+    for cam_id, res in results.items():
+        rvecs[rig.index(cam_id)], tvecs[rig.index(cam_id)] = res['rvec'], res['tvec']
+    new_rig = CameraRig(rig.cam_ids, rig.K, rig.dist, rvecs, tvecs, rig.image_sizes)
+    with span('calib.consistency'):
+        report, n_shared = consistency_check(new_rig, load_correspondences(args.calib_dir))
+
+    print(f"Punti del campo condivisi da almeno 2 camere: {n_shared}")
+    for cam_id, res in results.items():
+        i = rig.index(cam_id)
+        moved = np.linalg.norm(new_rig.centers[i] - rig.centers[i])
+        chk = report.get(cam_id, {})
+        cross = (f"triangolati {chk['reproj_px']:6.2f} px {chk['world_mm']:8.1f} mm ({chk['points']} punti)"
+                 if chk.get('points') else "nessun punto condiviso con altre camere")
+        print(f"cam_{cam_id}: PnP {res['residuals'][res['inliers']].mean():6.2f} px "
+              f"({res['inliers'].sum()}/{len(res['inliers'])} inlier)  {cross}  "
+              f"spostamento centro {moved:.1f} mm")
+
+    if args.dry_run:
+        return
+    files = calib_files(args.calib_dir)
+    for cam_id, res in results.items():
+        chk = report.get(cam_id, {})
+        update_calib_json(files[cam_id][0], {
+            'rvecs': res['rvec'].tolist(),
+            'tvecs': res['tvec'].tolist(),
+            'extrinsics': {
+                'ransac':        bool(args.ransac),
+                'pnp_rms':       float(np.sqrt(np.mean(res['residuals'][res['inliers']] ** 2))),
+                'inliers':       int(res['inliers'].sum()),
+                'points':        len(res['inliers']),
+                'consistency':   chk,
+            },
+        })
+    print("camera_calib.json aggiornati")
+
+
+if __name__ == '__main__':
+    main()
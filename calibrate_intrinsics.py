@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+CALIBRAZIONE INTRINSECA DAI DUMP DELLA SCACCHIERA
+
+Per ogni camera legge tutti i camera_data/cam_N/dump/dump_*.json (liste di
+frame, ognuno con gli angoli interni della scacchiera rilevati, (n, 1, 2)),
+sceglie un sottoinsieme piccolo e ben distribuito di viste e lancia
+cv2.calibrateCamera solo su quelle:
+  - copertura: l'immagine è divisa in una griglia e si preferiscono le
+    viste che coprono celle non ancora coperte;
+  - diversità di posa: ogni vista è descritta da posizione, scala,
+    rotazione nel piano e inclinazione della scacchiera (dall'omografia);
+    si preferiscono le viste lontane da quelle già scelte.
+Le camere vengono calibrate in parallelo in processi separati.
+
+Il risultato aggiorna calib/camera_calib.json (mtx, dist) in modo atomico,
+lasciando invariati gli estrinseci (rvecs, tvecs), e aggiunge le statistiche
+dei residui per vista: sia delle viste usate sia di tutte le altre
+(valutate con solvePnP), così si vede se la calibrazione generalizza.
+
+La disposizione della scacchiera (angoli per riga x righe) viene dedotta
+dal numero di angoli e dalla loro geometria; si può forzare con --pattern.
+La dimensione del quadrato non influisce sugli intrinseci.
+
+Esempio: python calibrate_intrinsics.py --cams 2 5 --views 20 --jobs 4
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+from camera_rig import CALIB_DIR, calib_files, update_calib_json
+from instrumentation import span, traced
+
+NUM_VIEWS   = 20
+GRID_CELLS  = (8, 6)          # celle di copertura (colonne, righe)
+SQUARE_SIZE = 1.0             # unità arbitraria: gli intrinseci non dipendono dalla scala
+
+
+def load_dumps(cam_dir):
+    """Ritorna (corners (V, n, 2) float32, sorgenti [(file, indice)]) di tutti i dump della camera."""
+    corners, sources = [], []
+    for path in sorted(glob.glob(os.path.join(cam_dir, 'dump', 'dump_*.json'))):
+        with open(path, 'r') as f:
+            frames = json.load(f)
+        for i, frame in enumerate(frames):
+            pts = np.asarray(frame, dtype=np.float32).reshape(-1, 2)
+            corners.append(pts)
+            sources.append((os.path.basename(path), i))
+    if not corners:
+        return np.zeros((0, 0, 2), np.float32), []
+    n = max(len(c) for c in corners)
+    keep = [i for i, c in enumerate(corners) if len(c) == n]    # viste con tutti gli angoli
+    return np.stack([corners[i] for i in keep]), [sources[i] for i in keep]
+
+
+def infer_pattern(corners):
+    """
+    Deduce (angoli per riga, righe) dai salti tra angoli consecutivi: nei
+    punti di fine riga la distanza è molto più grande del passo normale.
+    """
+    n = corners.shape[1]
+    steps = np.linalg.norm(np.diff(corners, axis=1), axis=-1)    # (V, n-1)
+    scores = {}
+    for cols in range(2, n // 2 + 1):
+        if n % cols:
+            continue
+        wrap = np.zeros(n - 1, dtype=bool)
+        wrap[cols - 1::cols] = True
+        scores[cols] = np.median(steps[:, wrap].mean(axis=1) / np.median(steps[:, ~wrap], axis=1))
+    if not scores:
+        raise ValueError(f"Impossibile dedurre la scacchiera da {n} angoli")
+    best = max(scores.values())
+    # i multipli del numero corretto hanno punteggio simile: si prende il più piccolo
+    cols = min(c for c, s in scores.items() if s >= 0.9 * best)
+    return cols, n // cols
+
+
+def object_points(pattern, square_size=SQUARE_SIZE):
+    cols, rows = pattern
+    grid = np.zeros((rows * cols, 3), np.float32)
+    grid[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2) * square_size
+    return grid
+
+
+def view_features(corners, pattern, image_size):
+    """
+    Descrittori (V, 6) di posa normalizzati: centro x/y, scala, rotazione nel
+    piano (cos, sin del doppio angolo) e inclinazione prospettica.
+    """
+    w, h = image_size
+    cols, rows = pattern
+    obj = object_points(pattern)[:, :2]
+    feats = []
+    for pts in corners:
+        H, _ = cv2.findHomography(obj, pts)
+        if H is None:
+            H = np.eye(3)
+        H = H / H[2, 2]
+        center = pts.mean(axis=0) / (w, h)
+        scale = np.sqrt(cv2.contourArea(cv2.convexHull(pts)) / (w * h))
+        axis = pts[cols - 1] - pts[0]
+        angle = np.arctan2(axis[1], axis[0])
+        tilt = np.hypot(H[2, 0], H[2, 1]) * max(cols, rows)
+        feats.append([center[0], center[1], scale, np.cos(2 * angle) / 2, np.sin(2 * angle) / 2, tilt])
+    return np.array(feats)
+
+
+def coverage_cells(corners, image_size, grid=GRID_CELLS):
+    """Maschera (V, celle) delle celle della griglia toccate da ogni vista."""
+    w, h = image_size
+    gx = np.clip((corners[..., 0] / w * grid[0]).astype(int), 0, grid[0] - 1)
+    gy = np.clip((corners[..., 1] / h * grid[1]).astype(int), 0, grid[1] - 1)
+    cells = np.zeros((len(corners), grid[0] * grid[1]), dtype=bool)
+    np.put_along_axis(cells, gy * grid[0] + gx, True, axis=1)
+    return cells
+
+
+def select_views(corners, pattern, image_size, num_views=NUM_VIEWS, diversity_weight=1.0):
+    """
+    Selezione greedy: ad ogni passo la vista che massimizza
+    (celle nuove coperte / celle totali) + diversity_weight * distanza
+    minima (nello spazio dei descrittori) dalle viste già scelte.
+    """
+    V = len(corners)
+    if V <= num_views:
+        return np.arange(V)
+    cells = coverage_cells(corners, image_size)
+    feats = view_features(corners, pattern, image_size)
+    feats = (feats - feats.mean(axis=0)) / np.maximum(feats.std(axis=0), 1e-9)
+
+    covered = np.zeros(cells.shape[1], dtype=bool)
+    min_dist = np.full(V, np.inf)
+    chosen = []
+    for _ in range(num_views):
+        gain = (cells & ~covered).sum(axis=1) / cells.shape[1]
+        diversity = np.where(np.isfinite(min_dist), min_dist, 0.0)
+        diversity = diversity / max(diversity.max(), 1e-9)
+        score = gain + diversity_weight * diversity
+        score[chosen] = -np.inf
+        if not chosen:
+            score = cells.sum(axis=1).astype(float)         # si parte dalla vista più grande
+        best = int(np.argmax(score))
+        chosen.append(best)
+        covered |= cells[best]
+        min_dist = np.minimum(min_dist, np.linalg.norm(feats - feats[best], axis=1))
+    return np.array(sorted(chosen))
+
+
+def view_residuals(obj, corners, K, dist):
+    """RMS di riproiezione (pixel) di ogni vista, con la posa stimata da solvePnP."""
+    rms = np.full(len(corners), np.nan)
+    for i, pts in enumerate(corners):
+        ok, rvec, tvec = cv2.solvePnP(obj, pts, K, dist)
+        if ok:
+            proj, _ = cv2.projectPoints(obj, rvec, tvec, K, dist)
+            rms[i] = np.sqrt(np.mean(np.sum((proj.reshape(-1, 2) - pts) ** 2, axis=1)))
+    return rms
+
+
+def _stats(values):
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return {}
+    return {'mean': float(values.mean()), 'median': float(np.median(values)),
+            'max': float(values.max()), 'count': int(values.size)}
+
+
+def calibrate_camera(cam_id, cam_dir, image_size, num_views=NUM_VIEWS, pattern=None):
+    """Calibra una camera; ritorna un dict con mtx, dist e le statistiche dei residui."""
+    t0 = time.perf_counter()
+    corners, sources = load_dumps(cam_dir)
+    if len(corners) < 3:
+        raise ValueError(f"cam_{cam_id}: servono almeno 3 viste complete, trovate {len(corners)}")
+    pattern = tuple(pattern) if pattern else infer_pattern(corners)
+    obj = object_points(pattern)
+
+    chosen = select_views(corners, pattern, image_size, num_views)
+    with span('calib.intrinsics', views=len(chosen)):
+        rms, K, dist, _, _, _, _, per_view = cv2.calibrateCameraExtended(
+            [obj] * len(chosen), [corners[i] for i in chosen], tuple(image_size), None, None)
+
+    all_rms = view_residuals(obj, corners, K, dist)
+    held_out = np.setdiff1d(np.arange(len(corners)), chosen)
+    return {
+        'cam_id':  cam_id,
+        'mtx':     K.tolist(),
+        'dist':    dist.reshape(1, -1).tolist(),
+        'calibration': {
+            'rms':            float(rms),
+            'pattern':        list(pattern),
+            'image_size':     list(image_size),
+            'views_total':    len(corners),
+            'views_used':     [{'dump': sources[i][0], 'index': sources[i][1], 'rms': float(e)}
+                               for i, e in zip(chosen, per_view.ravel())],
+            'residuals_used': _stats(per_view.ravel()),
+            'residuals_held_out': _stats(all_rms[held_out]),
+        },
+        # fuori dal blocco salvato: non deve cambiare camera_calib.json (e quindi calib_hash)
+        'seconds': time.perf_counter() - t0,
+    }
+
+
+def _image_size(cam_dir):
+    with open(os.path.join(cam_dir, 'metadata.json'), 'r') as f:
+        return tuple(json.load(f)['imsize'])
+
+
+@traced('calibrate_intrinsics')
+def main():
+    parser = argparse.ArgumentParser(description='Calibrazione intrinseca dai dump della scacchiera')
+    parser.add_argument('--calib_dir', default=CALIB_DIR, help='Cartella con cam_N/dump e cam_N/calib')
+    parser.add_argument('--cams', type=int, nargs='*', default=None, help='Camere da calibrare (default: tutte)')
+    parser.add_argument('--views', type=int, default=NUM_VIEWS, help='Viste usate per camera')
+    parser.add_argument('--pattern', type=int, nargs=2, default=None, metavar=('COLS', 'ROWS'),
+                        help='Angoli interni per riga e righe (default: dedotti)')
+    parser.add_argument('--jobs', type=int, default=4, help='Camere calibrate in parallelo')
+    parser.add_argument('--dry_run', action='store_true', help='Non scrive camera_calib.json')
+    args = parser.parse_args()
+
+    cam_dirs = {int(d.split('_')[-1]): os.path.join(args.calib_dir, d)
+                for d in sorted(os.listdir(args.calib_dir))
+                if d.startswith('cam_') and os.path.isdir(os.path.join(args.calib_dir, d, 'dump'))}
+    if args.cams:
+        cam_dirs = {c: d for c, d in cam_dirs.items() if c in args.cams}
+    jobs = [(c, d, _image_size(d), args.views, args.pattern) for c, d in sorted(cam_dirs.items())]
+
+    if args.jobs <= 1:
+        results = [calibrate_camera(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = [fut.result() for fut in [pool.submit(calibrate_camera, *job) for job in jobs]]
+
+    existing = calib_files(args.calib_dir)
+    for res in results:
+        cam_id, cal = res['cam_id'], res['calibration']
+        K = np.array(res['mtx'])
+        print(f"cam_{cam_id}: {len(cal['views_used'])}/{cal['views_total']} viste, scacchiera "
+              f"{cal['pattern'][0]}x{cal['pattern'][1]}, RMS {cal['rms']:.3f} px, "
+              f"held-out {cal['residuals_held_out'].get('mean', float('nan')):.3f} px, "
+              f"f=({K[0, 0]:.1f}, {K[1, 1]:.1f}) c=({K[0, 2]:.1f}, {K[1, 2]:.1f}), {res['seconds']:.2f} s")
+        if not args.dry_run:
+            calib_file = existing.get(cam_id, (os.path.join(cam_dirs[cam_id], 'calib', 'camera_calib.json'),))[0]
+            # mtx/dist nuovi, estrinseci (rvecs, tvecs) invariati
+            update_calib_json(calib_file, {k: res[k] for k in ('mtx', 'dist', 'calibration')})
+    if not args.dry_run:
+        print("camera_calib.json aggiornati")
+
+
+if __name__ == '__main__':
+    main()
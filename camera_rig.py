@@ -0,0 +1,215 @@
+"""
+RIG MULTI-CAMERA CONDIVISO
+
+Carica camera_data/cam_*/calib una sola volta e precalcola K, dist, R, t,
+P = K [R|t], centri ottici e matrici fondamentali per ogni coppia di camere.
+Il risultato viene salvato in una cache binaria (.npz) indicizzata dall'hash
+del contenuto dei file di calibrazione, quindi le esecuzioni successive non
+rifanno né il parsing JSON né Rodrigues.
+"""
+
+import hashlib
+import json
+import os
+import cv2
+import numpy as np
+
+CALIB_DIR = 'camera_data'
+CACHE_DIR = '.cache'
+
+
+def calib_files(calib_dir=CALIB_DIR):
+    """Ritorna dict cam_id (int) -> (camera_calib.json, metadata.json o None)."""
+    files = {}
+    for cam_folder in sorted(os.listdir(calib_dir)):
+        if not cam_folder.startswith('cam_'):
+            continue
+        calib_file = os.path.join(calib_dir, cam_folder, 'calib', 'camera_calib.json')
+        if not os.path.isfile(calib_file):
+            continue
+        meta_file = os.path.join(calib_dir, cam_folder, 'metadata.json')
+        files[int(cam_folder.split('_')[-1])] = (
+            calib_file, meta_file if os.path.isfile(meta_file) else None)
+    return files
+
+
+def calib_hash(calib_dir=CALIB_DIR):
+    """Hash SHA-1 del contenuto di tutti i file di calibrazione del rig."""
+    h = hashlib.sha1()
+    for cam_id, paths in sorted(calib_files(calib_dir).items()):
+        h.update(str(cam_id).encode())
+        for path in paths:
+            if path is None:
+                continue
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def update_calib_json(calib_file, updates):
+    """Aggiorna alcune chiavi di camera_calib.json in modo atomico (file temporaneo + os.replace)."""
+    data = {}
+    if os.path.isfile(calib_file):
+        with open(calib_file, 'r') as f:
+            data = json.load(f)
+    data.update(updates)
+    os.makedirs(os.path.dirname(calib_file) or '.', exist_ok=True)
+    tmp_path = f"{calib_file}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, calib_file)
+
+
+def _skew(v):
+    return np.array([[0, -v[2], v[1]],
+                     [v[2], 0, -v[0]],
+                     [-v[1], v[0], 0]])
+
+
+class CameraRig:
+    """
+    Calibrazione di tutte le camere, in array impilati nell'ordine di cam_ids.
+
+      K (C,3,3), dist (C,D), rvecs/tvecs (C,3,1), R (C,3,3), P (C,3,4),
+      centers (C,3) in coordinate mondo, image_sizes (C,2) = (w, h),
+      F (C,C,3,3) con x_j^T F[i,j] x_i = 0.
+    """
+
+    ARRAYS = ('cam_ids', 'K', 'dist', 'rvecs', 'tvecs', 'image_sizes',
+              'R', 'P', 'centers', 'F')
+
+    def __init__(self, cam_ids, K, dist, rvecs, tvecs, image_sizes,
+                 R=None, P=None, centers=None, F=None, calib_hash=None):
+        self.cam_ids     = [int(c) for c in cam_ids]
+        self.K           = np.asarray(K, dtype=np.float64)
+        self.dist        = np.asarray(dist, dtype=np.float64)
+        self.rvecs       = np.asarray(rvecs, dtype=np.float64).reshape(-1, 3, 1)
+        self.tvecs       = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3, 1)
+        self.image_sizes = np.asarray(image_sizes, dtype=np.int64).reshape(-1, 2)
+        self.calib_hash  = calib_hash
+        self._index      = {c: i for i, c in enumerate(self.cam_ids)}
+
+        if R is None:
+            R = np.stack([cv2.Rodrigues(r)[0] for r in self.rvecs])
+        self.R = np.asarray(R, dtype=np.float64)
+        if P is None:
+            P = self.K @ np.concatenate((self.R, self.tvecs), axis=2)
+        self.P = np.asarray(P, dtype=np.float64)
+        if centers is None:
+            centers = -(np.swapaxes(self.R, 1, 2) @ self.tvecs)[..., 0]
+        self.centers = np.asarray(centers, dtype=np.float64)
+        if F is None:
+            F = self._fundamental_matrices()
+        self.F = np.asarray(F, dtype=np.float64)
+
+    def _fundamental_matrices(self):
+        C = len(self.cam_ids)
+        F = np.zeros((C, C, 3, 3))
+        K_inv = np.linalg.inv(self.K)
+        for i in range(C):
+            for j in range(C):
+                if i == j:
+                    continue
+                R_ij = self.R[j] @ self.R[i].T
+                t_ij = self.tvecs[j, :, 0] - R_ij @ self.tvecs[i, :, 0]
+                E = _skew(t_ij) @ R_ij
+                F[i, j] = K_inv[j].T @ E @ K_inv[i]
+        return F
+
+    # --- accesso per camera ---
+
+    def __len__(self):
+        return len(self.cam_ids)
+
+    def __contains__(self, cam_id):
+        return int(cam_id) in self._index
+
+    def index(self, cam_id):
+        """Posizione della camera negli array impilati."""
+        return self._index[int(cam_id)]
+
+    def camera(self, cam_id):
+        """Ritorna (K, dist, rvec, tvec) della camera, come in camera_calib.json."""
+        i = self.index(cam_id)
+        return self.K[i], self.dist[i], self.rvecs[i], self.tvecs[i]
+
+    def projection(self, cam_id):
+        return self.P[self.index(cam_id)]
+
+    def image_size(self, cam_id):
+        """(w, h) della camera da metadata.json."""
+        w, h = self.image_sizes[self.index(cam_id)]
+        return int(w), int(h)
+
+    def fundamental(self, cam_a, cam_b):
+        """F tale che x_b^T F x_a = 0."""
+        return self.F[self.index(cam_a), self.index(cam_b)]
+
+    # --- costruzione e cache ---
+
+    @classmethod
+    def from_calib_dir(cls, calib_dir=CALIB_DIR):
+        """Parsa i JSON di calibrazione e calcola tutte le matrici derivate."""
+        cam_ids, K, dist, rvecs, tvecs, sizes = [], [], [], [], [], []
+        for cam_id, (calib_file, meta_file) in sorted(calib_files(calib_dir).items()):
+            with open(calib_file, 'r') as f:
+                calib = json.load(f)
+            size = (0, 0)
+            if meta_file is not None:
+                with open(meta_file, 'r') as f:
+                    size = tuple(json.load(f).get('imsize', size))
+            cam_ids.append(cam_id)
+            K.append(np.array(calib['mtx'], dtype=np.float64))
+            dist.append(np.array(calib.get('dist', [0, 0, 0, 0, 0]), dtype=np.float64).ravel())
+            rvecs.append(np.array(calib['rvecs'], dtype=np.float64).reshape(3, 1))
+            tvecs.append(np.array(calib['tvecs'], dtype=np.float64).reshape(3, 1))
+            sizes.append(size)
+        if not cam_ids:
+            raise FileNotFoundError(f"No camera calibration found in {calib_dir}")
+
+        # coefficienti di distorsione di lunghezza diversa: zero padding
+        n = max(len(d) for d in dist)
+        dist = [np.pad(d, (0, n - len(d))) for d in dist]
+        return cls(cam_ids, np.stack(K), np.stack(dist), np.stack(rvecs),
+                   np.stack(tvecs), sizes, calib_hash=calib_hash(calib_dir))
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        arrays = {name: np.asarray(getattr(self, name)) for name in self.ARRAYS}
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, calib_hash=np.array(self.calib_hash or ''), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_file(cls, path):
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in cls.ARRAYS}
+            h = str(data['calib_hash']) or None
+        return cls(calib_hash=h, **arrays)
+
+    @classmethod
+    def load(cls, calib_dir=CALIB_DIR, cache_dir=CACHE_DIR):
+        """
+        Carica il rig dalla cache binaria se l'hash dei file di calibrazione
+        coincide, altrimenti lo ricalcola e aggiorna la cache.
+        Con cache_dir=None la cache è disabilitata.
+        """
+        if cache_dir is None:
+            return cls.from_calib_dir(calib_dir)
+        h = calib_hash(calib_dir)
+        cache_path = os.path.join(cache_dir, f"camera_rig_{h[:16]}.npz")
+        if os.path.isfile(cache_path):
+            rig = cls.from_file(cache_path)
+            if rig.calib_hash == h:
+                return rig
+        rig = cls.from_calib_dir(calib_dir)
+        rig.save(cache_path)
+        return rig
+
+
+if __name__ == '__main__':
+    rig = CameraRig.load()
+    print(f"Rig {rig.calib_hash[:16]}: camere {rig.cam_ids}")
+    for cam_id, C in zip(rig.cam_ids, rig.centers):
+        w, h = rig.image_size(cam_id)
+        print(f"  cam_{cam_id}: {w}x{h}, centro ottico {np.round(C, 1).tolist()}")
@@ -0,0 +1,163 @@
+"""
+INDICE DELLE ANNOTAZIONI COCO CONDIVISO
+
+Parsa il file COCO una sola volta e costruisce:
+  - images:             image_id -> immagine
+  - anns_by_image:      image_id -> lista di annotazioni
+  - image_by_cam_frame: (cam_id, frame) -> image_id
+  - cam_frame:          image_id -> (cam_id, frame)
+  - keypoints:          tensore (F, C, J, 3) [x, y, v] per frame e camera
+                        (v=0 dove la camera non ha annotazioni)
+  - annotated:          (F, C) bool, True se la camera ha un'annotazione nel frame
+L'indice viene salvato in cache (pickle), un file per path sorgente che
+registra anche CACHE_VERSION, mtime e dimensione: se il JSON cambia il file
+di cache viene sovrascritto, così le query ripetute non riparsano il JSON e
+la cartella di cache non cresce ad ogni modifica.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import numpy as np
+
+from camera_rig import CACHE_DIR
+from instrumentation import span
+
+INDEX_CACHE_DIR = os.path.join(CACHE_DIR, 'coco_index')
+# da incrementare quando cambiano gli attributi di AnnotationIndex: invalida i pickle vecchi
+CACHE_VERSION = 1
+
+
+def parse_image_name(name):
+    """
+    Estrae cam_id e frame_idx dal nome:
+      es. 'out2_frame_0001.png' → (2, 1)
+    Ritorna (cam_id, frame_idx) o (None, None) se non matcha.
+    """
+    base = os.path.basename(name)
+    m = re.match(r"out(\d+)_frame_(\d+)", base)
+    if not m:
+        return None, None
+    return int(m.group(1)), int(m.group(2))
+
+
+def image_name(img):
+    """Nome originale dell'immagine (extra.name se presente, altrimenti file_name)."""
+    return img.get('extra', {}).get('name', img['file_name'])
+
+
+class AnnotationIndex:
+
+    def __init__(self, data):
+        self.data = data
+        self.images = {img['id']: img for img in data['images']}
+
+        self.anns_by_image = {}
+        for ann in data['annotations']:
+            self.anns_by_image.setdefault(ann['image_id'], []).append(ann)
+
+        self.cam_frame = {}
+        self.image_by_cam_frame = {}
+        for img in data['images']:
+            cam_id, frame = parse_image_name(image_name(img))
+            if cam_id is None:
+                continue
+            self.cam_frame[img['id']] = (cam_id, frame)
+            self.image_by_cam_frame[(cam_id, frame)] = img['id']
+
+        self.cam_ids = sorted({c for c, _ in self.cam_frame.values()})
+        self.frames  = np.array(sorted({f for _, f in self.cam_frame.values()}), dtype=np.int64)
+        self._build_keypoints()
+
+    def _build_keypoints(self):
+        num_joints = 0
+        for cat in self.data.get('categories', []):
+            num_joints = max(num_joints, len(cat.get('keypoints', [])))
+        if not num_joints and self.data['annotations']:
+            num_joints = len(self.data['annotations'][0].get('keypoints', [])) // 3
+
+        cam_pos   = {c: i for i, c in enumerate(self.cam_ids)}
+        frame_pos = {int(f): i for i, f in enumerate(self.frames)}
+        self.keypoints = np.zeros((len(self.frames), len(self.cam_ids), num_joints, 3))
+        self.annotated = np.zeros((len(self.frames), len(self.cam_ids)), dtype=bool)
+        for img_id, (cam_id, frame) in self.cam_frame.items():
+            kp = self.image_keypoints(img_id)
+            if kp is not None:
+                self.keypoints[frame_pos[frame], cam_pos[cam_id]] = kp[:num_joints]
+                self.annotated[frame_pos[frame], cam_pos[cam_id]] = True
+
+    # --- query O(1) ---
+
+    def annotations(self, image_id):
+        return self.anns_by_image.get(image_id, [])
+
+    def image_keypoints(self, image_id):
+        """Keypoints (J, 3) della prima annotazione dell'immagine, o None."""
+        anns = self.anns_by_image.get(image_id)
+        if not anns:
+            return None
+        return np.array(anns[0]['keypoints'], dtype=float).reshape(-1, 3)
+
+    def image_id(self, cam_id, frame):
+        return self.image_by_cam_frame.get((int(cam_id), int(frame)))
+
+    def frame_keypoints(self, frame):
+        """Keypoints (C, J, 3) di tutte le camere (ordine cam_ids) per il frame, o None."""
+        i = np.searchsorted(self.frames, frame)
+        if i >= len(self.frames) or self.frames[i] != frame:
+            return None
+        return self.keypoints[i]
+
+    def frames_by_camera(self):
+        """Dict cam_id -> lista ordinata dei frame annotati."""
+        frames = {}
+        for cam_id, frame in self.cam_frame.values():
+            frames.setdefault(cam_id, set()).add(frame)
+        return {cam: sorted(f) for cam, f in frames.items()}
+
+    def skeleton_links(self):
+        """Collegamenti dello scheletro (1-based) dalla categoria con keypoints."""
+        for cat in self.data.get('categories', []):
+            if cat.get('skeleton'):
+                return cat['skeleton']
+        return []
+
+    # --- caricamento con cache ---
+
+    @classmethod
+    def _parse(cls, path):
+        with span('coco_index.json_parse', bytes=os.path.getsize(path)), open(path, 'r') as f:
+            data = json.load(f)
+        with span('coco_index.build', images=len(data['images']), annotations=len(data['annotations'])):
+            return cls(data)
+
+    @classmethod
+    def load(cls, path, cache_dir=INDEX_CACHE_DIR):
+        """Carica l'indice dalla cache se il file non è cambiato, altrimenti lo ricostruisce."""
+        if cache_dir is None:
+            return cls._parse(path)
+        st = os.stat(path)
+        abs_path = os.path.abspath(path)
+        key = f"{CACHE_VERSION}|{abs_path}|{st.st_mtime_ns}|{st.st_size}"
+        name = os.path.splitext(os.path.basename(path))[0]
+        # nome legato solo al path: una modifica del JSON sovrascrive la cache invece di aggiungerne una
+        cache_path = os.path.join(cache_dir, f"{name}_{hashlib.sha1(abs_path.encode()).hexdigest()[:16]}.pkl")
+        if os.path.isfile(cache_path):
+            try:
+                with span('coco_index.cache_load'), open(cache_path, 'rb') as f:
+                    # prima la chiave (piccola), poi l'indice solo se la chiave coincide
+                    if pickle.load(f) == key:
+                        return pickle.load(f)
+            except Exception:
+                pass  # cache corrotta o di una versione precedente: la ricostruiamo
+
+        index = cls._parse(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        return index
@@ -0,0 +1,158 @@
+"""
+LETTURA E SCRITTURA COCO IN STREAMING
+
+Per file di annotazioni troppo grandi per json.load:
+  - iter_coco(path) legge il file a blocchi e restituisce ('images', img),
+    ('annotations', ann), ... un elemento alla volta, decodificando ogni
+    elemento con json.JSONDecoder.raw_decode sul buffer corrente; le chiavi
+    non-lista (info, categories, ...) vengono restituite intere.
+  - CocoStreamWriter scrive un file COCO un'annotazione alla volta.
+La memoria usata dipende dalla dimensione del blocco e del singolo
+elemento, non dalla lunghezza del file.
+"""
+
+import json
+import os
+
+READ_SIZE = 1 << 20
+_DELIMITERS = ' \t\n\r,]}'
+
+
+class _StreamReader:
+
+    def __init__(self, f, read_size=READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # scarta la parte già consumata per non far crescere il buffer
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Primo carattere non bianco (senza consumarlo), '' a fine file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f"JSON non valido: atteso uno tra {chars!r}, trovato {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodifica il prossimo valore JSON completo, leggendo altri blocchi se serve."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # un numero può essere troncato alla fine del buffer ('3.' di '3.5'):
+            # è completo solo se è seguito da un delimitatore
+            if (isinstance(value, (int, float)) and not isinstance(value, bool) and not self.eof
+                    and (end == len(self.buf) or self.buf[end] not in _DELIMITERS) and self._fill()):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_coco(path, read_size=READ_SIZE):
+    """
+    Genera (chiave, valore) dal file COCO: per le chiavi il cui valore è
+    una lista una coppia per elemento, per le altre una sola coppia.
+    """
+    with open(path, 'r') as f:
+        r = _StreamReader(f, read_size)
+        r.expect('{')
+        if r.peek() == '}':
+            return
+        while True:
+            key = r.value()
+            r.expect(':')
+            if r.peek() == '[':
+                r.expect('[')
+                if r.peek() == ']':
+                    r.expect(']')
+                else:
+                    while True:
+                        yield key, r.value()
+                        if r.expect(',]') == ']':
+                            break
+            else:
+                yield key, r.value()
+            if r.expect(',}') == '}':
+                return
+
+
+def read_header(path, skip=('images', 'annotations')):
+    """Tutte le chiavi del file tranne quelle in skip (info, licenses, categories, ...)."""
+    header = {}
+    for key, value in iter_coco(path):
+        if key in skip:
+            continue
+        if key in header and isinstance(header[key], list):
+            header[key].append(value)
+        elif key in ('licenses', 'categories'):
+            header.setdefault(key, []).append(value)
+        else:
+            header[key] = value
+    return header
+
+
+class CocoStreamWriter:
+    """
+    Scrive un file COCO a elementi: prima le chiavi di testata, poi le
+    liste 'images' e 'annotations' un elemento alla volta.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self._tmp = path + '.tmp'
+        self._f = open(self._tmp, 'w')
+        self._f.write('{')
+        for key, value in header.items():
+            self._f.write(f"{json.dumps(key)}: {json.dumps(value)}, ")
+        self._open_list = None
+        self._count = 0
+
+    def begin(self, key):
+        if self._open_list is not None:
+            self._f.write('], ')
+        self._f.write(f'{json.dumps(key)}: [')
+        self._open_list = key
+        self._count = 0
+
+    def write(self, item):
+        if self._count:
+            self._f.write(',')
+        self._f.write('\n' + json.dumps(item))
+        self._count += 1
+
+    def close(self):
+        if self._open_list is not None:
+            self._f.write(']')
+        else:
+            self._f.write('"images": [], "annotations": []')
+        self._f.write('}\n')
+        self._f.close()
+        os.replace(self._tmp, self.path)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+TRAIETTORIE 3D DENSE DAI SOLI FRAME ANNOTATI
+
+Solo alcuni frame del video sono annotati, quindi lo scheletro triangolato
+ha buchi (frame mancanti e giunti NaN). Questo stage produce uno scheletro
+per ogni frame del video con un filtro di Kalman a velocità costante e lo
+smoother di Rauch-Tung-Striebel, vettorizzati su tutti i giunti e le
+coordinate: il ciclo è solo sul tempo, ogni passo aggiorna insieme le J*3
+traiettorie. Nei frame non annotati il filtro fa solo la predizione.
+
+Per ogni giunto e frame viene salvata l'incertezza (deviazione standard
+della posizione, stesse unità dello scheletro) nell'extra 'uncertainty' e
+la maschera dei frame osservati nell'extra 'observed'.
+
+Il frame COCO n corrisponde al frame video (n - frame_base) * frame_step.
+Con frame_step 1 i frame dello scheletro denso sono numeri COCO; con
+frame_step > 1 i frame video intermedi non hanno un numero COCO intero,
+quindi i frame sono indici video (meta 'frame_units'). In entrambi i casi
+gli extra 'video_frame' (indice video) e 'coco_frame' (frame_base +
+indice / frame_step, intero nei frame annotati) danno le due numerazioni.
+Esempio: python dense_trajectories.py --video mocap_7_videos/out5.mp4
+"""
+
+import argparse
+import numpy as np
+import cv2
+
+from instrumentation import span, traced
+from skeleton_io import SKELETON_PATH, Skeleton, load_skeleton, save_skeleton
+
+OUTPUT_PATH = 'dense_3d_skeleton.npz'
+FPS         = 25.0
+
+# rumore di misura (deviazione standard dei giunti triangolati) e di
+# processo (accelerazione) nelle unità dello scheletro (mm, mm/s^2)
+MEASUREMENT_STD = 20.0
+ACCEL_STD       = 5000.0
+
+
+def kalman_smooth(obs, dt, measurement_std=MEASUREMENT_STD, accel_std=ACCEL_STD, obs_std=None):
+    """
+    Filtro di Kalman + smoother RTS a velocità costante su B serie 1D.
+
+    obs:     (T, B) misure, NaN dove mancano
+    obs_std: (T, B) deviazione standard di ogni misura (default measurement_std)
+    Ritorna (mean (T, B), std (T, B)) della posizione; le serie senza
+    nessuna misura restano NaN.
+    """
+    obs = np.asarray(obs, dtype=np.float64)
+    T, B = obs.shape
+    R = np.full((T, B), measurement_std ** 2) if obs_std is None else np.asarray(obs_std) ** 2
+    Fm = np.array([[1.0, dt], [0.0, 1.0]])
+    Q  = accel_std ** 2 * np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]])
+
+    # stato iniziale: prima misura disponibile, velocità nulla, covarianza ampia
+    seen = np.isfinite(obs)
+    first = np.where(seen.any(axis=0), seen.argmax(axis=0), 0)
+    x = np.zeros((B, 2))
+    x[:, 0] = np.nan_to_num(obs[first, np.arange(B)])
+    P = np.zeros((B, 2, 2))
+    P[:, 0, 0] = 1e3 * measurement_std ** 2
+    P[:, 1, 1] = (1e3 * measurement_std / dt) ** 2
+
+    xs_pred = np.empty((T, B, 2)); Ps_pred = np.empty((T, B, 2, 2))
+    xs_filt = np.empty((T, B, 2)); Ps_filt = np.empty((T, B, 2, 2))
+    for t in range(T):
+        if t > 0:
+            x = x @ Fm.T
+            P = Fm @ P @ Fm.T + Q
+        xs_pred[t], Ps_pred[t] = x, P
+
+        # aggiornamento con H = [1, 0] solo dove c'è la misura
+        m = seen[t]
+        S = P[:, 0, 0] + R[t]
+        K = P[:, :, 0] / S[:, None]                                        # (B, 2)
+        innov = np.where(m, obs[t] - x[:, 0], 0.0)
+        K = K * m[:, None]
+        x = x + K * innov[:, None]
+        P = P - K[:, :, None] * P[:, None, 0, :]
+        xs_filt[t], Ps_filt[t] = x, P
+
+    # smoother RTS all'indietro
+    xs, Ps = xs_filt.copy(), Ps_filt.copy()
+    for t in range(T - 2, -1, -1):
+        G = Ps_filt[t] @ Fm.T @ np.linalg.inv(Ps_pred[t + 1])             # (B, 2, 2)
+        xs[t] = xs_filt[t] + np.einsum('bij,bj->bi', G, xs[t + 1] - xs_pred[t + 1])
+        Ps[t] = Ps_filt[t] + G @ (Ps[t + 1] - Ps_pred[t + 1]) @ np.swapaxes(G, 1, 2)
+
+    mean = xs[..., 0]
+    std = np.sqrt(np.maximum(Ps[..., 0, 0], 0))
+    never = ~seen.any(axis=0)
+    mean[:, never] = np.nan
+    std[:, never] = np.nan
+    return mean, std
+
+
+def densify(sk3d, num_frames=None, frame_base=1, frame_step=1, fps=FPS,
+            measurement_std=MEASUREMENT_STD, accel_std=ACCEL_STD):
+    """
+    Scheletro denso su tutti i frame video da frame_base (o dal primo annotato)
+    fino a num_frames frame video (default: ultimo frame annotato).
+    Ritorna un nuovo Skeleton con extras 'uncertainty' (F, J), 'observed' (F, J),
+    'video_frame' (F,) e 'coco_frame' (F,).
+    """
+    points = np.asarray(sk3d.points, dtype=np.float64)
+    video_idx = (np.asarray(sk3d.frames) - frame_base) * frame_step
+    start = 0 if num_frames else int(video_idx.min())
+    end = num_frames if num_frames else int(video_idx.max()) + 1
+    T, J = end - start, points.shape[1]
+
+    obs = np.full((T, J, 3), np.nan)
+    inside = (video_idx >= start) & (video_idx < end)
+    obs[video_idx[inside] - start] = points[inside]
+
+    obs_std = None
+    if 'inliers' in sk3d.extras:
+        # meno camere inlier -> misura meno affidabile
+        n_views = np.asarray(sk3d.extras['inliers']).sum(axis=-1).astype(np.float64)
+        std = np.full((T, J), measurement_std)
+        std[video_idx[inside] - start] = measurement_std * np.sqrt(2.0 / np.maximum(n_views[inside], 1))
+        obs_std = np.repeat(std[:, :, None], 3, axis=2).reshape(T, J * 3)
+
+    with span('dense.kalman', frames=T):
+        mean, std = kalman_smooth(obs.reshape(T, J * 3), 1.0 / fps, measurement_std, accel_std, obs_std)
+    mean = mean.reshape(T, J, 3)
+    uncertainty = np.sqrt(np.mean(std.reshape(T, J, 3) ** 2, axis=-1))
+    video_frame = np.arange(start, end)
+    coco_frame = frame_base + video_frame / frame_step
+    # numeri COCO solo se sono interi per ogni frame video, altrimenti indici video
+    frames, units = (frame_base + video_frame, 'coco') if frame_step == 1 else (video_frame, 'video')
+    meta = dict(sk3d.meta, dense=True, fps=fps, frame_base=frame_base, frame_step=frame_step,
+                frame_units=units, measurement_std=measurement_std, accel_std=accel_std)
+    return Skeleton(mean, frames, meta=meta, uncertainty=uncertainty,
+                    observed=np.isfinite(obs).all(axis=-1), video_frame=video_frame, coco_frame=coco_frame)
+
+
+@traced('dense_trajectories')
+def main():
+    parser = argparse.ArgumentParser(description='Scheletro 3D denso per ogni frame del video')
+    parser.add_argument('--skeleton', default=SKELETON_PATH, help='Scheletro 3D triangolato')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='Scheletro denso (.npz)')
+    parser.add_argument('--video', default=None, help='Video da cui prendere numero di frame e fps')
+    parser.add_argument('--num_frames', type=int, default=None, help='Numero di frame video da coprire')
+    parser.add_argument('--fps', type=float, default=FPS, help='Frame al secondo del video')
+    parser.add_argument('--frame_base', type=int, default=1, help='Numero COCO del primo frame del video')
+    parser.add_argument('--frame_step', type=int, default=1, help='Passo tra frame COCO consecutivi nel video')
+    parser.add_argument('--measurement_std', type=float, default=MEASUREMENT_STD, help='Rumore dei giunti triangolati')
+    parser.add_argument('--accel_std', type=float, default=ACCEL_STD, help='Rumore di accelerazione del modello')
+    args = parser.parse_args()
+
+    num_frames, fps = args.num_frames, args.fps
+    if args.video:
+        cap = cv2.VideoCapture(args.video)
+        if cap.isOpened():
+            num_frames = num_frames or int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            fps = cap.get(cv2.CAP_PROP_FPS) or fps
+        cap.release()
+
+    sk3d = load_skeleton(args.skeleton)
+    dense = densify(sk3d, num_frames, args.frame_base, args.frame_step, fps,
+                    args.measurement_std, args.accel_std)
+    save_skeleton(args.output, dense)
+
+    unc = dense.extras['uncertainty']
+    obs = dense.extras['observed']
+    print(f"Frame: {len(sk3d)} annotati -> {len(dense)} densi ({fps:g} fps)")
+    print(f"Incertezza media: {np.nanmean(unc[obs]):.2f} nei frame osservati, "
+          f"{np.nanmean(unc[~obs]) if (~obs).any() else 0:.2f} negli altri")
+    print(f"Scheletro denso salvato in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,15 @@
 DISEGNA KEYPOINT E SCHEELTRO DATO UN FRAME IN 2D"""
 
 import cv2
-import json
 import argparse
 import os
 
-# Draw keypoints and skeleton on a frame given COCO annotations
-
-def load_annotations(json_path):
-    with open(json_path, 'r') as f:
-        return json.load(f)
+from coco_index import AnnotationIndex, image_name
+from frame_server import VIDEO_GLOB, FrameServer, camera_videos
+from instrumentation import traced
+from rectified_videos import RECTIFY_PROFILES
 
+# Draw keypoints and skeleton on a frame given COCO annotations
 
 def draw_keypoints_on_image(img, ann, skeleton, kp_radius=4, color=(0,255,0)):
     """
@@ -40,35 +39,45 @@ def draw_keypoints_on_image(img, ann, skeleton, kp_radius=4, color=(0,255,0)):
     return img
 
 
+@traced('draw_keypoint_over_frame_ckeck')
 def main():
     parser = argparse.ArgumentParser(description='Draw keypoints on an image frame')
-    parser.add_argument('--image', required=True, help='Path to the image file')
+    parser.add_argument('--image', default=None,
+                        help='Path to the image file (default: decode the frame from the camera video)')
+    parser.add_argument('--videos', default=VIDEO_GLOB, help='Glob of the outN.mp4 videos used without --image')
+    parser.add_argument('--rectify', choices=sorted(RECTIFY_PROFILES), default=None,
+                        help='Rectify the decoded frame (use with rectified annotations)')
     parser.add_argument('--annotations', required=True, help='Path to COCO-format JSON annotations')
     parser.add_argument('--image_id', type=int, required=True, help='Image ID to overlay')
     parser.add_argument('--output', default=None, help='Path to save the output image')
     args = parser.parse_args()
 
-    data = load_annotations(args.annotations)
+    index = AnnotationIndex.load(args.annotations)
 
     # find image entry
-    img_entry = next((im for im in data['images'] if im['id'] == args.image_id), None)
+    img_entry = index.images.get(args.image_id)
     if img_entry is None:
         print(f"Image ID {args.image_id} not found in annotations")
         return
 
-    # load image
-    img_path = args.image
-    if not os.path.isfile(img_path):
-        print(f"Image file not found: {img_path}")
-        return
-    img = cv2.imread(img_path)
+    # load image: from file, or decoded straight from the video
+    if args.image:
+        if not os.path.isfile(args.image):
+            print(f"Image file not found: {args.image}")
+            return
+        img = cv2.imread(args.image)
+    else:
+        server = FrameServer(camera_videos(args.videos), rectify=args.rectify)
+        img = server.image(image_name(img_entry))
+        if img is None:
+            print(f"No video frame for {image_name(img_entry)}")
+            return
 
     # get skeleton from categories
-    cat = data['categories'][0]
-    skeleton = cat.get('skeleton', [])
+    skeleton = index.skeleton_links()
 
     # find all annotations for this image
-    anns = [ann for ann in data['annotations'] if ann['image_id'] == args.image_id]
+    anns = index.annotations(args.image_id)
     if not anns:
         print(f"No annotations found for image ID {args.image_id}")
         return
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+ESTRAE E RETTIFICA SOLO I FRAME ANNOTATI
+
+Legge dal file COCO quali frame servono per ogni camera (outN_frame_XXXX.png),
+salta direttamente a quei frame nel video, rettifica solo quelli e li salva
+in una cache di frame: PNG con lo stesso nome dell'immagine COCO oppure un
+unico array impacchettato per camera (outN_frames.npy + outN_frames_index.npy).
+
+Si assume che frame_XXXX corrisponda al frame video (XXXX - frame_base) * frame_step;
+di default frame_0001 è il primo frame del video.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+from camera_rig import CameraRig
+from coco_index import AnnotationIndex
+from instrumentation import span, traced
+from rectified_videos import RECTIFY_PROFILES, load_profile_maps
+
+# oltre questa distanza conviene un seek invece di decodificare i frame intermedi
+SEEK_THRESHOLD = 30
+
+
+def annotated_frames(coco_json_path):
+    """Ritorna dict cam_id -> lista ordinata dei numeri di frame annotati."""
+    return AnnotationIndex.load(coco_json_path).frames_by_camera()
+
+
+def read_frames_at(cap, video_indices, seek_threshold=SEEK_THRESHOLD):
+    """
+    Genera (video_index, frame) per gli indici richiesti (ordinati), usando
+    seek per i salti lunghi e grab() per quelli corti.
+    """
+    pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    for target in video_indices:
+        if target < pos or target - pos > seek_threshold:
+            with span('decode.seek'):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            pos = target
+        if pos < target:
+            with span('decode.grab', frames=target - pos):
+                while pos < target:
+                    if not cap.grab():
+                        return
+                    pos += 1
+        with span('decode.read', frames=1):
+            ret, frame = cap.read()
+        if not ret:
+            return
+        pos += 1
+        yield target, frame
+
+
+def extract_camera(video_path, rig, cam_id, frame_numbers, output_dir, fmt='png',
+                   profile='exact', frame_base=1, frame_step=1):
+    """Rettifica i frame annotati di una camera; ritorna il numero di frame scritti."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print("Error opening video file:", video_path)
+        return 0
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    n_video = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    map1, map2, interpolation, roi = load_profile_maps(rig, cam_id, (width, height), profile)
+
+    # numero di frame COCO -> indice nel video
+    video_idx = {(n - frame_base) * frame_step: n for n in frame_numbers}
+    wanted = sorted(i for i in video_idx if 0 <= i < n_video or n_video <= 0)
+    if len(wanted) < len(video_idx):
+        print(f"cam_{cam_id}: {len(video_idx) - len(wanted)} frame fuori dal video, ignorati")
+
+    packed = None
+    if fmt == 'npy':
+        packed = np.lib.format.open_memmap(
+            os.path.join(output_dir, f"out{cam_id}_frames.npy"), mode='w+',
+            dtype=np.uint8, shape=(len(wanted), roi[3], roi[2], 3))
+    written = []
+    for i, frame in read_frames_at(cap, wanted):
+        with span('extract.remap', frames=1):
+            rectified = cv2.remap(frame, map1, map2, interpolation=interpolation)
+        with span('extract.write', frames=1):
+            if packed is not None:
+                packed[len(written)] = rectified
+            else:
+                cv2.imwrite(os.path.join(output_dir, f"out{cam_id}_frame_{video_idx[i]:04d}.png"), rectified)
+        written.append(video_idx[i])
+    cap.release()
+
+    if packed is not None:
+        packed.flush()
+        np.save(os.path.join(output_dir, f"out{cam_id}_frames_index.npy"), np.array(written, dtype=np.int64))
+    print(f"cam_{cam_id}: {len(written)}/{len(wanted)} frame rettificati da {video_path}")
+    return len(written)
+
+
+def load_packed_frames(output_dir, cam_id):
+    """Ritorna (frames memmap (N,h,w,3), dict numero_frame -> posizione)."""
+    frames = np.load(os.path.join(output_dir, f"out{cam_id}_frames.npy"), mmap_mode='r')
+    index = np.load(os.path.join(output_dir, f"out{cam_id}_frames_index.npy"))
+    return frames[:len(index)], {int(n): i for i, n in enumerate(index)}
+
+
+@traced('extract_rectified_frames')
+def main():
+    parser = argparse.ArgumentParser(description='Rettifica solo i frame annotati nel file COCO')
+    parser.add_argument('--annotations', default='_annotations.coco.json', help='File COCO con le immagini annotate')
+    parser.add_argument('--video_dir', default='mocap_7_videos', help='Cartella con i video outN.mp4')
+    parser.add_argument('--output_dir', default='rectified_frames', help='Cartella della cache dei frame')
+    parser.add_argument('--format', choices=['png', 'npy'], default='png', help='PNG singoli o array impacchettato')
+    parser.add_argument('--profile', choices=sorted(RECTIFY_PROFILES), default='exact', help='Profilo di rettifica')
+    parser.add_argument('--frame_base', type=int, default=1, help='Numero COCO del primo frame del video')
+    parser.add_argument('--frame_step', type=int, default=1, help='Passo tra frame COCO consecutivi nel video')
+    parser.add_argument('--jobs', type=int, default=1, help='Camere elaborate in parallelo')
+    args = parser.parse_args()
+
+    rig = CameraRig.load()
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = []
+    for cam_id, numbers in sorted(annotated_frames(args.annotations).items()):
+        video_path = os.path.join(args.video_dir, f"out{cam_id}.mp4")
+        if cam_id not in rig or not os.path.isfile(video_path):
+            print(f"cam_{cam_id}: video o calibrazione mancante, salto")
+            continue
+        jobs.append((video_path, rig, cam_id, numbers, args.output_dir, args.format,
+                     args.profile, args.frame_base, args.frame_step))
+
+    if args.jobs <= 1:
+        for job in jobs:
+            extract_camera(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            for fut in [pool.submit(extract_camera, *job) for job in jobs]:
+                fut.result()
+
+
+if __name__ == '__main__':
+    main()
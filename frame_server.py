@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+FRAME SERVER: ACCESSO CASUALE AI FRAME DEI VIDEO CON CACHE LRU
+
+Per il QA interattivo delle annotazioni senza estrarre prima migliaia di
+PNG 4K su disco.
+
+  - Indice persistente per video (.cache/frame_index/*.json, chiave su path,
+    mtime e dimensione): numero di frame, fps, dimensioni e keyframe letti
+    dalla sync sample table (stss) del file MP4, senza decodificare nulla.
+  - FrameServer.frame(cam_id, index) decodifica un frame qualsiasi: se il
+    decoder è già posizionato tra il keyframe precedente e il frame
+    richiesto si prosegue con grab(), altrimenti si fa un seek (che riparte
+    comunque dal keyframe). Un VideoCapture aperto per camera.
+  - Cache LRU dei frame decodificati limitata in byte (max_bytes).
+  - Rettifica opzionale al volo con le mappe in cache (load_profile_maps),
+    per confrontare i frame con le annotazioni rettificate.
+Funziona sia sui video originali (mocap_7_videos/outN.mp4) sia su quelli
+rettificati da rectified_videos.py (in quel caso senza --rectify).
+
+Esempio: python frame_server.py --cam 5 --frame 12 --rectify exact --output f.png
+"""
+
+import argparse
+import bisect
+import collections
+import glob
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import cv2
+
+from camera_rig import CACHE_DIR, CameraRig
+from coco_index import parse_image_name
+from instrumentation import span, traced
+from rectified_videos import RECTIFY_PROFILES, load_profile_maps
+
+INDEX_DIR   = os.path.join(CACHE_DIR, 'frame_index')
+VIDEO_GLOB  = 'mocap_7_videos/out*.mp4'
+MAX_BYTES   = 1 << 30         # cache dei frame decodificati (1 GB ~ 40 frame 4K)
+
+# contenitori MP4 da attraversare per arrivare alle tabelle dei sample
+_CONTAINERS = {'moov', 'trak', 'mdia', 'minf', 'stbl'}
+
+
+def _boxes(f, start, end):
+    """Genera (tipo, inizio payload, fine) dei box MP4 in [start, end)."""
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield kind.decode('latin1'), pos + header, pos + size
+        pos += size
+
+
+def _video_tables(f, start, end, tables):
+    """Raccoglie hdlr/mdhd/stsz/stss della traccia video (la prima con handler 'vide')."""
+    for kind, a, b in _boxes(f, start, end):
+        if kind == 'trak':
+            found = {}
+            _video_tables(f, a, b, found)
+            if found.get('hdlr') == 'vide' and 'hdlr' not in tables:
+                tables.update(found)
+        elif kind in _CONTAINERS:
+            _video_tables(f, a, b, tables)
+        elif kind == 'hdlr':
+            f.seek(a + 8)
+            tables['hdlr'] = f.read(4).decode('latin1')
+        elif kind == 'mdhd':
+            f.seek(a)
+            version = f.read(1)[0]
+            f.seek(a + (20 if version == 1 else 12))
+            fmt = '>IQ' if version == 1 else '>II'
+            tables['timescale'], tables['duration'] = struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+        elif kind == 'stsz':
+            f.seek(a + 8)
+            tables['samples'] = struct.unpack('>I', f.read(4))[0]
+        elif kind == 'stss':
+            f.seek(a + 4)
+            n = struct.unpack('>I', f.read(4))[0]
+            # numeri di sample 1-based -> indici di frame
+            tables['keyframes'] = [k - 1 for k in struct.unpack(f'>{n}I', f.read(4 * n))]
+
+
+def mp4_keyframes(path):
+    """
+    Ritorna (numero di frame, fps, keyframe) dalla traccia video del file
+    MP4 (senza stss tutti i frame sono keyframe); (None, None, None) se il
+    contenitore non è leggibile.
+    """
+    tables = {}
+    try:
+        with open(path, 'rb') as f:
+            _video_tables(f, 0, os.path.getsize(path), tables)
+    except (OSError, struct.error):
+        return None, None, None
+    if 'samples' not in tables:
+        return None, None, None
+    fps = None
+    if tables.get('duration'):
+        fps = tables['samples'] * tables['timescale'] / tables['duration']
+    keyframes = tables.get('keyframes')
+    if keyframes is None:
+        keyframes = list(range(tables['samples']))
+    return tables['samples'], fps, keyframes
+
+
+def build_index(path):
+    """Indice del video: frame, fps, dimensioni e keyframe (dall'MP4, con fallback su OpenCV)."""
+    frames, fps, keyframes = mp4_keyframes(path)
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Impossibile aprire il video: {path}")
+    width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if frames is None:
+        frames, fps = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return {'path': os.path.abspath(path), 'frames': frames, 'fps': fps, 'size': [width, height],
+            'keyframes': keyframes if keyframes is not None else [0]}
+
+
+def load_index(path, index_dir=INDEX_DIR):
+    """Indice persistente del video, ricostruito solo se il file è cambiato."""
+    st = os.stat(path)
+    abs_path = os.path.abspath(path)
+    key = f"{abs_path}|{st.st_mtime_ns}|{st.st_size}"
+    name = os.path.splitext(os.path.basename(path))[0]
+    # nome legato solo al path (mtime e dimensione stanno nel file): un video
+    # ricodificato sovrascrive il suo indice invece di lasciarne uno orfano
+    cache_path = os.path.join(index_dir, f"{name}_{hashlib.sha1(abs_path.encode()).hexdigest()[:16]}.json")
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                index = json.load(f)
+            if index.get('key') == key:
+                return index
+        except (OSError, ValueError, AttributeError):
+            pass  # indice corrotto: lo ricostruiamo
+    index = build_index(path)
+    index['key'] = key
+    os.makedirs(index_dir, exist_ok=True)
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, cache_path)
+    return index
+
+
+def camera_videos(pattern=VIDEO_GLOB):
+    """dict cam_id -> path dei video outN.mp4 che corrispondono al glob."""
+    videos = {}
+    for path in sorted(glob.glob(pattern)):
+        m = re.search(r'out(\d+)\.mp4$', os.path.basename(path))
+        if m:
+            videos[int(m.group(1))] = path
+    return videos
+
+
+class FrameServer:
+    """
+    Frame decodificati per (cam_id, indice video), con cache LRU limitata
+    in byte. rectify: profilo di RECTIFY_PROFILES o None per i frame così
+    come sono nel video. Thread-safe (un lock per tutte le camere).
+    """
+
+    def __init__(self, videos=None, rig=None, rectify=None, max_bytes=MAX_BYTES,
+                 frame_base=1, frame_step=1):
+        if rectify is not None and rectify not in RECTIFY_PROFILES:
+            raise ValueError(f"Unknown rectification profile: {rectify}")
+        self.videos     = camera_videos() if videos is None else dict(videos)
+        self.rig        = rig if rig is not None or rectify is None else CameraRig.load()
+        self.rectify    = rectify
+        self.max_bytes  = max_bytes
+        self.frame_base = frame_base
+        self.frame_step = frame_step
+        self.index      = {cam_id: load_index(path) for cam_id, path in self.videos.items()}
+        self.stats      = {'hits': 0, 'misses': 0, 'seeks': 0, 'grabbed': 0}
+        self._caps      = {}        # cam_id -> (VideoCapture, prossimo frame decodificato)
+        self._maps      = {}        # cam_id -> (map1, map2, interpolation)
+        self._cache     = collections.OrderedDict()
+        self._bytes     = 0
+        self._lock      = threading.Lock()
+
+    def __contains__(self, cam_id):
+        return cam_id in self.videos
+
+    def num_frames(self, cam_id):
+        return self.index[cam_id]['frames']
+
+    def keyframe_before(self, cam_id, index):
+        keys = self.index[cam_id]['keyframes']
+        return keys[max(bisect.bisect_right(keys, index) - 1, 0)]
+
+    def video_index(self, frame_number):
+        """Numero di frame COCO (outN_frame_XXXX) -> indice nel video."""
+        return (frame_number - self.frame_base) * self.frame_step
+
+    def _decode(self, cam_id, index):
+        cap, pos = self._caps.get(cam_id, (None, 0))
+        if cap is None:
+            cap = cv2.VideoCapture(self.videos[cam_id])
+        with span('frame_server.decode', frames=1) as s:
+            # grab() in avanti solo se costa meno di ripartire dal keyframe
+            if not (pos <= index and self.keyframe_before(cam_id, index) <= pos):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+                self.stats['seeks'] += 1
+                s.add(seeks=1)
+                pos = index
+            while pos < index:
+                if not cap.grab():
+                    break
+                pos += 1
+                self.stats['grabbed'] += 1
+                s.add(grabbed=1)
+            ret, frame = cap.read()
+        if not ret:
+            # la capture è rimasta a fine video: la si chiude, la prossima richiesta ne apre una nuova
+            self._caps.pop(cam_id, None)
+            cap.release()
+            return None
+        self._caps[cam_id] = (cap, pos + 1)
+        if self.rectify is not None:
+            if cam_id not in self._maps:
+                map1, map2, interp, _ = load_profile_maps(self.rig, cam_id, frame.shape[1::-1], self.rectify)
+                self._maps[cam_id] = (map1, map2, interp)
+            map1, map2, interp = self._maps[cam_id]
+            with span('frame_server.remap', frames=1):
+                frame = cv2.remap(frame, map1, map2, interpolation=interp)
+        return frame
+
+    def frame(self, cam_id, index):
+        """Frame BGR (non copiato: non modificarlo) o None se fuori dal video."""
+        if cam_id not in self.videos:
+            raise KeyError(f"Nessun video per la camera {cam_id}")
+        if not 0 <= index < self.num_frames(cam_id):
+            return None
+        key = (cam_id, index)
+        with self._lock:
+            frame = self._cache.get(key)
+            if frame is not None:
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return frame
+            self.stats['misses'] += 1
+            frame = self._decode(cam_id, index)
+            if frame is None or frame.nbytes > self.max_bytes:
+                return frame
+            self._cache[key] = frame
+            self._bytes += frame.nbytes
+            while self._bytes > self.max_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._bytes -= old.nbytes
+            return frame
+
+    def image(self, name):
+        """Frame per il nome di un'immagine COCO (outN_frame_XXXX.png), copiato."""
+        cam_id, frame_number = parse_image_name(name)
+        if cam_id is None or cam_id not in self.videos:
+            return None
+        frame = self.frame(cam_id, self.video_index(frame_number))
+        return None if frame is None else frame.copy()
+
+    def close(self):
+        with self._lock:
+            for cap, _ in self._caps.values():
+                cap.release()
+            self._caps.clear()
+            self._cache.clear()
+            self._bytes = 0
+
+
+@traced('frame_server')
+def main():
+    parser = argparse.ArgumentParser(description='Accesso casuale ai frame dei video')
+    parser.add_argument('--videos', default=VIDEO_GLOB, help='Glob dei video outN.mp4')
+    parser.add_argument('--cam', type=int, help='Camera')
+    parser.add_argument('--frame', type=int, nargs='*', default=[], help='Indici di frame nel video')
+    parser.add_argument('--rectify', choices=sorted(RECTIFY_PROFILES), default=None,
+                        help='Rettifica al volo con questo profilo')
+    parser.add_argument('--output', default=None, help="Salva l'(ultimo) frame richiesto")
+    args = parser.parse_args()
+
+    server = FrameServer(camera_videos(args.videos), rectify=args.rectify)
+    for cam_id, idx in sorted(server.index.items()):
+        print(f"cam_{cam_id}: {idx['frames']} frame, {idx['fps']:.2f} fps, {idx['size'][0]}x{idx['size'][1]}, "
+              f"{len(idx['keyframes'])} keyframe")
+    if args.cam is None:
+        return
+    frame = None
+    for index in args.frame:
+        frame = server.frame(args.cam, index)
+        if frame is None:
+            print(f"cam_{args.cam}: frame {index} non disponibile")
+    print(server.stats)
+    if args.output and frame is not None:
+        cv2.imwrite(args.output, frame)
+        print(f"Frame salvato in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
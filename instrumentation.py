@@ -0,0 +1,279 @@
+"""
+STRUMENTAZIONE DELLE FASI: TEMPI, CPU, MEMORIA E CONTEGGI
+
+Livello comune a tutti gli script per vedere dove va il tempo (decode,
+remap, encode, parsing JSON, SVD, ...) nelle esecuzioni reali.
+
+    from instrumentation import span, traced
+
+    with span('triangulate.svd', points=n) as s:
+        ...
+        s.add(frames=len(obs))          # conteggi aggiunti durante la fase
+
+    @traced('rectified_annotations')
+    def main(): ...
+
+Disattivata di default: span() restituisce sempre lo stesso contesto vuoto e
+traced() chiama direttamente la funzione, quindi il costo è il controllo di
+una variabile globale. Si attiva con la variabile d'ambiente
+PIPELINE_TRACE=trace.json (vale per qualunque script) oppure con enable().
+
+Per ogni span si registrano tempo wall, tempo CPU del thread (cpu_ms), tempo
+CPU del processo più quello dei figli terminati durante lo span (proc_cpu_ms:
+conta i worker dei ProcessPoolExecutor chiusi dentro lo span), picco di RSS
+del processo (peak_rss_mb) e dei figli (children_rss_mb) alla chiusura e i
+conteggi. All'uscita vengono scritti
+  trace.json          formato Chrome trace (chrome://tracing, Perfetto)
+  trace.summary.json  totali per nome di fase (chiamate, wall, CPU, RSS, conteggi)
+e un riepilogo su stderr. Gli span dei processi figli (ProcessPoolExecutor)
+vengono scritti subito in file trace.json.<pid>.part e uniti dal processo
+principale all'esportazione. Un errore di scrittura del trace produce solo
+un avviso su stderr: non interrompe mai lo script misurato.
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:           # Windows: niente picco di RSS
+    resource = None
+
+TRACE_ENV   = 'PIPELINE_TRACE'
+_MAIN_ENV   = 'PIPELINE_TRACE_MAIN_PID'
+MAX_EVENTS  = 200000          # eventi tenuti per il trace; i totali restano esatti
+
+_enabled    = False
+_path       = None
+_events     = []
+_totals     = {}
+_dropped    = 0
+_part       = None            # file degli eventi nei processi figli
+_failed     = False           # scrittura del trace fallita: niente più eventi su file
+_lock       = threading.Lock()
+_RESOURCE_ARGS = ('cpu_ms', 'proc_cpu_ms', 'peak_rss_mb', 'children_rss_mb')
+
+
+def _rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _children_cpu_ns():
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return int((usage.ru_utime + usage.ru_stime) * 1e9)
+
+
+def _warn(what, error):
+    print(f"[trace] errore in {what}: {error} (trace ignorato, lo script prosegue)", file=sys.stderr)
+
+
+def _is_child():
+    return os.environ.get(_MAIN_ENV) not in (None, str(os.getpid()))
+
+
+def _accumulate(event):
+    global _dropped
+    args = event['args']
+    tot = _totals.setdefault(event['name'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'proc_cpu_s': 0.0,
+                                             'peak_rss_mb': 0.0, 'children_rss_mb': 0.0, 'counts': {}})
+    tot['calls'] += 1
+    tot['wall_s'] += event['dur'] / 1e6
+    tot['cpu_s'] += args['cpu_ms'] / 1e3
+    tot['proc_cpu_s'] += args.get('proc_cpu_ms', args['cpu_ms']) / 1e3
+    tot['peak_rss_mb'] = max(tot['peak_rss_mb'], args.get('peak_rss_mb') or 0.0)
+    tot['children_rss_mb'] = max(tot['children_rss_mb'], args.get('children_rss_mb') or 0.0)
+    for key, value in args.items():
+        if key not in _RESOURCE_ARGS:
+            tot['counts'][key] = tot['counts'].get(key, 0) + value
+    if len(_events) < MAX_EVENTS:
+        _events.append(event)
+    else:
+        _dropped += 1
+
+
+def _record(event):
+    global _part, _failed
+    with _lock:
+        if not _is_child():
+            _accumulate(event)
+            return
+        if _failed:
+            return
+        # i worker dei pool escono con os._exit: niente buffer, una riga per evento
+        try:
+            if _part is None:
+                _part = open(f"{_path}.{os.getpid()}.part", 'a', buffering=1)
+            _part.write(json.dumps(event) + '\n')
+        except OSError as e:
+            _failed = True
+            _warn(f"scrittura di {_path}.{os.getpid()}.part", e)
+
+
+class _Span:
+    __slots__ = ('name', 'counts', '_t0', '_c0', '_p0')
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        self._t0 = time.perf_counter_ns()
+        self._c0 = time.thread_time_ns()
+        self._p0 = time.process_time_ns() + _children_cpu_ns()
+        return self
+
+    def __exit__(self, *exc):
+        t1, c1 = time.perf_counter_ns(), time.thread_time_ns()
+        p1 = time.process_time_ns() + _children_cpu_ns()
+        args = {'cpu_ms': (c1 - self._c0) / 1e6, 'proc_cpu_ms': (p1 - self._p0) / 1e6}
+        if resource is not None:
+            args['peak_rss_mb'] = _rss_mb(resource.RUSAGE_SELF)
+            args['children_rss_mb'] = _rss_mb(resource.RUSAGE_CHILDREN)
+        args.update(self.counts)
+        _record({'name': self.name, 'ph': 'X', 'ts': self._t0 / 1e3, 'dur': (t1 - self._t0) / 1e3,
+                 'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': args})
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **counts):
+    """Contesto che misura una fase; con la strumentazione spenta non fa nulla."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, counts)
+
+
+def traced(name=None):
+    """Decoratore: misura ogni chiamata della funzione come span `name`."""
+    def decorate(fn):
+        label = name or fn.__qualname__
+
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(label, {}):
+                return fn(*args, **kwargs)
+        wrapper.__name__, wrapper.__doc__, wrapper.__wrapped__ = fn.__name__, fn.__doc__, fn
+        return wrapper
+    return decorate
+
+
+def enabled():
+    return _enabled
+
+
+def enable(path='trace.json'):
+    """
+    Attiva la strumentazione; il processo principale esporta in path all'uscita.
+    Se la cartella del trace non si può creare resta disattivata (con un avviso).
+    """
+    global _enabled, _path
+    path = os.path.abspath(path)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    except OSError as e:
+        _warn(f"cartella del trace {os.path.dirname(path)}", e)
+        return
+    _enabled, _path = True, path
+    os.environ[TRACE_ENV] = _path
+    if _MAIN_ENV not in os.environ:
+        os.environ[_MAIN_ENV] = str(os.getpid())
+    if not _is_child():
+        atexit.register(export)
+
+
+def summary():
+    """Totali per nome di fase, ordinati per tempo wall decrescente."""
+    with _lock:
+        return dict(sorted(_totals.items(), key=lambda kv: -kv[1]['wall_s']))
+
+
+def _merge_children():
+    directory, base = os.path.split(_path)
+    for name in sorted(os.listdir(directory or '.')):
+        if not (name.startswith(base + '.') and name.endswith('.part')):
+            continue
+        part = os.path.join(directory, name)
+        try:
+            with open(part, 'r') as f:
+                for line in f:
+                    # l'ultima riga può essere troncata se il worker è stato ucciso
+                    try:
+                        _accumulate(json.loads(line))
+                    except ValueError:
+                        continue
+            os.remove(part)
+        except OSError as e:
+            _warn(f"lettura di {part}", e)
+
+
+def export(path=None, quiet=False):
+    """
+    Scrive il Chrome trace e il riepilogo JSON (path di default quello di
+    enable). Gli errori di scrittura diventano un avviso su stderr.
+    """
+    path = path or _path
+    if not _enabled or path is None or _is_child():
+        return
+    try:
+        _export(path, quiet)
+    except (OSError, ValueError) as e:
+        _warn(f"esportazione in {path}", e)
+
+
+def _export(path, quiet):
+    with _lock:
+        try:
+            _merge_children()
+        except OSError as e:
+            _warn(f"ricerca dei file .part in {os.path.dirname(path)}", e)
+        events = sorted(_events, key=lambda e: e['ts'])
+        t0 = events[0]['ts'] if events else 0.0
+        trace = [dict(e, ts=e['ts'] - t0) for e in events]
+        meta = {'argv': sys.argv, 'dropped_events': _dropped}
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': meta}, f)
+    os.replace(tmp, path)
+    totals = summary()
+    with open(os.path.splitext(path)[0] + '.summary.json', 'w') as f:
+        json.dump(dict(meta, stages=totals), f, indent=2)
+    if quiet:
+        return
+    print(f"[trace] {len(trace)} eventi in {path} (cpu thr = thread, cpu proc = processo + figli, "
+          "rss = processo / figli)", file=sys.stderr)
+    for name, tot in totals.items():
+        counts = ' '.join(f"{k}={v:g}" for k, v in tot['counts'].items())
+        print(f"[trace] {name:32s} x{tot['calls']:<6d} wall {tot['wall_s']:9.3f} s  "
+              f"cpu thr {tot['cpu_s']:9.3f} s  cpu proc {tot['proc_cpu_s']:9.3f} s  "
+              f"rss {tot['peak_rss_mb']:7.1f} / {tot['children_rss_mb']:7.1f} MB  {counts}", file=sys.stderr)
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
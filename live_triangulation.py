@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+TRIANGOLAZIONE LIVE DA FLUSSI DI KEYPOINTS 2D PER CAMERA
+
+Libreria + server locale per anteprime in tempo reale con lo stesso rig e
+la stessa DLT degli script offline.
+
+LiveTriangulator riceve keypoints 2D con timestamp da ogni camera
+(push), li raggruppa per frame in un jitter buffer (timestamp arrotondato
+al periodo di frame) e triangola un frame appena:
+  - arrivano tutte le camere, oppure
+  - ci sono almeno min_views camere ed è scaduto il limite di latenza
+    (max_latency secondi dal primo arrivo del frame, controllato da poll()).
+I frame vengono emessi in ordine; le viste che arrivano dopo l'emissione
+del loro frame sono scartate e contate come in ritardo. Per ogni frame
+emesso si registra la latenza (emissione - primo arrivo); LatencyMetrics
+tiene le ultime N latenze e i contatori.
+
+Server (JSON lines su TCP, solo per test locali):
+  client camera  -> {"cam": 5, "t": 1.24, "keypoints": [x, y, v, ...]}
+  client monitor -> {"subscribe": true}   riceve {"frame", "t", "points", "views", "latency"}
+  chiunque       -> {"metrics": true}     riceve le metriche correnti
+  chiunque       -> {"reset": true}       nuovo flusso: svuota il buffer e azzera le metriche
+
+Esempi:
+  python live_triangulation.py serve --port 8765
+  python live_triangulation.py replay --port 8765 --fps 25 --jitter 0.01
+  python live_triangulation.py bench          # replay in-process, senza socket
+"""
+
+import argparse
+import collections
+import json
+import queue
+import random
+import socket
+import socketserver
+import sys
+import threading
+import time
+import numpy as np
+import cv2
+
+from camera_rig import CameraRig
+from coco_index import AnnotationIndex
+from instrumentation import span, traced
+from triangulation import triangulate_batch
+
+FPS          = 25.0
+MAX_LATENCY  = 0.080          # secondi
+HOST, PORT   = '127.0.0.1', 8765
+RAW_ANN_PATH = '_annotations.coco.json'
+
+
+class LatencyMetrics:
+    """Contatori e latenze (secondi) degli ultimi `window` frame emessi."""
+
+    def __init__(self, window=1000):
+        self.latencies = collections.deque(maxlen=window)
+        self.emitted   = 0
+        self.partial   = 0        # emessi senza tutte le camere (limite di latenza)
+        self.late      = 0        # viste arrivate dopo l'emissione del loro frame
+        self.skipped   = 0        # frame scaduti con meno di min_views camere
+        self.received  = 0
+
+    def record(self, latency, complete):
+        self.latencies.append(latency)
+        self.emitted += 1
+        self.partial += not complete
+
+    def summary(self):
+        lat = np.array(self.latencies) * 1000.0
+        out = {'received': self.received, 'emitted': self.emitted, 'partial': self.partial,
+               'late': self.late, 'skipped': self.skipped}
+        if lat.size:
+            out.update({'latency_ms_mean': float(lat.mean()), 'latency_ms_p50': float(np.percentile(lat, 50)),
+                        'latency_ms_p95': float(np.percentile(lat, 95)), 'latency_ms_max': float(lat.max())})
+        return out
+
+
+class LiveTriangulator:
+    """
+    Jitter buffer + triangolazione per frame. Thread-safe: push/poll possono
+    essere chiamati da thread diversi. Ogni frame emesso è un dict
+    {'frame', 't', 'points' (J, 3), 'views', 'latency'} passato a on_frame
+    (se dato, in ordine e fuori dal lock del buffer, così un callback lento
+    non blocca le push delle camere) e restituito da push/poll.
+    """
+
+    def __init__(self, rig, num_joints, min_views=2, max_latency=MAX_LATENCY, fps=FPS,
+                 t0=0.0, undistort=True, min_visibility=2, on_frame=None, clock=time.monotonic):
+        self.rig            = rig
+        self.num_joints     = num_joints
+        self.min_views      = min_views
+        self.max_latency    = max_latency
+        self.period         = 1.0 / fps
+        self.t0             = t0
+        self.undistort      = undistort
+        self.min_visibility = min_visibility
+        self.on_frame       = on_frame
+        self.clock          = clock
+        self.metrics        = LatencyMetrics()
+        self._pending       = {}      # frame -> {'first': arrivo, 'obs': (C, J, 3), 'views': set}
+        self._next          = None    # primo frame non ancora emesso
+        self._lock          = threading.Lock()
+        self._outbox        = collections.deque()   # frame emessi non ancora passati a on_frame
+        self._emit_lock     = threading.Lock()
+
+    def frame_of(self, t):
+        return int(round((t - self.t0) / self.period))
+
+    def _undistort(self, cam_id, kp):
+        if not self.undistort:
+            return kp
+        K, dist, _, _ = self.rig.camera(cam_id)
+        out = kp.copy()
+        out[:, :2] = cv2.undistortPoints(kp[:, :2].reshape(-1, 1, 2), K, dist, P=K).reshape(-1, 2)
+        return out
+
+    def push(self, cam_id, t, keypoints, arrival=None):
+        """Aggiunge i keypoints (J*3 o (J, 3)) della camera al tempo t; ritorna i frame emessi."""
+        now = self.clock() if arrival is None else arrival
+        frame = self.frame_of(t)
+        kp = self._undistort(cam_id, np.asarray(keypoints, dtype=np.float64).reshape(-1, 3)[:self.num_joints])
+        with self._lock:
+            self.metrics.received += 1
+            if self._next is not None and frame < self._next:
+                self.metrics.late += 1
+                return []
+            slot = self._pending.get(frame)
+            if slot is None:
+                slot = self._pending[frame] = {'first': now, 'views': set(),
+                                               'obs': np.zeros((len(self.rig.cam_ids), self.num_joints, 3))}
+            slot['obs'][self.rig.index(cam_id)] = kp
+            slot['views'].add(cam_id)
+            emitted = self._drain(now)
+        self._emit()
+        return emitted
+
+    def reset(self):
+        """Nuovo flusso (es. un replay che riparte da t=0): svuota il buffer e azzera le metriche."""
+        with self._lock:
+            self._pending.clear()
+            self._next = None
+            self.metrics = LatencyMetrics()
+
+    def poll(self, now=None):
+        """Emette i frame il cui limite di latenza è scaduto; da chiamare periodicamente."""
+        with self._lock:
+            emitted = self._drain(self.clock() if now is None else now)
+        self._emit()
+        return emitted
+
+    def _emit(self):
+        # l'outbox è riempita in ordine sotto _lock; _emit_lock serializza le chiamate
+        # a on_frame tra thread, e se un altro thread sta già emettendo ci pensa lui
+        # (il controllo dopo il rilascio raccoglie ciò che è arrivato nel frattempo)
+        while self.on_frame is not None and self._outbox:
+            if not self._emit_lock.acquire(blocking=False):
+                return
+            try:
+                while self._outbox:
+                    self.on_frame(self._outbox.popleft())
+            finally:
+                self._emit_lock.release()
+
+    def _drain(self, now):
+        """Emette in ordine i frame pronti (completi o scaduti)."""
+        emitted = []
+        all_views = len(self.rig.cam_ids)
+        while self._pending:
+            frame = min(self._pending)
+            slot = self._pending[frame]
+            complete = len(slot['views']) == all_views
+            expired = now - slot['first'] >= self.max_latency
+            # un frame successivo già completo non aspetta quelli precedenti oltre il limite
+            if not complete and not expired:
+                break
+            del self._pending[frame]
+            self._next = frame + 1
+            if len(slot['views']) < self.min_views:
+                self.metrics.skipped += 1
+                continue
+            with span('live.triangulate', frames=1, views=len(slot['views'])):
+                points = triangulate_batch(slot['obs'][None], self.rig.P, self.min_visibility)[0]
+            result = {'frame': frame, 't': self.t0 + frame * self.period, 'points': points,
+                      'views': sorted(slot['views']), 'latency': now - slot['first']}
+            self.metrics.record(result['latency'], complete)
+            emitted.append(result)
+        if self.on_frame is not None:
+            self._outbox.extend(emitted)
+        return emitted
+
+
+# --- server JSON lines su TCP ---
+
+def _encode(result):
+    return (json.dumps({'frame': result['frame'], 't': result['t'], 'views': result['views'],
+                        'latency': result['latency'],
+                        'points': [None if np.isnan(p).any() else p.tolist() for p in result['points']]})
+            + '\n').encode()
+
+
+class LiveServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, triangulator, tick=0.005):
+        super().__init__(address, _LiveHandler)
+        self.triangulator = triangulator
+        self.subscribers = set()
+        self.sub_lock = threading.Lock()
+        # i risultati vanno ai subscriber da un thread dedicato: un monitor lento
+        # rallenta solo sé stesso, non le push delle camere
+        self._outgoing = queue.Queue()
+        triangulator.on_frame = self._outgoing.put
+        self._sender = threading.Thread(target=self._send_loop, daemon=True)
+        self._sender.start()
+        self._ticker = threading.Thread(target=self._tick, args=(tick,), daemon=True)
+        self._ticker.start()
+
+    def _tick(self, tick):
+        while True:
+            time.sleep(tick)
+            self.triangulator.poll()
+
+    def _send_loop(self):
+        while True:
+            self.broadcast(self._outgoing.get())
+
+    def broadcast(self, result):
+        data = _encode(result)
+        with self.sub_lock:
+            for conn in list(self.subscribers):
+                try:
+                    conn.sendall(data)
+                except OSError:
+                    self.subscribers.discard(conn)
+
+
+class _LiveHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    msg = json.loads(line)
+                    if msg.get('subscribe'):
+                        with server.sub_lock:
+                            server.subscribers.add(self.connection)
+                    elif msg.get('reset'):
+                        server.triangulator.reset()
+                    elif msg.get('metrics'):
+                        self.wfile.write((json.dumps(server.triangulator.metrics.summary()) + '\n').encode())
+                    else:
+                        server.triangulator.push(int(msg['cam']), float(msg['t']), msg['keypoints'])
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # un pacchetto malformato non deve far cadere il flusso della camera
+                    print(f"Messaggio scartato da {self.client_address}: {type(e).__name__}: {e}",
+                          file=sys.stderr)
+                    continue
+        finally:
+            with server.sub_lock:
+                server.subscribers.discard(self.connection)
+
+
+def serve(rig, num_joints, host=HOST, port=PORT, **kwargs):
+    server = LiveServer((host, port), LiveTriangulator(rig, num_joints, **kwargs))
+    print(f"Server di triangolazione live su {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# --- replay di un file COCO come flussi per camera ---
+
+def replay_messages(index, fps=FPS, jitter=0.0, drop=0.0, seed=0):
+    """Messaggi (tempo di invio relativo, cam, t, keypoints) ordinati per invio."""
+    rng = random.Random(seed)
+    msgs = []
+    for (cam_id, frame), img_id in index.image_by_cam_frame.items():
+        kp = index.image_keypoints(img_id)
+        if kp is None or rng.random() < drop:
+            continue
+        t = (frame - index.frames[0]) / fps
+        msgs.append((t + abs(rng.gauss(0, jitter)), cam_id, t, kp.ravel().tolist()))
+    return sorted(msgs)
+
+
+def bench(rig, index, fps=FPS, jitter=0.01, drop=0.0, **kwargs):
+    """Replay in-process con clock simulato: latenze deterministiche, nessun socket."""
+    msgs = replay_messages(index, fps, jitter, drop)
+    lt = LiveTriangulator(rig, index.keypoints.shape[2], fps=fps, **kwargs)
+    out = []
+    for send, cam_id, t, kp in msgs:
+        out += lt.poll(send)
+        out += lt.push(cam_id, t, kp, arrival=send)
+    if msgs:
+        # dopo l'ultimo messaggio scadono tutti i frame ancora in attesa
+        out += lt.poll(msgs[-1][0] + lt.max_latency)
+    return out, lt.metrics
+
+
+def replay(index, host=HOST, port=PORT, fps=FPS, jitter=0.0, drop=0.0, speed=1.0):
+    """Invia il file COCO al server come se fosse live e stampa cosa riceve un monitor."""
+    msgs = replay_messages(index, fps, jitter, drop)
+    monitor = socket.create_connection((host, port))
+    monitor.sendall(b'{"subscribe": true}\n')
+    received = []
+
+    def listen():
+        for line in monitor.makefile('r'):
+            received.append(json.loads(line))
+    threading.Thread(target=listen, daemon=True).start()
+
+    feed = socket.create_connection((host, port))
+    # il replay riparte da t=0: senza reset il server conterebbe tutto come 'late'
+    feed.sendall(b'{"reset": true}\n')
+    start = time.monotonic()
+    for send, cam_id, t, kp in msgs:
+        delay = start + send / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        feed.sendall((json.dumps({'cam': cam_id, 't': t, 'keypoints': kp}) + '\n').encode())
+    time.sleep(0.5)
+    feed.sendall(b'{"metrics": true}\n')
+    metrics = json.loads(feed.makefile('r').readline())
+    feed.close()
+    monitor.close()
+    return received, metrics
+
+
+@traced('live_triangulation')
+def main():
+    parser = argparse.ArgumentParser(description='Triangolazione live da flussi di keypoints 2D')
+    parser.add_argument('command', choices=['serve', 'replay', 'bench'])
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--annotations', default=RAW_ANN_PATH, help='COCO (non rettificato) da riprodurre')
+    parser.add_argument('--fps', type=float, default=FPS)
+    parser.add_argument('--max_latency', type=float, default=MAX_LATENCY, help='Limite di latenza in secondi')
+    parser.add_argument('--min_views', type=int, default=2, help='Camere minime per triangolare')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Jitter di arrivo simulato (s)')
+    parser.add_argument('--drop', type=float, default=0.0, help='Frazione di messaggi persi simulata')
+    parser.add_argument('--speed', type=float, default=1.0, help='Velocità del replay')
+    args = parser.parse_args()
+
+    rig = CameraRig.load()
+    if args.command == 'serve':
+        index = AnnotationIndex.load(args.annotations)
+        serve(rig, index.keypoints.shape[2], args.host, args.port, min_views=args.min_views,
+              max_latency=args.max_latency, fps=args.fps)
+        return
+
+    index = AnnotationIndex.load(args.annotations)
+    if args.command == 'bench':
+        frames, metrics = bench(rig, index, args.fps, args.jitter, args.drop,
+                                min_views=args.min_views, max_latency=args.max_latency)
+        metrics = metrics.summary()
+    else:
+        frames, metrics = replay(index, args.host, args.port, args.fps, args.jitter, args.drop, args.speed)
+    print(f"Frame 3D ricevuti: {len(frames)}")
+    print(json.dumps(metrics, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+OVERLAY DEI KEYPOINTS SU TUTTI I FRAME ANNOTATI, UN PASSAGGIO PER VIDEO
+
+Per ogni camera decodifica il video una sola volta (read_frames_at, solo i
+frame annotati, in ordine) e disegna su ogni frame i keypoints
+  - GT           (verde, file COCO originale),
+  - rettificati  (blu, file COCO rettificato, opzionale),
+  - riproiettati (rosso, keypoints.npz o COCO, opzionale),
+ognuno con un'unica chiamata a cv2.polylines per le ossa e una per i
+giunti (segmenti degeneri = punti), invece di un cv2.circle/cv2.line per
+keypoint. GT e riproiettati sono nello spazio del video originale, i
+rettificati in quello rettificato: prima di disegnare ogni livello viene
+portato nello spazio del frame (senza --rectify i rettificati vengono
+ridistorti, con --rectify GT e riproiettati vengono rettificati e tutti
+spostati dell'eventuale ritaglio del profilo).
+
+Uscita per camera: outN_overlay.mp4 oppure fogli di miniature
+outN_sheet_XX.png (--sheet). Le camere vengono elaborate in processi
+separati (--jobs), ciascuno con il proprio decoder.
+
+Esempio: python overlay_videos.py --rectified _annotations.coco.rectified.json --sheet
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+from camera_rig import CameraRig
+from coco_index import AnnotationIndex
+from extract_rectified_frames import read_frames_at
+from instrumentation import span, traced
+from rectified_videos import RECTIFY_PROFILES, load_profile_maps
+from skeleton_io import KEYPOINTS_PATH, load_keypoints
+
+LAYER_COLORS = {'gt': (0, 255, 0), 'rectified': (255, 128, 0), 'reprojected': (0, 0, 255)}
+RECTIFIED_LAYERS = {'rectified'}          # livelli già in coordinate rettificate
+OUTPUT_DIR   = 'overlays'
+SCALE        = 0.5            # scala dei frame in uscita (4K -> 1920x1080)
+SHEET_COLS   = 6
+SHEET_SIZE   = 36             # miniature per foglio
+THUMB_WIDTH  = 640
+
+
+def draw_keypoints_batch(img, kps, links, color, scale=1.0, radius=4, thickness=2):
+    """
+    Disegna keypoints (N, J, 3) e ossa (links 0-based (L, 2)) di N scheletri
+    su img con due sole chiamate a cv2.polylines. Giunti con v<=0 o NaN
+    vengono saltati.
+    """
+    kps = np.asarray(kps, dtype=np.float64).reshape(-1, kps.shape[-2], 3)
+    xy = kps[..., :2] * scale
+    ok = (kps[..., 2] > 0) & np.isfinite(xy).all(axis=-1)
+    pts = np.round(np.where(ok[..., None], xy, 0)).astype(np.int32)
+    if len(links):
+        a, b = links[:, 0], links[:, 1]
+        both = ok[:, a] & ok[:, b]                                   # (N, L)
+        segs = np.stack([pts[:, a], pts[:, b]], axis=2)[both]       # (S, 2, 2)
+        if len(segs):
+            cv2.polylines(img, list(segs), False, color, thickness, cv2.LINE_AA)
+    dots = pts[ok]
+    if len(dots):
+        cv2.polylines(img, list(np.repeat(dots[:, None], 2, axis=1)), False, color, 2 * radius, cv2.LINE_AA)
+    return img
+
+
+def distort_points(xy, K, dist):
+    """Inverso di cv2.undistortPoints(..., P=K): punti rettificati (N, 2) -> pixel del video originale."""
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    if not len(xy):
+        return xy
+    norm = (xy - K[:2, 2]) / np.diag(K)[:2]
+    rays = np.concatenate([norm, np.ones((len(norm), 1))], axis=1)
+    out, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3), K, dist)
+    return out.reshape(-1, 2)
+
+
+def to_frame_space(layers, K, dist, rectified, roi=(0, 0)):
+    """
+    Porta tutti i livelli (dict nome -> dict numero_frame -> (J, 3)) nello
+    spazio del frame disegnato: rettificato (con origine nel ritaglio roi) se
+    rectified, altrimenti quello del video originale. Un solo undistortPoints
+    o projectPoints per livello.
+    """
+    out = {}
+    for name, by_frame in layers.items():
+        if not by_frame:
+            out[name] = {}
+            continue
+        keys = list(by_frame)
+        kps = np.stack([np.asarray(by_frame[k], dtype=np.float64) for k in keys])       # (N, J, 3)
+        xy = kps[..., :2].reshape(-1, 2)
+        ok = np.isfinite(xy).all(axis=1)
+        if rectified and name not in RECTIFIED_LAYERS:
+            xy[ok] = cv2.undistortPoints(xy[ok].reshape(-1, 1, 2), K, dist, P=K).reshape(-1, 2)
+        elif not rectified and name in RECTIFIED_LAYERS:
+            xy[ok] = distort_points(xy[ok], K, dist)
+        if rectified:
+            xy -= np.asarray(roi[:2], dtype=np.float64)
+        kps[..., :2] = xy.reshape(kps.shape[:-1] + (2,))
+        out[name] = dict(zip(keys, kps))
+    return out
+
+
+def draw_legend(img, layers, label):
+    y = 30
+    cv2.putText(img, label, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2, cv2.LINE_AA)
+    for name in layers:
+        y += 28
+        cv2.putText(img, name, (10, y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, LAYER_COLORS[name], 2, cv2.LINE_AA)
+    return img
+
+
+def render_camera(video_path, cam_id, frames, layers, links, output_dir, rig=None, rectify=None,
+                  scale=SCALE, sheet=False, fps=5.0, frame_base=1, frame_step=1):
+    """
+    Rende tutti i frame annotati di una camera. frames: numeri di frame
+    COCO ordinati; layers: dict nome -> dict numero_frame -> (J, 3).
+    Ritorna la lista dei file scritti.
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print("Error opening video file:", video_path)
+        return []
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    maps = load_profile_maps(rig, cam_id, size, rectify) if rectify else None
+    if maps is not None:
+        size = maps[3][2:]                                           # frame ritagliato dal profilo
+    if rig is not None:
+        K, dist, _, _ = rig.camera(cam_id)
+        layers = to_frame_space(layers, K, dist, rectify is not None, maps[3] if maps else (0, 0))
+    out_size = (int(round(size[0] * scale)), int(round(size[1] * scale)))
+    if sheet:
+        out_size = (THUMB_WIDTH, int(round(THUMB_WIDTH * size[1] / size[0])))
+        scale = out_size[0] / size[0]
+
+    # spessori proporzionali alla scala (riferiti al frame 4K)
+    radius, thickness = max(2, round(8 * scale)), max(1, round(4 * scale))
+    by_index = {(n - frame_base) * frame_step: n for n in frames}
+    writer, thumbs, written = None, [], []
+
+    def flush_sheet():
+        rows = -(-len(thumbs) // SHEET_COLS)
+        grid = np.zeros((rows * out_size[1], SHEET_COLS * out_size[0], 3), np.uint8)
+        for i, t in enumerate(thumbs):
+            r, c = divmod(i, SHEET_COLS)
+            grid[r * out_size[1]:(r + 1) * out_size[1], c * out_size[0]:(c + 1) * out_size[0]] = t
+        path = os.path.join(output_dir, f"out{cam_id}_sheet_{len(written):02d}.png")
+        with span('overlay.sheet', frames=len(thumbs)):
+            cv2.imwrite(path, grid)
+        written.append(path)
+        thumbs.clear()
+
+    for index, frame in read_frames_at(cap, sorted(by_index)):
+        n = by_index[index]
+        if maps is not None:
+            with span('overlay.remap', frames=1):
+                frame = cv2.remap(frame, maps[0], maps[1], interpolation=maps[2])
+        with span('overlay.draw', frames=1):
+            # si disegna sul frame già ridotto: meno pixel da scrivere
+            img = cv2.resize(frame, out_size, interpolation=cv2.INTER_AREA) if scale != 1.0 else frame
+            present = [name for name, kps in layers.items() if n in kps]
+            for name in present:
+                draw_keypoints_batch(img, layers[name][n][None], links, LAYER_COLORS[name], scale,
+                                     radius, thickness)
+            draw_legend(img, present, f"cam_{cam_id} frame {n}")
+        if sheet:
+            thumbs.append(img)
+            if len(thumbs) == SHEET_SIZE:
+                flush_sheet()
+            continue
+        if writer is None:
+            path = os.path.join(output_dir, f"out{cam_id}_overlay.mp4")
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, out_size)
+            written.append(path)
+        with span('overlay.encode', frames=1):
+            writer.write(img)
+    if thumbs:
+        flush_sheet()
+    if writer is not None:
+        writer.release()
+    cap.release()
+    print(f"cam_{cam_id}: {len(by_index)} frame -> {', '.join(written) or 'nessun file'}")
+    return written
+
+
+def _layer_by_frame(index, cam_id, keypoints):
+    """dict numero_frame -> keypoints (J, 3) della camera, da dict image_id -> keypoints."""
+    return {frame: keypoints[img_id] for (c, frame), img_id in index.image_by_cam_frame.items()
+            if c == cam_id and img_id in keypoints}
+
+
+@traced('overlay_videos')
+def main():
+    parser = argparse.ArgumentParser(description='Overlay dei keypoints su tutti i frame annotati dei video')
+    parser.add_argument('--annotations', default='_annotations.coco.json', help='File COCO GT')
+    parser.add_argument('--rectified', default=None, help='File COCO rettificato (opzionale)')
+    parser.add_argument('--reproj', default=KEYPOINTS_PATH,
+                        help='Keypoints riproiettati (.npz o COCO); ignorato se il file non esiste')
+    parser.add_argument('--video_dir', default='mocap_7_videos', help='Cartella con i video outN.mp4')
+    parser.add_argument('--output_dir', default=OUTPUT_DIR, help='Cartella di uscita')
+    parser.add_argument('--rectify', choices=sorted(RECTIFY_PROFILES), default=None, help='Rettifica i frame')
+    parser.add_argument('--scale', type=float, default=SCALE, help='Scala dei frame in uscita (MP4)')
+    parser.add_argument('--sheet', action='store_true', help='Fogli di miniature PNG invece di un MP4')
+    parser.add_argument('--fps', type=float, default=5.0, help='fps del video di uscita')
+    parser.add_argument('--cams', type=int, nargs='*', default=None, help='Camere (default: tutte)')
+    parser.add_argument('--frame_base', type=int, default=1, help='Numero COCO del primo frame del video')
+    parser.add_argument('--frame_step', type=int, default=1, help='Passo tra frame COCO consecutivi nel video')
+    parser.add_argument('--jobs', type=int, default=1, help='Camere elaborate in parallelo')
+    args = parser.parse_args()
+
+    gt = AnnotationIndex.load(args.annotations)
+    links = np.array(gt.skeleton_links(), dtype=np.int64).reshape(-1, 2) - 1
+    sources = {'gt': (gt, {i: gt.image_keypoints(i) for i in gt.images})}
+    if args.rectified:
+        rect = AnnotationIndex.load(args.rectified)
+        sources['rectified'] = (rect, {i: rect.image_keypoints(i) for i in rect.images})
+    if args.reproj and os.path.isfile(args.reproj):
+        ids, kps, _ = load_keypoints(args.reproj)
+        sources['reprojected'] = (gt, dict(zip(ids.tolist(), kps)))
+    for _, kps in sources.values():
+        for i in [i for i, k in kps.items() if k is None]:
+            del kps[i]
+
+    # serve la calibrazione anche senza --rectify per ridistorcere il livello rettificato
+    rig = CameraRig.load() if args.rectify or 'rectified' in sources else None
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = []
+    for cam_id, numbers in sorted(gt.frames_by_camera().items()):
+        video_path = os.path.join(args.video_dir, f"out{cam_id}.mp4")
+        if (args.cams and cam_id not in args.cams) or not os.path.isfile(video_path):
+            continue
+        layers = {name: _layer_by_frame(index, cam_id, kps) for name, (index, kps) in sources.items()}
+        jobs.append((video_path, cam_id, numbers, layers, links, args.output_dir, rig, args.rectify,
+                     args.scale, args.sheet, args.fps, args.frame_base, args.frame_step))
+
+    if args.jobs <= 1:
+        for job in jobs:
+            render_camera(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            for fut in [pool.submit(render_camera, *job) for job in jobs]:
+                fut.result()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""
+PIPELINE INCREMENTALE
+
+Modella gli step del README come un DAG:
+
+  rectify      _annotations.coco.json           -> _annotations.coco.rectified.json
+  triangulate  _annotations.coco.rectified.json -> triangulated_3d_skeleton.npz
+  reproject    triangulated_3d_skeleton.npz     -> reprojected_keypoints.npz
+
+Ogni stage calcola un hash del contenuto dei suoi input per chiave (immagine
+per la rettifica, frame per triangolazione e riproiezione) più un hash dei
+parametri globali (calibrazione, modalità). Vengono ricalcolate solo le
+chiavi cambiate e i risultati vengono fusi negli output esistenti; lo stato
+è salvato in .cache/pipeline_state.json.
+
+Uso: python pipeline.py [--force] [--dry-run] [--stages rectify triangulate ...]
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import numpy as np
+
+from camera_rig import CameraRig, CACHE_DIR
+from coco_index import AnnotationIndex
+from rectified_annotations import rectify_coco
+from triangulation import RANSAC_THRESHOLD, build_observations, triangulate, coco_skeleton_meta
+from generate_reprojected_annotations import reproject_images
+from instrumentation import span, traced
+from skeleton_io import (Skeleton, save_skeleton, load_skeleton, save_keypoints, load_keypoints,
+                         export_keypoints_coco, SKELETON_PATH, KEYPOINTS_PATH)
+
+RAW_ANN_PATH   = '_annotations.coco.json'
+RECT_ANN_PATH  = '_annotations.coco.rectified.json'
+STATE_PATH     = os.path.join(CACHE_DIR, 'pipeline_state.json')
+
+
+def _hash(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else json.dumps(p, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class Stage:
+    """
+    Uno step del DAG. Le sottoclassi implementano:
+      key_hashes(ctx) -> dict chiave -> hash degli input di quella chiave
+      params(ctx)     -> parametri globali (se cambiano, tutto è dirty)
+      run(ctx, dirty) -> ricalcola le chiavi dirty e aggiorna l'output
+    """
+    name    = None
+    deps    = ()
+    output  = None
+
+    def key_hashes(self, ctx):
+        raise NotImplementedError
+
+    def params(self, ctx):
+        return {}
+
+    def run(self, ctx, dirty):
+        raise NotImplementedError
+
+
+class RectifyStage(Stage):
+    name   = 'rectify'
+    output = RECT_ANN_PATH
+
+    def _raw(self, ctx):
+        if 'raw' not in ctx:
+            with open(ctx['raw_path'], 'r') as f:
+                ctx['raw'] = json.load(f)
+        return ctx['raw']
+
+    def key_hashes(self, ctx):
+        raw = self._raw(ctx)
+        anns = {}
+        for ann in raw['annotations']:
+            anns.setdefault(ann['image_id'], []).append(ann)
+        return {str(img['id']): _hash(img, anns.get(img['id'], [])) for img in raw['images']}
+
+    def params(self, ctx):
+        return {'calib': ctx['rig'].calib_hash, 'mode': ctx['mode']}
+
+    def run(self, ctx, dirty):
+        raw = self._raw(ctx)
+        dirty_ids = {int(k) for k in dirty}
+
+        prev = {}
+        if os.path.isfile(self.output):
+            with open(self.output, 'r') as f:
+                prev = {ann['id']: ann for ann in json.load(f)['annotations']}
+        # un'annotazione che manca dall'output precedente rende dirty la sua immagine
+        dirty_ids |= {ann['image_id'] for ann in raw['annotations'] if ann['id'] not in prev}
+
+        sub = {k: v for k, v in raw.items() if k not in ('images', 'annotations')}
+        sub['images'] = [img for img in raw['images'] if img['id'] in dirty_ids]
+        sub['annotations'] = [copy.deepcopy(ann) for ann in raw['annotations'] if ann['image_id'] in dirty_ids]
+        rectify_coco(sub, ctx['rig'], ctx['mode'])
+        fresh = {ann['id']: ann for ann in sub['annotations']}
+
+        out = dict(raw)
+        out['annotations'] = [fresh[ann['id']] if ann['image_id'] in dirty_ids else prev[ann['id']]
+                              for ann in raw['annotations']]
+        with open(self.output, 'w') as f:
+            json.dump(out, f, indent=2)
+        return len(dirty_ids)
+
+
+class TriangulateStage(Stage):
+    name   = 'triangulate'
+    deps   = ('rectify',)
+    output = SKELETON_PATH
+
+    def _observations(self, ctx):
+        if 'obs' not in ctx:
+            ctx['rect_index'] = AnnotationIndex.load(RECT_ANN_PATH)
+            ctx['obs'] = build_observations(ctx['rect_index'], ctx['rig'].cam_ids)
+        return ctx['obs']
+
+    def key_hashes(self, ctx):
+        frames, obs = self._observations(ctx)
+        return {str(int(f)): _hash(o.tobytes()) for f, o in zip(frames, obs)}
+
+    def params(self, ctx):
+        params = {'calib': ctx['rig'].calib_hash, 'method': ctx['method']}
+        if ctx['method'] == 'robust':
+            params['threshold'] = ctx['threshold']
+        return params
+
+    def run(self, ctx, dirty):
+        frames, obs = self._observations(ctx)
+        rig = ctx['rig']
+        prev = load_skeleton(self.output) if os.path.isfile(self.output) else None
+        prev_rows = prev.frame_index() if prev is not None else {}
+        todo = np.array([str(int(f)) in dirty or int(f) not in prev_rows for f in frames], dtype=bool)
+
+        points = np.full((len(frames), obs.shape[2], 3), np.nan)
+        extras = {}
+        if todo.any():
+            points[todo], fresh = triangulate(obs[todo], rig.P, ctx['method'], ctx['threshold'])
+            for name, arr in fresh.items():
+                extras[name] = np.zeros((len(frames),) + arr.shape[1:], dtype=arr.dtype)
+                extras[name][todo] = arr
+        elif prev is not None:
+            # solo frame rimossi: gli extra (es. inliers) vengono tutti dall'output precedente
+            for name, arr in prev.extras.items():
+                extras[name] = np.zeros((len(frames),) + arr.shape[1:], dtype=arr.dtype)
+        for i in np.flatnonzero(~todo):
+            row = prev_rows[int(frames[i])]
+            points[i] = prev.points[row]
+            for name in extras:
+                extras[name][i] = prev.extras[name][row]
+
+        meta = dict(coco_skeleton_meta(ctx['rect_index'].data), source=RECT_ANN_PATH,
+                    cam_ids=rig.cam_ids, calib_hash=rig.calib_hash, method=ctx['method'])
+        if ctx['method'] == 'robust':
+            meta['threshold'] = ctx['threshold']
+        save_skeleton(self.output, Skeleton(points, frames, meta=meta, **extras))
+        return int(todo.sum())
+
+
+class ReprojectStage(Stage):
+    name   = 'reproject'
+    deps   = ('triangulate',)
+    output = KEYPOINTS_PATH
+
+    def key_hashes(self, ctx):
+        ctx['skeleton'] = load_skeleton(SKELETON_PATH)
+        return {str(int(f)): _hash(np.ascontiguousarray(p).tobytes())
+                for f, p in zip(ctx['skeleton'].frames, ctx['skeleton'].points)}
+
+    def params(self, ctx):
+        return {'calib': ctx['rig'].calib_hash}
+
+    def run(self, ctx, dirty):
+        coco = ctx.get('rect_index') or AnnotationIndex.load(RECT_ANN_PATH)
+        sk3d = ctx['skeleton']
+        prev = {}
+        if os.path.isfile(self.output):
+            ids, kps, _ = load_keypoints(self.output)
+            prev = dict(zip(ids.tolist(), kps))
+
+        frames = set(sk3d.frame_index())
+        dirty_frames = {int(k) for k in dirty}
+        todo = [img_id for img_id, (_, f) in coco.cam_frame.items()
+                if f in frames and (f in dirty_frames or img_id not in prev)]
+        fresh_ids, fresh_kps = reproject_images(coco, sk3d, ctx['rig'], todo)
+        fresh = dict(zip(fresh_ids, fresh_kps))
+
+        # stesso ordine di generate_reprojected_annotations (ordine immagini COCO)
+        image_ids, keypoints = [], []
+        for img in coco.data['images']:
+            img_id = img['id']
+            _, f = coco.cam_frame.get(img_id, (None, None))
+            if f not in frames or (img_id not in fresh and img_id not in prev):
+                continue
+            image_ids.append(img_id)
+            keypoints.append(fresh[img_id] if img_id in fresh else prev[img_id])
+        keypoints = np.array(keypoints).reshape(len(image_ids), sk3d.num_joints, 3)
+        save_keypoints(self.output, image_ids, keypoints,
+                       {'skeleton': os.path.basename(SKELETON_PATH), 'calib_hash': ctx['rig'].calib_hash})
+        if ctx.get('coco'):
+            export_keypoints_coco(ctx['coco'], coco.data, image_ids, keypoints)
+        return len(fresh_ids)
+
+
+STAGES = [RectifyStage(), TriangulateStage(), ReprojectStage()]
+
+
+def topological_order(stages):
+    """Ordina gli stage in modo che ognuno venga dopo le sue dipendenze."""
+    by_name = {s.name: s for s in stages}
+    order, visiting = [], set()
+
+    def visit(stage):
+        if stage in order:
+            return
+        if stage.name in visiting:
+            raise ValueError(f"Ciclo nel DAG della pipeline su '{stage.name}'")
+        visiting.add(stage.name)
+        for dep in stage.deps:
+            if dep in by_name:
+                visit(by_name[dep])
+        visiting.discard(stage.name)
+        order.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return order
+
+
+def load_state(path=STATE_PATH):
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, path=STATE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def run_pipeline(stages=None, force=False, dry_run=False, mode='map', method='svd', coco=None,
+                 raw_path=RAW_ANN_PATH, state_path=STATE_PATH, threshold=RANSAC_THRESHOLD):
+    """
+    Esegue gli stage richiesti (default: tutti) in ordine topologico,
+    ricalcolando solo le chiavi il cui hash è cambiato.
+    Ritorna dict stage -> numero di chiavi ricalcolate (None in dry-run se
+    dipende da uno stage da ricalcolare: le sue chiavi non sono note).
+    """
+    selected = set(stages or [s.name for s in STAGES])
+    state = load_state(state_path)
+    ctx = {'rig': CameraRig.load(), 'mode': mode, 'method': method, 'threshold': threshold,
+           'coco': coco, 'raw_path': raw_path}
+    report = {}
+    pending = set()    # dry-run: stage che verrebbero eseguiti (i loro output su disco sono vecchi)
+
+    for stage in topological_order(STAGES):
+        if stage.name not in selected:
+            continue
+        if dry_run and pending.intersection(stage.deps):
+            print(f"[{stage.name}] dipende da {', '.join(sorted(pending.intersection(stage.deps)))} "
+                  "che va ricalcolato: chiavi dirty non note in dry-run")
+            report[stage.name] = None
+            pending.add(stage.name)
+            continue
+        hashes = stage.key_hashes(ctx)
+        params = _hash(stage.params(ctx))
+        prev = state.get(stage.name, {})
+        rebuild = force or prev.get('params') != params or not os.path.isfile(stage.output)
+        old = {} if rebuild else prev.get('keys', {})
+        dirty = {k for k, h in hashes.items() if old.get(k) != h}
+        removed = set(old) - set(hashes)
+
+        if not dirty and not removed:
+            print(f"[{stage.name}] aggiornato ({len(hashes)} chiavi)")
+            report[stage.name] = 0
+            continue
+        print(f"[{stage.name}] {len(dirty)} chiavi da ricalcolare, {len(removed)} rimosse"
+              + (" (rebuild completo)" if rebuild else ""))
+        if dry_run:
+            report[stage.name] = len(dirty)
+            pending.add(stage.name)
+            continue
+        with span(f'pipeline.{stage.name}', keys=len(dirty)):
+            report[stage.name] = stage.run(ctx, dirty)
+        state[stage.name] = {'params': params, 'keys': hashes}
+        save_state(state, state_path)
+    return report
+
+
+@traced('pipeline')
+def main():
+    parser = argparse.ArgumentParser(description='Pipeline incrementale rettifica -> triangolazione -> riproiezione')
+    parser.add_argument('--stages', nargs='*', choices=[s.name for s in STAGES], default=None,
+                        help='Stage da eseguire (default: tutti)')
+    parser.add_argument('--force', action='store_true', help='Ricalcola tutto ignorando lo stato')
+    parser.add_argument('--dry-run', action='store_true', help='Mostra solo cosa verrebbe ricalcolato')
+    parser.add_argument('--mode', choices=['map', 'analytic'], default='map', help='Modalità di rettifica')
+    parser.add_argument('--method', choices=['svd', 'normal', 'robust'], default='svd', help='Solver DLT')
+    parser.add_argument('--threshold', type=float, default=RANSAC_THRESHOLD,
+                        help='Soglia inlier in pixel per --method robust')
+    parser.add_argument('--coco', nargs='?', const='reprojected_annotations.json', default=None,
+                        help='Esporta anche i keypoints riproiettati in COCO JSON')
+    parser.add_argument('--annotations', default=RAW_ANN_PATH, help='Annotazioni COCO originali')
+    args = parser.parse_args()
+
+    report = run_pipeline(args.stages, args.force, args.dry_run, args.mode, args.method, args.coco,
+                          args.annotations, threshold=args.threshold)
+    print("Ricalcolati: " + ", ".join(f"{k}={'?' if v is None else v}" for k, v in report.items()))
+
+
+if __name__ == '__main__':
+    main()
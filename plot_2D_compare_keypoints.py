@@ -1,52 +1,202 @@
 """
-DISEGNA keypoints rettificati vs riproiettati NELLO STESSO PLOT"""
+DISEGNA keypoints rettificati vs riproiettati NELLO STESSO PLOT
+
+  python plot_2D_compare_keypoints.py 12                  -> una immagine, finestra interattiva
+  python plot_2D_compare_keypoints.py --all [--jobs 4]     -> tutte le immagini in compare_plots/
+  python plot_2D_compare_keypoints.py --worst 20           -> solo le 20 immagini con errore maggiore
+
+In modalità batch i due file vengono caricati una volta sola, gli errori
+per giunto (pixel) di tutte le immagini sono calcolati in un colpo solo,
+i grafici vengono resi con Agg in un pool di processi e si scrive un
+indice index.html (immagini ordinate per errore medio) più errors.png.
+"""
 
 #!/usr/bin/env python3
-import json
 import numpy as np
 import matplotlib.pyplot as plt
 import argparse
+import html
 import os
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 
-def load_coco_annotations(path):
-    """
-    Carica il JSON COCO e ritorna:
-      - annots: lista di dizionari 'annotation'
-      - images: dict image_id → dizionario 'image'
-    """
-    data = json.load(open(path, 'r'))
-    annots = data['annotations']
-    images = {img['id']: img for img in data['images']}
-    return annots, images
+from coco_index import AnnotationIndex, image_name
+from instrumentation import span, traced
+from skeleton_io import KEYPOINTS, KEYPOINTS_PATH, load_keypoints
+
+OUTPUT_DIR = "compare_plots"
 
-def get_keypoints_for_image(annots, image_id):
+# FrameServer del processo (creato alla prima immagine con --video)
+_frame_server = None
+
+
+def image_errors(rect, reproj_ids, reproj_kps):
     """
-    Cerca nelle annots l'unica annotation con image_id, estrae keypoints Nx3
-    Ritorna array (N_joints, 3), oppure None se non trovato.
+    Allinea i keypoints riproiettati a quelli rettificati e calcola gli
+    errori per giunto. Ritorna (image_ids (N,), gt (N, J, 3), reproj (N, J, 3),
+    errors (N, J) in pixel, NaN dove il GT ha v<=0 o il punto manca).
     """
-    for ann in annots:
-        if ann['image_id'] == image_id:
-            kp = np.array(ann['keypoints'], dtype=float).reshape(-1, 3)
-            return kp
-    return None
+    cam_pos = {c: i for i, c in enumerate(rect.cam_ids)}
+    frame_pos = {int(f): i for i, f in enumerate(rect.frames)}
+    ids, fi, ci, rows = [], [], [], []
+    for row, img_id in enumerate(np.asarray(reproj_ids).tolist()):
+        cf = rect.cam_frame.get(img_id)
+        if cf is None or not rect.annotated[frame_pos[cf[1]], cam_pos[cf[0]]]:
+            continue
+        ids.append(img_id)
+        fi.append(frame_pos[cf[1]])
+        ci.append(cam_pos[cf[0]])
+        rows.append(row)
+    gt = rect.keypoints[fi, ci]
+    rp = np.asarray(reproj_kps)[rows]
+    J = min(gt.shape[1], rp.shape[1])
+    gt, rp = gt[:, :J], rp[:, :J]
+    errors = np.linalg.norm(gt[..., :2] - rp[..., :2], axis=-1)
+    errors[gt[..., 2] <= 0] = np.nan
+    return np.array(ids, dtype=np.int64), gt, rp, errors
+
+
+def draw_comparison(ax, kp_rect, kp_reproj, errors=None, title='', frame=None):
+    """GT rettificati (verde), riproiettati (rosso) e segmenti di errore tra i due."""
+    if frame is not None:
+        ax.imshow(frame[..., ::-1])
+    xy_rect, xy_reproj = kp_rect[:, :2], kp_reproj[:, :2]
+    ax.scatter(xy_rect[:, 0],   xy_rect[:, 1],   c='g', marker='o', label='GT rettificati')
+    ax.scatter(xy_reproj[:, 0], xy_reproj[:, 1], c='r', marker='x', label='Riproiettati')
+    if errors is not None and np.isfinite(errors).any():
+        ok = np.isfinite(errors)
+        ax.add_collection(LineCollection(np.stack([xy_rect[ok], xy_reproj[ok]], axis=1),
+                                         colors='orange', linewidths=1))
+        worst = int(np.nanargmax(errors))
+        name = KEYPOINTS[worst] if worst < len(KEYPOINTS) else str(worst)
+        ax.annotate(f"{name} {errors[worst]:.1f}px", xy_rect[worst], color='orange', fontsize=8)
+        title += f"\nMPJPE {np.nanmean(errors):.1f} px, max {np.nanmax(errors):.1f} px"
+    ax.legend(loc='upper right')
+    ax.set_title(title)
+    if not ax.yaxis_inverted():
+        ax.invert_yaxis()  # coord. immagine (0,0) in alto a sinistra
+    ax.set_xlabel("x [px]")
+    ax.set_ylabel("y [px]")
+    ax.axis('equal')
+
+
+def _video_frame(img_info):
+    global _frame_server
+    if _frame_server is None:
+        from frame_server import FrameServer
+        _frame_server = FrameServer(rectify='exact')
+    return _frame_server.image(image_name(img_info))
 
+
+def render_image(img_id, img_info, kp_rect, kp_reproj, errors, path, video=False):
+    """Rende offscreen (Agg) il confronto di una immagine in path."""
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    fname = img_info.get('file_name')
+    with span('compare.frame', frames=1):
+        frame = _video_frame(img_info) if video and fname else None
+    with span('compare.render', images=1):
+        draw_comparison(ax, kp_rect, kp_reproj, errors,
+                        f"Keypoints confronto per image_id {img_id}" + (f"\n{fname}" if fname else ""), frame)
+        fig.tight_layout()
+        fig.savefig(path, dpi=100)
+    return path
+
+
+def write_index(output_dir, entries):
+    """index.html con le immagini ordinate per errore medio ed errors.png (errore per immagine)."""
+    fig = Figure(figsize=(10, 4))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.bar(np.arange(len(entries)), [e['mpjpe'] for e in entries], color='tab:red')
+    ax.set_xlabel("immagini (ordinate per errore)")
+    ax.set_ylabel("MPJPE [px]")
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_dir, 'errors.png'), dpi=100)
+
+    rows = []
+    for e in entries:
+        rows.append(
+            f"<tr><td>{e['image_id']}</td><td>{html.escape(e['file_name'])}</td>"
+            f"<td>{e['mpjpe']:.2f}</td><td>{e['max']:.2f}</td><td>{html.escape(e['worst_joint'])}</td>"
+            f"<td><a href=\"{e['plot']}\"><img src=\"{e['plot']}\" width=\"240\"></a></td></tr>")
+    with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+        f.write("<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Confronto keypoints</title>"
+                "<style>td{padding:4px 8px;vertical-align:middle}</style></head><body>"
+                "<h1>Rettificati vs riproiettati</h1><img src=\"errors.png\">"
+                "<table><tr><th>image_id</th><th>file</th><th>MPJPE [px]</th><th>max [px]</th>"
+                "<th>giunto peggiore</th><th>plot</th></tr>\n" + "\n".join(rows) + "\n</table></body></html>\n")
+
+
+def run_batch(rect, reproj_ids, reproj_kps, output_dir=OUTPUT_DIR, worst=None, jobs=1, video=False):
+    """Grafici di confronto per tutte le immagini (o le worst peggiori) più l'indice."""
+    ids, gt, rp, errors = image_errors(rect, reproj_ids, reproj_kps)
+    with np.errstate(invalid='ignore'):
+        valid = np.isfinite(errors).any(axis=1)
+    ids, gt, rp, errors = ids[valid], gt[valid], rp[valid], errors[valid]
+    mpjpe = np.nanmean(errors, axis=1)
+    order = np.argsort(-mpjpe)
+    if worst:
+        order = order[:worst]
+    os.makedirs(output_dir, exist_ok=True)
+
+    entries, tasks = [], []
+    for i in order:
+        img_id = int(ids[i])
+        info = rect.images.get(img_id, {})
+        plot = f"image_{img_id:06d}.png"
+        worst_j = int(np.nanargmax(errors[i]))
+        entries.append({'image_id': img_id, 'file_name': info.get('file_name', ''), 'plot': plot,
+                        'mpjpe': float(mpjpe[i]), 'max': float(errors[i, worst_j]),
+                        'worst_joint': KEYPOINTS[worst_j] if worst_j < len(KEYPOINTS) else str(worst_j)})
+        tasks.append((img_id, info, gt[i], rp[i], errors[i], os.path.join(output_dir, plot), video))
+
+    if jobs <= 1:
+        for task in tasks:
+            render_image(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for fut in [pool.submit(render_image, *task) for task in tasks]:
+                fut.result()
+    write_index(output_dir, entries)
+    return entries
+
+
+@traced('plot_2D_compare_keypoints')
 def main():
     parser = argparse.ArgumentParser(
         description="Confronta keypoints rettificati vs riproiettati per una stessa image_id")
-    parser.add_argument("image_id", type=int, help="ID dell'immagine da plottare")
+    parser.add_argument("image_id", type=int, nargs='?', help="ID dell'immagine da plottare")
     parser.add_argument("--rectified", default="_annotations.coco.rectified.json",
                         help="Path al file COCO rettificato")
-    parser.add_argument("--reproj", default="reprojected_annotations.json",
-                        help="Path al file COCO con keypoints riproiettati")
+    parser.add_argument("--reproj", default=KEYPOINTS_PATH,
+                        help="Path ai keypoints riproiettati (.npz o file COCO .json)")
+    parser.add_argument("--video", action="store_true",
+                        help="Mostra sotto i keypoints il frame rettificato decodificato dal video")
+    parser.add_argument("--all", action="store_true", help="Batch: tutte le immagini")
+    parser.add_argument("--worst", type=int, default=None, help="Batch: solo le N immagini con errore maggiore")
+    parser.add_argument("--output_dir", default=OUTPUT_DIR, help="Cartella dei grafici e dell'indice (batch)")
+    parser.add_argument("--jobs", type=int, default=1, help="Processi di rendering (batch)")
     args = parser.parse_args()
 
     # 1) Carica le annotazioni
-    rect_annots, rect_images = load_coco_annotations(args.rectified)
-    reproj_annots, reproj_images = load_coco_annotations(args.reproj)
+    rect = AnnotationIndex.load(args.rectified)
+    reproj_ids, reproj_kps, _ = load_keypoints(args.reproj, mmap_mode='r')
+
+    if args.all or args.worst:
+        entries = run_batch(rect, reproj_ids, reproj_kps, args.output_dir, args.worst, args.jobs, args.video)
+        print(f"{len(entries)} grafici in {args.output_dir}/ (indice: {os.path.join(args.output_dir, 'index.html')})")
+        return
+    if args.image_id is None:
+        parser.error("serve image_id oppure --all/--worst")
 
     # 2) Estrai keypoints
-    kp_rect = get_keypoints_for_image(rect_annots, args.image_id)
-    kp_reproj = get_keypoints_for_image(reproj_annots, args.image_id)
+    kp_rect = rect.image_keypoints(args.image_id)
+    rows = np.flatnonzero(reproj_ids == args.image_id)
+    kp_reproj = np.asarray(reproj_kps[rows[0]]) if rows.size else None
 
     if kp_rect is None:
         print(f"[ERRORE] Nessuna annotation rettificata per image_id {args.image_id}")
@@ -56,23 +206,15 @@ def main():
         return
 
     # 3) Ricava informazioni immagine per titolo e dimensioni (opzionale)
-    img_info = rect_images.get(args.image_id, {})
+    img_info = rect.images.get(args.image_id, {})
     fname = img_info.get('file_name', None)
+    _, _, _, errors = image_errors(rect, [args.image_id], kp_reproj[None])
 
-    # 4) Prepara i dati XY
-    xy_rect   = kp_rect[:,:2]
-    xy_reproj = kp_reproj[:,:2]
-
-    # 5) Plot
-    plt.figure(figsize=(6,6))
-    plt.scatter(xy_rect[:,0],   xy_rect[:,1],   c='g', marker='o', label='GT rettificati')
-    plt.scatter(xy_reproj[:,0], xy_reproj[:,1], c='r', marker='x', label='Riproiettati')
-    plt.legend(loc='upper right')
-    plt.title(f"Keypoints confronto per image_id {args.image_id}" + (f"\n{fname}" if fname else ""))
-    plt.gca().invert_yaxis()  # coord. immagine (0,0) in alto a sinistra
-    plt.xlabel("x [px]")
-    plt.ylabel("y [px]")
-    plt.axis('equal')
+    # 4) Plot (con il frame del video come sfondo, se richiesto)
+    fig, ax = plt.subplots(figsize=(6, 6))
+    frame = _video_frame(img_info) if args.video and fname else None
+    draw_comparison(ax, kp_rect, kp_reproj, errors[0] if len(errors) else None,
+                    f"Keypoints confronto per image_id {args.image_id}" + (f"\n{fname}" if fname else ""), frame)
     plt.tight_layout()
     plt.show()
 
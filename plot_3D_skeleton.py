@@ -1,85 +1,246 @@
 """
-DISEGNA LO SCHELETRO 3D PER UN DATO FRAME"""
+DISEGNA LO SCHELETRO 3D PER UN DATO FRAME, O ESPORTA L'ANIMAZIONE
+
+  python plot_3D_skeleton.py 6 [skeleton.npz]                 -> finestra interattiva
+  python plot_3D_skeleton.py --export sessione.mp4 [--skeleton s.npz] [--jobs 4]
+                                                              -> MP4 (o .gif) di tutti i frame
+
+In esportazione la sequenza viene caricata una volta sola (memory-mapped),
+gli artisti sono un solo scatter e una sola Line3DCollection i cui dati
+vengono aggiornati ad ogni frame, e il rendering è offscreen con Agg (nessuna
+finestra, funziona anche senza display). Ogni frame reso va subito
+nell'MP4 (cv2.VideoWriter) o nella GIF (PIL). Con --jobs i frame vengono
+divisi in blocchi contigui (in ordine di frame) resi da processi separati in
+file .npy temporanei, con al più --jobs blocchi su disco alla volta.
+"""
 
-import json
-import sys
+import argparse
+import collections
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+from instrumentation import span, traced
+from skeleton_io import KEYPOINTS, SKELETON, SKELETON_PATH, load_skeleton, frame_key
+
+EXPORT_FPS  = 25.0
+EXPORT_SIZE = (800, 800)      # pixel
+EXPORT_DPI  = 100
+CHUNK_FRAMES = 64             # frame per blocco con --jobs (al più jobs blocchi su disco)
+
+
+class SkeletonArtist:
+    """Scatter dei giunti (testa in rosso) + ossa come unica Line3DCollection, aggiornabili in place."""
+
+    def __init__(self, ax, num_joints, links=SKELETON):
+        self.ax = ax
+        self.links = np.array(links, dtype=np.int64) - 1
+        head_idx = KEYPOINTS.index("Head") if num_joints == len(KEYPOINTS) else -1
+        colors = np.array(['b'] * num_joints, dtype=object)
+        sizes = np.full(num_joints, 20.0)
+        if head_idx >= 0:
+            colors[head_idx], sizes[head_idx] = 'r', 60.0
+        # scatter creato con punti finiti: con NaN matplotlib scarterebbe i punti (e i colori)
+        zero = np.zeros(num_joints)
+        self.scatter = ax.scatter(zero, zero, zero, c=list(colors), s=sizes, depthshade=False)
+        self.lines = Line3DCollection([], colors='k')
+        ax.add_collection3d(self.lines, autolim=False)
+
+    def update(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        self.scatter._offsets3d = (points[:, 0], points[:, 1], points[:, 2])
+        segs = points[self.links]                                      # (L, 2, 3)
+        self.lines.set_segments(segs[np.isfinite(segs).all(axis=(1, 2))])
+
+
+def _setup_axes(ax, limits=None):
+    ax.set_xlabel('X'); ax.set_ylabel('Y'); ax.set_zlabel('Z')
+    #scale x2 z-axis
+    ax.set_box_aspect([1, 1, 2])  # Aspect ratio
+    if limits is not None:
+        ax.set_xlim(*limits[0]); ax.set_ylim(*limits[1]); ax.set_zlim(*limits[2])
+
+
+def sequence_limits(points, margin=0.05):
+    """Limiti degli assi fissi per tutta la sequenza (così la vista non salta tra i frame)."""
+    lo, hi = np.nanmin(points, axis=(0, 1)), np.nanmax(points, axis=(0, 1))
+    pad = (hi - lo) * margin + 1e-6
+    return list(zip(lo - pad, hi + pad))
 
-# Definizioni statiche
-KEYPOINTS = [
-    "Hips", "RHip", "RKnee", "RAnkle", "RFoot",
-    "LHip", "LKnee", "LAnkle", "LFoot",
-    "Spine", "Neck", "Head",
-    "RShoulder", "RElbow", "RHand",
-    "LShoulder", "LElbow", "LHand"
-]
-
-SKELETON = [
-    (1, 2), (2, 3), (3, 4), (4, 5),
-    (1, 6), (6, 7), (7, 8), (8, 9),
-    (1, 10), (10, 11), (11, 12),
-    (11, 13), (13, 14), (14, 15),
-    (11, 16), (16, 17), (17, 18)
-]
-
-def plot_frame(frame_number, json_path="triangulated_3d_skeleton.json"):
+
+def plot_frame(frame_number, skeleton_path=SKELETON_PATH):
     """
     Plot 3D skeleton for a given frame.
 
     Args:
       frame_number: int or str, e.g. 1, "1", "0001" → frame_0001
-      json_path: path to the JSON file
+      skeleton_path: path to the skeleton file (.npz, or legacy .json)
     """
-    # Carica il JSON
+    # Carica lo scheletro
     try:
-        with open(json_path, 'r') as f:
-            data = json.load(f)
+        skeleton = load_skeleton(skeleton_path, mmap_mode='r')
     except FileNotFoundError:
-        print(f"File JSON '{json_path}' non trovato.")
+        print(f"File scheletro '{skeleton_path}' non trovato.")
         return
 
-    frames = data.get('skeleton_3d', {})
     try:
         idx = int(frame_number)
     except ValueError:
         print(f"Numero di frame non valido: {frame_number}")
         return
 
-    key = f"frame_{idx:04d}"
-    if key not in frames:
-        print(f"Frame '{key}' non presente nel JSON.")
+    key = frame_key(idx)
+    points = skeleton.get(idx)
+    if points is None:
+        print(f"Frame '{key}' non presente in {skeleton_path}.")
         return
 
-    points = frames[key]
-    xs, ys, zs = zip(*points)
-
+    points = np.asarray(points)
     fig = plt.figure()
     ax = fig.add_subplot(111, projection='3d')
+    artist = SkeletonArtist(ax, len(points))
+    artist.update(points)
+    _setup_axes(ax, sequence_limits(points[None]))
 
-    # Scatter: testa in rosso, gli altri in blu
-    head_idx = KEYPOINTS.index("Head")
-    for i, (x, y, z) in enumerate(points):
-        c = 'r' if i == head_idx else 'b'
-        s = 60  if i == head_idx else 20
-        ax.scatter(x, y, z, c=c, s=s)
-
-    # Connessioni scheletro
-    for a, b in SKELETON:
-        i, j = a-1, b-1
-        ax.plot([xs[i], xs[j]], [ys[i], ys[j]], [zs[i], zs[j]], c='k')
+    plt.title(f"Scheletro 3D — {key}")
+    plt.legend([artist.scatter], ['Head (rosso)'])
+    plt.show()
 
-    ax.set_xlabel('X'); ax.set_ylabel('Y'); ax.set_zlabel('Z')
 
-    #scale x2 z-axis
-    ax.set_box_aspect([1, 1, 2])  # Aspect ratio
+def iter_rendered(skeleton_path, indices, size=EXPORT_SIZE, dpi=EXPORT_DPI, limits=None):
+    """Rende offscreen, nell'ordine dato, le righe `indices` della sequenza: genera frame (h, w, 3) uint8 RGB."""
+    skeleton = load_skeleton(skeleton_path, mmap_mode='r')
+    fig = Figure(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection='3d')
+    artist = SkeletonArtist(ax, skeleton.num_joints)
+    _setup_axes(ax, limits or sequence_limits(skeleton.points))
+    title = ax.set_title('')
+    for i in indices:
+        artist.update(skeleton.points[i])
+        title.set_text(f"Scheletro 3D — {frame_key(skeleton.frames[i])}")
+        with span('plot3d.draw', frames=1):
+            canvas.draw()
+        yield np.asarray(canvas.buffer_rgba())[..., :3]
+
+
+def render_chunk(skeleton_path, indices, out_path, size=EXPORT_SIZE, dpi=EXPORT_DPI, limits=None):
+    """Rende le righe `indices` in un .npy (N, h, w, 3) uint8 RGB. Ritorna out_path."""
+    out = None
+    for k, frame in enumerate(iter_rendered(skeleton_path, indices, size, dpi, limits)):
+        if out is None:
+            out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.uint8,
+                                            shape=(len(indices),) + frame.shape)
+        out[k] = frame
+    if out is not None:
+        out.flush()
+        del out
+    return out_path
+
+
+def _iter_chunks(args, jobs):
+    """
+    Frame dei blocchi resi in parallelo, in ordine. Al più `jobs` blocchi
+    sono in lavorazione o su disco: un blocco viene cancellato appena letto
+    e solo allora si sottomette il successivo.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque(pool.submit(render_chunk, *a) for a in args[:jobs])
+        queued = args[jobs:]
+        while pending:
+            path = pending.popleft().result()
+            yield from np.load(path, mmap_mode='r')
+            os.remove(path)
+            if queued:
+                pending.append(pool.submit(render_chunk, *queued.pop(0)))
+
+
+def export_animation(skeleton_path, output, fps=EXPORT_FPS, jobs=1, size=EXPORT_SIZE, dpi=EXPORT_DPI,
+                     chunk_size=CHUNK_FRAMES):
+    """
+    Esporta tutti i frame dello scheletro in output (.mp4 o .gif). Con jobs=1
+    i frame vanno direttamente al writer; con più processi i blocchi di
+    chunk_size frame passano da file temporanei. Ritorna il numero di frame.
+    """
+    ext = os.path.splitext(output)[1].lower()
+    if ext not in ('.mp4', '.gif'):
+        raise ValueError(f"Formato non supportato: {output} (usa .mp4 o .gif)")
+    skeleton = load_skeleton(skeleton_path, mmap_mode='r')
+    n = len(skeleton)
+    if n == 0:
+        print(f"Nessun frame in {skeleton_path}")
+        return 0
+    limits = sequence_limits(skeleton.points)
+    # le righe del file non sono necessariamente in ordine di frame
+    order = np.argsort(skeleton.frames, kind='stable').tolist()
+
+    if jobs <= 1:
+        with span('plot3d.write', frames=n):
+            _write_frames(iter_rendered(skeleton_path, order, size, dpi, limits), output, ext, fps)
+        return n
+
+    chunk_size = max(1, min(chunk_size or n, -(-n // jobs)))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp:
+        args = [(skeleton_path, order[s:s + chunk_size], os.path.join(tmp, f"chunk_{k:04d}.npy"),
+                 size, dpi, limits) for k, s in enumerate(range(0, n, chunk_size))]
+        with span('plot3d.write', frames=n):
+            _write_frames(_iter_chunks(args, jobs), output, ext, fps)
+    return n
+
+
+def _write_frames(frames, output, ext, fps):
+    """Scrive in ordine i frame RGB (iteratore) in un MP4 o in una GIF."""
+    if ext == '.mp4':
+        import cv2
+        writer = None
+        for frame in frames:
+            if writer is None:
+                h, w = frame.shape[:2]
+                writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+            writer.write(cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2BGR))
+        writer.release()
+        return
+    from PIL import Image
+    # PIL vuole tutti i frame della GIF insieme: si passano come iteratore pigro
+    images = (Image.fromarray(np.array(f)) for f in frames)
+    first = next(images)
+    first.save(output, save_all=True, append_images=images, duration=int(round(1000 / fps)), loop=0)
+
+
+@traced('plot_3D_skeleton')
+def main():
+    parser = argparse.ArgumentParser(description='Scheletro 3D: un frame interattivo o animazione offscreen')
+    parser.add_argument('frame', nargs='?', default='1', help='Frame da mostrare (modalità interattiva)')
+    parser.add_argument('skeleton', nargs='?', default=None, help='File dello scheletro')
+    parser.add_argument('--skeleton', dest='skeleton_opt', default=None,
+                        help='File dello scheletro (alternativa al positional, comoda con --export)')
+    parser.add_argument('--export', default=None, help='Esporta tutti i frame in un .mp4 o .gif')
+    parser.add_argument('--fps', type=float, default=EXPORT_FPS, help='fps dell\'animazione')
+    parser.add_argument('--size', type=int, nargs=2, default=EXPORT_SIZE, metavar=('W', 'H'),
+                        help='Dimensione dei frame in pixel')
+    parser.add_argument('--jobs', type=int, default=1, help='Processi di rendering (blocchi di frame)')
+    args = parser.parse_args()
+    if args.skeleton and args.skeleton_opt:
+        parser.error("scheletro indicato due volte (positional e --skeleton)")
+    skeleton_path = args.skeleton or args.skeleton_opt or SKELETON_PATH
+    try:
+        int(args.frame)
+    except ValueError:
+        # es. `--export out.mp4 my.npz`: my.npz finirebbe in `frame` e si esporterebbe lo scheletro di default
+        parser.error(f"frame non numerico: {args.frame!r} (per scegliere lo scheletro usa --skeleton)")
 
-    plt.title(f"Scheletro 3D — {key}")
-    plt.legend(['Head (rosso)'])
-    plt.show()
+    if args.export:
+        n = export_animation(skeleton_path, args.export, args.fps, args.jobs, tuple(args.size))
+        print(f"{n} frame esportati in {args.export}")
+    else:
+        plot_frame(args.frame, skeleton_path)
 
 
 if __name__ == "__main__":
-    # Passa il frame da linea di comando, es. `python plot_skeleton.py 6`
-    frame_arg = sys.argv[1] if len(sys.argv) > 1 else "1"
-    plot_frame(frame_arg)
+    main()
@@ -1,59 +1,27 @@
 import json
 import os
-import re
+import argparse
+from itertools import chain
 import cv2
 import numpy as np
 
-# Calibration files for each camera index
-CALIB_FILES = {
-    '2': 'camera_data/cam_2/calib/camera_calib.json',
-    '5': 'camera_data/cam_5/calib/camera_calib.json',
-    '8': 'camera_data/cam_8/calib/camera_calib.json',
-    '13': 'camera_data/cam_13/calib/camera_calib.json',
-}
+from camera_rig import CameraRig
+from coco_index import parse_image_name
+from instrumentation import span, traced
+from undistort_maps import get_undistort_maps
 
 
-def load_calibration(calib_path):
+def _rectify_with_maps(data, image_cams, rig):
     """
-    Load camera matrix and distortion coefficients from a JSON file.
+    Rectify keypoints and bboxes by looking up the dense remap tables at the
+    nearest integer pixel (same maps used for video rectification).
     """
-    with open(calib_path, 'r') as f:
-        calib = json.load(f)
-    mtx = np.array(calib['mtx'], dtype=np.float32)
-    dist = np.array(calib['dist'], dtype=np.float32)
-    return mtx, dist
-
-
-def rectify_annotations(coco_json_path, output_json_path):
-    """
-    Read COCO-format annotations, undistort keypoints and bboxes using the same maps
-    that are used for video rectification, and save rectified JSON.
-    """
-    # Load annotations
-    with open(coco_json_path, 'r') as f:
-        data = json.load(f)
-
-    # Prepare undistort maps per image
+    # Prepare undistort maps per image (shared memory-mapped maps per camera)
     maps = {}  # image_id -> (map_x, map_y)
-
     for img in data['images']:
-        fname = img['file_name']
-        match = re.match(r'.*out(\d+)_frame_.*', fname)
-        if not match:
-            raise ValueError(f"Cannot extract camera index from {fname}")
-        cam_idx = match.group(1)
-        if cam_idx not in CALIB_FILES:
-            raise ValueError(f"No calibration for camera {cam_idx}")
-
-        # Load calibration once per camera index
-        mtx, dist = load_calibration(CALIB_FILES[cam_idx])
         w, h = img['width'], img['height']
-
-        # Build undistort rectify maps (same as video)
-        map_x, map_y = cv2.initUndistortRectifyMap(
-            mtx, dist, None, mtx, (w, h), cv2.CV_32FC1
-        )
-        maps[img['id']] = (map_x, map_y)
+        # Undistort rectify maps, computed once per camera and resolution
+        maps[img['id']] = get_undistort_maps(rig, image_cams[img['id']], (w, h), kind='rectify')
 
     # Rectify annotations
     for ann in data['annotations']:
@@ -93,18 +61,114 @@ def rectify_annotations(coco_json_path, output_json_path):
         y_min, y_max = min(uy_list), max(uy_list)
         ann['bbox'] = [x_min, y_min, x_max - x_min, y_max - y_min]
 
+
+def _rectify_analytic(data, image_cams, rig):
+    """
+    Rectify keypoints and bboxes without dense maps: gather every point of
+    the file into one array per camera, undistort it with a single
+    cv2.undistortPoints call (sub-pixel, through the distortion model) and
+    scatter the results back into the annotations.
+    """
+    anns = [ann for ann in data['annotations'] if ann['image_id'] in image_cams]
+    if not anns:
+        return
+    ann_cams = np.array([image_cams[ann['image_id']] for ann in anns])
+    kp_counts = np.array([len(ann.get('keypoints', [])) // 3 for ann in anns])
+    kpts = np.fromiter(chain.from_iterable(ann.get('keypoints', [])[:3 * n]
+                                           for ann, n in zip(anns, kp_counts)),
+                       dtype=np.float64, count=3 * int(kp_counts.sum())).reshape(-1, 3)
+    kp_cams = np.repeat(ann_cams, kp_counts)
+
+    # bbox corners: (N, 4, 2)
+    bbox = np.array([ann['bbox'] for ann in anns], dtype=np.float64)
+    x, y, bw, bh = bbox.T
+    corners = np.stack([np.stack([x, y], -1), np.stack([x + bw, y], -1),
+                        np.stack([x, y + bh], -1), np.stack([x + bw, y + bh], -1)], axis=1)
+
+    kp_xy = kpts[:, :2].copy()
+    for cam_idx in np.unique(ann_cams):
+        K, dist, _, _ = rig.camera(cam_idx)
+        sel = kp_cams == cam_idx
+        if sel.any():
+            kp_xy[sel] = cv2.undistortPoints(kp_xy[sel].reshape(-1, 1, 2), K, dist, P=K).reshape(-1, 2)
+        sel = ann_cams == cam_idx
+        corners[sel] = cv2.undistortPoints(corners[sel].reshape(-1, 1, 2), K, dist, P=K).reshape(-1, 4, 2)
+
+    # Scatter back (visibility kept as in the original annotation)
+    kp_xy = kp_xy.tolist()
+    lo, hi = corners.min(axis=1), corners.max(axis=1)
+    new_bbox = np.concatenate([lo, hi - lo], axis=1).tolist()
+    start = 0
+    for ann, n, box in zip(anns, kp_counts, new_bbox):
+        if n:
+            vis = ann['keypoints'][2:3 * n:3]
+            ann['keypoints'] = [c for (ux, uy), v in zip(kp_xy[start:start + n], vis) for c in (ux, uy, v)]
+        ann['bbox'] = box
+        start += n
+
+
+def rectify_coco(data, rig, mode='map'):
+    """
+    Undistort, in place, the keypoints and bboxes of a COCO dict.
+
+    mode='map' uses the same maps that are used for video rectification;
+    mode='analytic' undistorts all points analytically at sub-pixel accuracy
+    without building any dense map.
+    """
+    if mode not in ('map', 'analytic'):
+        raise ValueError(f"Unknown rectification mode: {mode}")
+
+    image_cams = {}  # image_id -> camera index
+    for img in data['images']:
+        fname = img['file_name']
+        cam_idx, _ = parse_image_name(fname)
+        if cam_idx is None:
+            raise ValueError(f"Cannot extract camera index from {fname}")
+        if cam_idx not in rig:
+            raise ValueError(f"No calibration for camera {cam_idx}")
+        image_cams[img['id']] = cam_idx
+
+    with span(f'rectify.{mode}', annotations=len(data['annotations'])):
+        if mode == 'map':
+            _rectify_with_maps(data, image_cams, rig)
+        else:
+            _rectify_analytic(data, image_cams, rig)
+    return data
+
+
+def rectify_annotations(coco_json_path, output_json_path, rig=None, mode='map'):
+    """
+    Read COCO-format annotations, undistort keypoints and bboxes (see
+    rectify_coco for the modes) and save rectified JSON.
+    """
+    if rig is None:
+        rig = CameraRig.load()
+
+    # Load annotations
+    with span('rectify.json_load', bytes=os.path.getsize(coco_json_path)), open(coco_json_path, 'r') as f:
+        data = json.load(f)
+
+    rectify_coco(data, rig, mode)
+
     # Save rectified annotations
     os.makedirs(os.path.dirname(output_json_path), exist_ok=True)
-    with open(output_json_path, 'w') as f:
+    with span('rectify.json_write'), open(output_json_path, 'w') as f:
         json.dump(data, f, indent=2)
 
 
+@traced('rectified_annotations')
 def main():
-    # adjust paths if needed
-    input_json = '_annotations.coco.json'
-    output_json = './_annotations.coco.rectified.json'
+    parser = argparse.ArgumentParser(description='Rectify COCO keypoints and bboxes')
+    parser.add_argument('--input', default='_annotations.coco.json', help='Original COCO annotations')
+    parser.add_argument('--output', default='./_annotations.coco.rectified.json', help='Rectified output JSON')
+    parser.add_argument('--mode', choices=['map', 'analytic'], default='map',
+                        help='map: dense remap tables (as for videos); analytic: map-free cv2.undistortPoints')
+    args = parser.parse_args()
+
+    input_json = args.input
+    output_json = args.output
     print(f"Loading annotations from {input_json}...")
-    rectify_annotations(input_json, output_json)
+    rectify_annotations(input_json, output_json, mode=args.mode)
     print(f"Rectified annotations saved to {output_json}")
 
 
@@ -1,85 +1,276 @@
 import cv2
-import numpy as np
-import json
 import os
 import glob
 import re
+import time
+import queue
+import threading
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from camera_rig import CameraRig
+from instrumentation import span, traced
+from undistort_maps import get_undistort_maps, get_fixed_point_maps, valid_roi
+
+_STOP = object()  # end-of-stream marker passed through the pipeline queues
+
+# Rectification profiles (speed/quality tradeoff):
+#   fixed_point   -> CV_16SC2 maps from cv2.convertMaps instead of float32 maps
+#   interpolation -> cv2.remap interpolation
+#   crop          -> output only the valid-pixel ROI (no black borders); note that
+#                    pixel coordinates are shifted by the ROI origin
+RECTIFY_PROFILES = {
+    'exact':   {'fixed_point': False, 'interpolation': cv2.INTER_LINEAR,  'crop': False},
+    'fast':    {'fixed_point': True,  'interpolation': cv2.INTER_LINEAR,  'crop': False},
+    'preview': {'fixed_point': True,  'interpolation': cv2.INTER_NEAREST, 'crop': False},
+    'crop':    {'fixed_point': True,  'interpolation': cv2.INTER_LINEAR,  'crop': True},
+}
+
+
+class StageStats:
+    """Busy time and item count of one pipeline stage (thread-safe)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, frames=1):
+        with self._lock:
+            self.busy += seconds
+            self.frames += frames
+
+    def fps(self):
+        return self.frames / self.busy if self.busy > 0 else 0.0
+
+
+def _run_stage(target, errors, *args):
+    # Record the first exception of a worker thread so the caller can re-raise it
+    try:
+        target(*args)
+    except BaseException as e:
+        errors.append(e)
+
+
+def _put(q, item, stop_event):
+    # Bounded put that gives up when another stage has failed
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop_event):
+    # Blocking get that returns _STOP when another stage has failed
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _STOP
+
+
+def load_profile_maps(rig, cam_id, size, profile='exact'):
+    """
+    Return (map1, map2, interpolation, roi) for a rectification profile.
+    roi is (x, y, w, h) of the output frame; the maps are already cropped to it.
+    """
+    if profile not in RECTIFY_PROFILES:
+        raise ValueError(f"Unknown rectification profile: {profile}")
+    opts = RECTIFY_PROFILES[profile]
+    nearest = opts['interpolation'] == cv2.INTER_NEAREST
+    if opts['fixed_point']:
+        map1, map2 = get_fixed_point_maps(rig, cam_id, size, kind='points', nearest=nearest)
+    else:
+        map1, map2 = get_undistort_maps(rig, cam_id, size, kind='points')
+
+    roi = (0, 0, size[0], size[1])
+    if opts['crop']:
+        roi = valid_roi(*get_undistort_maps(rig, cam_id, size, kind='points'))
+        x, y, w, h = roi
+        # Remapping with cropped maps produces the cropped frame directly
+        map1 = np.ascontiguousarray(map1[y:y + h, x:x + w])
+        map2 = None if map2 is None else np.ascontiguousarray(map2[y:y + h, x:x + w])
+    return map1, map2, opts['interpolation'], roi
 
-def load_calibration(calib_path):
-    # Load the camera calibration parameters from a JSON file.
-    with open(calib_path, 'r') as f:
-        calib = json.load(f)
-    mtx = np.array(calib["mtx"], dtype=np.float32)
-    dist = np.array(calib["dist"], dtype=np.float32)
-    return mtx, dist
 
-def process_video(video_path, calib_path, output_path):
-    mtx, dist = load_calibration(calib_path)
+def process_video(video_path, rig, cam_id, output_path, workers=4, queue_size=16, profile='exact'):
+    """
+    Rectify one video with a bounded-queue pipeline:
+    reader thread -> `workers` remap threads -> in-order writer thread.
+    `profile` selects map format, interpolation and cropping (see RECTIFY_PROFILES).
+    Returns a dict with frames/sec per stage, or None if the video can't be opened.
+    """
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
         print("Error opening video file:", video_path)
-        return
+        return None
 
     fps = cap.get(cv2.CAP_PROP_FPS)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    
+
+    # Undistortion maps of the pixel grid, cached on disk once per camera
+    with span('video.load_maps'):
+        map1, map2, interpolation, roi = load_profile_maps(rig, cam_id, (width, height), profile)
 
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-    
-
-    grid_x, grid_y = np.meshgrid(np.arange(width), np.arange(height))
-    pts = np.stack([grid_x, grid_y], axis=-1).astype(np.float32)
-    pts = pts.reshape(-1, 1, 2)
-    
-
-    undistorted_pts = cv2.undistortPoints(pts, mtx, dist, P=mtx)
-    undistorted_map = undistorted_pts.reshape(height, width, 2)
-    map_x = undistorted_map[:, :, 0]
-    map_y = undistorted_map[:, :, 1]
-    
-    frame_count = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        # Apply the undistortion map to the frame
-        rectified_frame = cv2.remap(frame, map_x, map_y, interpolation=cv2.INTER_LINEAR)
-        out.write(rectified_frame)
-        frame_count += 1
-        if frame_count % 50 == 0:
-            print(f"Processed {frame_count} frames for {video_path}")
-    
+    out = cv2.VideoWriter(output_path, fourcc, fps, (roi[2], roi[3]))
+
+    workers = max(1, int(workers))
+    in_q = queue.Queue(maxsize=queue_size)
+    out_q = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+    stats = {name: StageStats(name) for name in ('decode', 'remap', 'encode')}
+
+    def reader():
+        idx = 0
+        try:
+            while not stop_event.is_set():
+                t0 = time.perf_counter()
+                with span('video.decode') as decode_span:
+                    ret, frame = cap.read()
+                    decode_span.add(frames=int(ret))
+                if not ret:
+                    break
+                stats['decode'].add(time.perf_counter() - t0)
+                if not _put(in_q, (idx, frame), stop_event):
+                    break
+                idx += 1
+        finally:
+            for _ in range(workers):
+                _put(in_q, _STOP, stop_event)
+
+    def remapper():
+        try:
+            while True:
+                item = _get(in_q, stop_event)
+                if item is _STOP:
+                    break
+                idx, frame = item
+                t0 = time.perf_counter()
+                # Apply the undistortion map to the frame
+                with span('video.remap', frames=1):
+                    rectified_frame = cv2.remap(frame, map1, map2, interpolation=interpolation)
+                stats['remap'].add(time.perf_counter() - t0)
+                if not _put(out_q, (idx, rectified_frame), stop_event):
+                    break
+        finally:
+            _put(out_q, _STOP, stop_event)
+
+    def writer():
+        # Frames arrive out of order from the remap workers: buffer until the next index is ready
+        pending = {}
+        next_idx = 0
+        done_workers = 0
+        while done_workers < workers:
+            item = _get(out_q, stop_event)
+            if item is _STOP:
+                if stop_event.is_set():
+                    break
+                done_workers += 1
+                continue
+            idx, frame = item
+            pending[idx] = frame
+            while next_idx in pending:
+                t0 = time.perf_counter()
+                with span('video.encode', frames=1):
+                    out.write(pending.pop(next_idx))
+                stats['encode'].add(time.perf_counter() - t0)
+                next_idx += 1
+                if next_idx % 50 == 0:
+                    print(f"Processed {next_idx} frames for {video_path}")
+
+    t_start = time.perf_counter()
+    with span('video.rectify') as video_span:
+        threads = [threading.Thread(target=_run_stage, args=(reader, errors))]
+        threads += [threading.Thread(target=_run_stage, args=(remapper, errors)) for _ in range(workers)]
+        threads += [threading.Thread(target=_run_stage, args=(writer, errors))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            # Stop the other stages as soon as one of them fails
+            while t.is_alive():
+                t.join(timeout=0.1)
+                if errors:
+                    stop_event.set()
+        video_span.add(frames=stats['encode'].frames)
+    wall = time.perf_counter() - t_start
+
     cap.release()
     out.release()
-    print(f"Finished processing video: {video_path}")
+    if errors:
+        raise errors[0]
+
+    report = {name: {'frames': s.frames, 'busy_s': s.busy, 'fps': s.fps()} for name, s in stats.items()}
+    # remap runs on several threads: per-thread fps times the number of workers
+    report['remap']['fps'] *= workers
+    report['total'] = {'frames': stats['encode'].frames, 'wall_s': wall,
+                       'fps': stats['encode'].frames / wall if wall > 0 else 0.0}
+    print(f"Finished processing video: {video_path} "
+          + ", ".join(f"{name} {r['fps']:.1f} fps" for name, r in report.items()))
+    return report
+
 
+def _process_camera(video_path, rig, cam_index, output_path, workers, queue_size, profile):
+    print(f"Processing {video_path} using calibration of cam_{cam_index} ({profile})...")
+    return process_video(video_path, rig, cam_index, output_path, workers, queue_size, profile)
+
+
+@traced('rectified_videos')
 def main():
-    video_files = glob.glob("mocap_7_videos/out*.mp4") # path to the video files
-    output_dir = "rectified_videos" # folder path where to save the rectified videos
+    parser = argparse.ArgumentParser(description='Rectify the mocap videos')
+    parser.add_argument('--videos', default="mocap_7_videos/out*.mp4", help='Glob of the input videos')
+    parser.add_argument('--output_dir', default="rectified_videos", help='Folder for the rectified videos')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Cameras processed in parallel (default: one process per video)')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='Remap threads per video')
+    parser.add_argument('--queue_size', type=int, default=16, help='Frames buffered between stages')
+    parser.add_argument('--profile', choices=sorted(RECTIFY_PROFILES), default='exact',
+                        help='Rectification profile (map format / interpolation / ROI crop)')
+    args = parser.parse_args()
+
+    video_files = glob.glob(args.videos) # path to the video files
+    rig = CameraRig.load()
+    output_dir = args.output_dir # folder path where to save the rectified videos
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    
+
+    jobs = []
     for video_path in video_files:
-        
+
         basename = os.path.basename(video_path)
         match = re.search(r'out(\d+)\.mp4', basename)
         if match:
-            cam_index = match.group(1)
-            
-            calib_path = os.path.join("camera_data", f"cam_{cam_index}", "calib", "camera_calib.json")
+            cam_index = int(match.group(1))
         else:
             print("Could not extract camera index from filename:", video_path)
             continue
-        
-        ## Create one folder for each sample e.g. tracking_01, mocap_1, hpe_1
-        output_path = os.path.join(output_dir, '', basename)
-        if not os.path.exists(os.path.join(output_dir, '')):
-            os.makedirs(os.path.join(output_dir, ''))
-            
-        print(f"Processing {video_path} using calibration file {calib_path}...")
-        process_video(video_path, calib_path, output_path)
+
+        if cam_index not in rig:
+            print("No calibration for camera", cam_index)
+            continue
+        output_path = os.path.join(output_dir, basename)
+        jobs.append((video_path, rig, cam_index, output_path, args.workers, args.queue_size, args.profile))
+
+    if not jobs:
+        return
+    n_procs = args.jobs or len(jobs)
+    if n_procs <= 1:
+        for job in jobs:
+            _process_camera(*job)
+        return
+    with ProcessPoolExecutor(max_workers=min(n_procs, len(jobs))) as pool:
+        futures = {pool.submit(_process_camera, *job): job[0] for job in jobs}
+        for fut in as_completed(futures):
+            fut.result()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,207 @@
+"""
+MOTORE DI RIPROIEZIONE 3D -> 2D CON METRICHE IN STREAMING
+
+Proietta lo scheletro 3D in tutte le camere con una sola chiamata a
+cv2.projectPoints per camera (a blocchi di frame) e, nello stesso
+passaggio, produce i keypoints riproiettati in ordine di immagine COCO e
+accumula MSE/MPJPE per giunto, per camera e per frame rispetto alle
+annotazioni 2D.
+
+Le metriche sono somme correnti (conteggio, somma, somma dei quadrati),
+quindi la memoria non cresce con il numero di errori. I giunti NaN
+(triangolazione fallita) e i keypoints GT con v=0 vengono esclusi.
+"""
+
+import numpy as np
+import cv2
+
+from instrumentation import span
+
+# frame proiettati per chiamata a cv2.projectPoints
+CHUNK_FRAMES = 1024
+
+
+def project_points(points, rig, cam_id):
+    """
+    Proietta points (..., 3) nella camera cam_id con la distorsione.
+    Ritorna (..., 2), NaN dove il punto 3D non è finito.
+    """
+    pts = np.asarray(points, dtype=np.float64)
+    flat = pts.reshape(-1, 3)
+    ok = np.isfinite(flat).all(axis=1)
+    out = np.full((len(flat), 2), np.nan)
+    if ok.any():
+        K, dist, rvec, tvec = rig.camera(cam_id)
+        imgpts, _ = cv2.projectPoints(np.ascontiguousarray(flat[ok]), rvec, tvec, K, dist)
+        out[ok] = imgpts.reshape(-1, 2)
+    return out.reshape(pts.shape[:-1] + (2,))
+
+
+class RunningErrorStats:
+    """
+    Accumulatori di MSE e MPJPE per gruppo (giunto, camera, frame) a
+    memoria costante: per ogni gruppo solo conteggio, somma e somma dei
+    quadrati degli errori euclidei in pixel.
+    """
+
+    def __init__(self, num_joints, cam_ids, frames):
+        self.cam_ids = list(cam_ids)
+        self.frames  = np.asarray(frames, dtype=np.int64)
+        self.total   = np.zeros(3)
+        self.joint   = np.zeros((num_joints, 3))
+        self.camera  = np.zeros((len(self.cam_ids), 3))
+        self.frame   = np.zeros((len(self.frames), 3))
+
+    @staticmethod
+    def _acc(table, groups, errs):
+        n = len(table)
+        table[:, 0] += np.bincount(groups, minlength=n)
+        table[:, 1] += np.bincount(groups, weights=errs, minlength=n)
+        table[:, 2] += np.bincount(groups, weights=errs ** 2, minlength=n)
+
+    def update(self, cam_pos, frame_pos, errors):
+        """
+        Aggiunge gli errori (N, J) della camera in posizione cam_pos per i
+        frame in posizione frame_pos (N,). Gli errori NaN vengono ignorati.
+        """
+        valid = np.isfinite(errors)
+        errs  = errors[valid]
+        if not errs.size:
+            return
+        rows, joints = np.nonzero(valid)
+        self.total += (errs.size, errs.sum(), (errs ** 2).sum())
+        self._acc(self.joint, joints, errs)
+        self._acc(self.frame, np.asarray(frame_pos)[rows], errs)
+        self.camera[cam_pos] += (errs.size, errs.sum(), (errs ** 2).sum())
+
+    def merge(self, other):
+        """Somma gli accumulatori globali, per giunto e per camera di other (stesse camere)."""
+        self.total  += other.total
+        self.joint  += other.joint
+        self.camera += other.camera
+
+    @staticmethod
+    def _summary(table):
+        table = np.atleast_2d(table)
+        count = table[:, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mpjpe = np.where(count > 0, table[:, 1] / count, np.nan)
+            mse   = np.where(count > 0, table[:, 2] / count, np.nan)
+        return count.astype(np.int64), mse, mpjpe
+
+    @property
+    def count(self):
+        return int(self.total[0])
+
+    def overall(self):
+        """(mse, mpjpe) su tutti gli errori."""
+        _, mse, mpjpe = self._summary(self.total)
+        return float(mse[0]), float(mpjpe[0])
+
+    def per_joint(self):
+        return self._summary(self.joint)
+
+    def per_camera(self):
+        return self._summary(self.camera)
+
+    def per_frame(self):
+        return self._summary(self.frame)
+
+    def to_dict(self):
+        """Metriche in forma serializzabile JSON (NaN -> None)."""
+        def rows(labels, table):
+            count, mse, mpjpe = self._summary(table)
+            return {str(l): {'count': int(n), 'mse': None if np.isnan(a) else float(a),
+                             'mpjpe': None if np.isnan(b) else float(b)}
+                    for l, n, a, b in zip(labels, count, mse, mpjpe)}
+        mse, mpjpe = self.overall()
+        return {
+            'count':      self.count,
+            'mse':        None if np.isnan(mse) else mse,
+            'mpjpe':      None if np.isnan(mpjpe) else mpjpe,
+            'per_joint':  rows(range(len(self.joint)), self.joint),
+            'per_camera': rows(self.cam_ids, self.camera),
+            'per_frame':  rows(self.frames.tolist(), self.frame),
+        }
+
+
+def reproject(coco, sk3d, rig, image_ids=None, compute_errors=True, chunk_frames=CHUNK_FRAMES):
+    """
+    Riproietta lo scheletro sk3d in ogni immagine COCO (o solo in image_ids)
+    di una camera calibrata il cui frame è presente nello scheletro.
+
+    Ritorna (image_ids, keypoints (N, J, 3) con v=2, stats) con le immagini
+    in ordine COCO; stats è un RunningErrorStats rispetto alle annotazioni
+    di coco (None se compute_errors=False).
+    """
+    sk_rows = sk3d.frame_index()
+    wanted  = None if image_ids is None else set(image_ids)
+
+    # immagini da riproiettare, in ordine COCO
+    order, cams, rows = [], [], []
+    for img in coco.data['images']:
+        img_id = img['id']
+        if wanted is not None and img_id not in wanted:
+            continue
+        cam_id, frame = coco.cam_frame.get(img_id, (None, None))
+        if cam_id not in rig or frame not in sk_rows:
+            continue
+        order.append(img_id)
+        cams.append(cam_id)
+        rows.append(sk_rows[frame])
+    cams = np.array(cams, dtype=np.int64)
+    rows = np.array(rows, dtype=np.int64)
+
+    num_joints = sk3d.num_joints
+    keypoints = np.empty((len(order), num_joints, 3))
+    keypoints[:, :, 2] = 2
+    stats = RunningErrorStats(num_joints, coco.cam_ids, coco.frames) if compute_errors else None
+    gt_frame_pos = {int(f): i for i, f in enumerate(coco.frames)}
+    gt_cam_pos   = {c: i for i, c in enumerate(coco.cam_ids)}
+
+    for cam_id in np.unique(cams):
+        sel = np.flatnonzero(cams == cam_id)
+        for start in range(0, len(sel), chunk_frames):
+            idx = sel[start:start + chunk_frames]
+            with span('reproject.project', points=len(idx) * num_joints):
+                pts3d = np.asarray(sk3d.points[rows[idx]], dtype=np.float64)   # (n, J, 3)
+                proj = project_points(pts3d, rig, int(cam_id))                  # (n, J, 2)
+                keypoints[idx, :, :2] = proj
+
+            if stats is None or int(cam_id) not in gt_cam_pos:
+                continue
+            with span('reproject.errors', points=len(idx) * num_joints):
+                c = gt_cam_pos[int(cam_id)]
+                f_pos = np.array([gt_frame_pos[coco.cam_frame[order[i]][1]] for i in idx])
+                gt = coco.keypoints[f_pos, c]                                   # (n, J, 3)
+                errors = np.linalg.norm(proj - gt[..., :2], axis=-1)
+                errors[(gt[..., 2] <= 0) | ~coco.annotated[f_pos, c][:, None]] = np.nan
+                stats.update(c, f_pos, errors)
+
+    return order, keypoints, stats
+
+
+def print_report(stats, per_camera=True, per_frame=False, header=None):
+    """Stampa le metriche globali e per giunto/camera/frame."""
+    mse, mpjpe = stats.overall()
+    print("=== Risultati Riproiezione 3D→2D ===")
+    if header:
+        print(header)
+    print(f"#errori calcolati = {stats.count}")
+    print(f"MSE   (pixel²):       {mse:.3f}")
+    print(f"MPJPE (pixel):        {mpjpe:.3f}\n")
+
+    print("MPJPE per giunto:")
+    for j, (n, _, e) in enumerate(zip(*stats.per_joint())):
+        if n:
+            print(f"  giunto {j:02d}: {e:.2f} px")
+    if per_camera:
+        print("\nMSE / MPJPE per camera:")
+        for cam_id, n, m, e in zip(stats.cam_ids, *stats.per_camera()):
+            if n:
+                print(f"  cam_{cam_id}: {m:10.3f} px²  {e:7.2f} px  ({n} punti)")
+    if per_frame:
+        print("\nMSE / MPJPE per frame:")
+        for frame, n, m, e in zip(stats.frames, *stats.per_frame()):
+            if n:
+                print(f"  frame_{int(frame):04d}: {m:10.3f} px²  {e:7.2f} px")
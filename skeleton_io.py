@@ -0,0 +1,353 @@
+"""
+FORMATO BINARIO PER SCHELETRI 3D E SET DI KEYPOINTS 2D
+
+Scheletro 3D (.npz non compresso):
+  points (F, J, 3) float64, NaN per i giunti mancanti
+  valid  (F, J)    bool
+  frames (F,)      int64, numero di frame (frame_XXXX -> XXXX)
+  meta             JSON con nomi dei giunti, scheletro, provenienza, ...
+  più eventuali array aggiuntivi per frame (es. incertezza per giunto)
+
+Set di keypoints 2D (.npz non compresso):
+  keypoints (N, J, 3) float64 [x, y, v] per immagine
+  image_ids (N,)      int64, id delle immagini COCO
+  meta                JSON
+
+Gli array sono salvati senza compressione, quindi con mmap_mode='r' vengono
+mappati direttamente dal file senza copiarli in memoria. Il vecchio formato
+JSON ({'skeleton_3d': {'frame_XXXX': [[x,y,z], ...]}}) resta leggibile e
+si può esportare con export_skeleton_json / export_keypoints_coco.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+
+from instrumentation import span
+
+SKELETON_PATH  = 'triangulated_3d_skeleton.npz'
+KEYPOINTS_PATH = 'reprojected_keypoints.npz'
+
+# Topologia di default (coerente con le categorie COCO del progetto)
+KEYPOINTS = [
+    "Hips", "RHip", "RKnee", "RAnkle", "RFoot",
+    "LHip", "LKnee", "LAnkle", "LFoot",
+    "Spine", "Neck", "Head",
+    "RShoulder", "RElbow", "RHand",
+    "LShoulder", "LElbow", "LHand"
+]
+
+SKELETON = [
+    (1, 2), (2, 3), (3, 4), (4, 5),
+    (1, 6), (6, 7), (7, 8), (8, 9),
+    (1, 10), (10, 11), (11, 12),
+    (11, 13), (13, 14), (14, 15),
+    (11, 16), (16, 17), (17, 18)
+]
+
+
+def frame_key(frame):
+    """12 -> 'frame_0012'"""
+    return f"frame_{int(frame):04d}"
+
+
+def parse_frame_key(key):
+    """'frame_0012' -> 12"""
+    return int(str(key).split('_')[-1])
+
+
+class Skeleton:
+    """Sequenza di scheletri 3D: points (F,J,3), valid (F,J), frames (F,), meta, extras."""
+
+    def __init__(self, points, frames, valid=None, meta=None, **extras):
+        self.points = points
+        self.frames = np.asarray(frames, dtype=np.int64)
+        if valid is None:
+            valid = ~np.isnan(points).any(axis=-1)
+        self.valid  = valid
+        self.meta   = dict(meta or {})
+        self.extras = extras
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def num_joints(self):
+        return self.points.shape[1]
+
+    def frame_index(self):
+        """Dict numero di frame -> riga."""
+        return {int(f): i for i, f in enumerate(self.frames)}
+
+    def get(self, frame):
+        """Giunti (J,3) del frame (numero o 'frame_XXXX'), None se assente."""
+        if isinstance(frame, str):
+            frame = parse_frame_key(frame)
+        i = self.frame_index().get(int(frame))
+        return None if i is None else self.points[i]
+
+
+# --- lettura/scrittura .npz con memory mapping ---
+
+def _save_npz(path, arrays):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    with span('npz.save', bytes=sum(np.asarray(a).nbytes for a in arrays.values())):
+        np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _load_npz(path, mmap_mode=None):
+    """
+    Come np.load per .npz, ma con mmap_mode gli array (salvati senza
+    compressione) vengono mappati direttamente dal file zip.
+    """
+    if mmap_mode is None:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zf.open(info))
+                continue
+            # header locale zip: 30 byte + nome file + campo extra
+            f.seek(info.header_offset + 26)
+            n_name, n_extra = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(n_name) + int(n_extra))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or 0 in shape or not shape:
+                f.seek(info.header_offset + 30 + int(n_name) + int(n_extra))
+                arrays[name] = np.lib.format.read_array(f)
+                continue
+            arrays[name] = np.memmap(f, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+                                     shape=shape, order='F' if fortran else 'C')
+    return arrays
+
+
+class NpyAppender:
+    """
+    Scrive un .npy a blocchi lungo il primo asse senza conoscerne in anticipo
+    la lunghezza: l'header viene riscritto alla chiusura con la forma finale
+    (spazio riservato in apertura, così i dati non vanno spostati).
+    """
+
+    HEADER_SIZE = 256
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.path      = path
+        self.dtype     = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows      = 0
+        self._f        = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                  'shape': (self.rows,) + self.row_shape}
+        text = repr(header).encode('latin1')
+        # magic + versione (2 byte) + lunghezza dell'header (uint32 little endian)
+        pad = self.HEADER_SIZE - len(np.lib.format.MAGIC_PREFIX) - 2 - 4 - len(text) - 1
+        self._f.seek(0)
+        self._f.write(np.lib.format.MAGIC_PREFIX + bytes([2, 0]))
+        self._f.write(np.array(len(text) + pad + 1, dtype='<u4').tobytes())
+        self._f.write(text + b' ' * pad + b'\n')
+        assert self._f.tell() == self.HEADER_SIZE, "header .npy non allineato"
+
+    def append(self, arr):
+        arr = np.ascontiguousarray(arr, dtype=self.dtype).reshape((len(arr),) + self.row_shape)
+        self._f.seek(0, os.SEEK_END)
+        self._f.write(arr.tobytes())
+        self.rows += len(arr)
+
+    def close(self):
+        self._write_header()
+        self._f.close()
+
+
+class StreamingNpzWriter:
+    """
+    Scrive un .npz (non compresso, quindi memory-mappabile) accodando blocchi
+    di righe: ogni array cresce in un .npy temporaneo e alla chiusura i file
+    vengono copiati nello zip, senza mai tenere l'intero array in memoria.
+    """
+
+    def __init__(self, path):
+        self.path     = path
+        self._dir     = tempfile.mkdtemp(prefix='npz_', dir=os.path.dirname(os.path.abspath(path)))
+        self._arrays  = {}
+
+    def append(self, **arrays):
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            if name not in self._arrays:
+                self._arrays[name] = NpyAppender(os.path.join(self._dir, name + '.npy'),
+                                                 arr.dtype, arr.shape[1:])
+            self._arrays[name].append(arr)
+
+    def close(self, **scalars):
+        """Chiude gli array accodati e aggiunge gli array piccoli in scalars (es. meta)."""
+        try:
+            for name, arr in scalars.items():
+                np.save(os.path.join(self._dir, name + '.npy'), np.asarray(arr))
+            for appender in self._arrays.values():
+                appender.close()
+            tmp_path = self.path + '.tmp.npz'
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for name in list(self._arrays) + list(scalars):
+                    zf.write(os.path.join(self._dir, name + '.npy'), arcname=name + '.npy')
+            os.replace(tmp_path, self.path)
+        finally:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class SkeletonWriter(StreamingNpzWriter):
+    """Scheletro 3D scritto a blocchi di frame, stesso formato di save_skeleton."""
+
+    def write(self, points, frames, valid=None, **extras):
+        points = np.asarray(points, dtype=np.float64)
+        if valid is None:
+            valid = ~np.isnan(points).any(axis=-1)
+        self.append(points=points, valid=np.asarray(valid, dtype=bool),
+                    frames=np.asarray(frames, dtype=np.int64),
+                    **{'extra_' + name: arr for name, arr in extras.items()})
+
+    def close(self, meta=None):
+        if not self._arrays:
+            self.write(np.zeros((0, 0, 3)), [])
+        super().close(meta=np.array(json.dumps(meta or {})))
+
+
+class KeypointsWriter(StreamingNpzWriter):
+    """Set di keypoints 2D scritto a blocchi, stesso formato di save_keypoints."""
+
+    def write(self, image_ids, keypoints):
+        self.append(image_ids=np.asarray(image_ids, dtype=np.int64),
+                    keypoints=np.asarray(keypoints, dtype=np.float64))
+
+    def close(self, meta=None):
+        if not self._arrays:
+            self.write([], np.zeros((0, 0, 3)))
+        super().close(meta=np.array(json.dumps(meta or {})))
+
+
+def save_skeleton(path, skeleton):
+    arrays = {'points': np.asarray(skeleton.points, dtype=np.float64),
+              'valid':  np.asarray(skeleton.valid, dtype=bool),
+              'frames': np.asarray(skeleton.frames, dtype=np.int64),
+              'meta':   np.array(json.dumps(skeleton.meta))}
+    for name, arr in skeleton.extras.items():
+        arrays['extra_' + name] = np.asarray(arr)
+    _save_npz(path, arrays)
+
+
+def load_skeleton(path=SKELETON_PATH, mmap_mode=None):
+    """Carica uno scheletro da .npz (eventualmente memory-mapped) o dal JSON legacy."""
+    if path.endswith('.json'):
+        return skeleton_from_json(path)
+    arrays = _load_npz(path, mmap_mode)
+    extras = {name[len('extra_'):]: arr for name, arr in arrays.items() if name.startswith('extra_')}
+    return Skeleton(arrays['points'], arrays['frames'], arrays['valid'],
+                    json.loads(str(arrays['meta'])), **extras)
+
+
+def skeleton_from_json(path):
+    """Legge il formato {'skeleton_3d': {'frame_XXXX': [[x,y,z] | [None]*3, ...]}}."""
+    with open(path, 'r') as f:
+        sk3d = json.load(f)['skeleton_3d']
+    keys   = list(sk3d)
+    frames = np.array([parse_frame_key(k) for k in keys], dtype=np.int64)
+    points = np.array([[[np.nan if c is None else c for c in p] for p in sk3d[k]] for k in keys],
+                      dtype=np.float64).reshape(len(keys), -1, 3)
+    return Skeleton(points, frames, meta={'source': os.path.basename(path)})
+
+
+def export_skeleton_json(skeleton, path):
+    """Esporta nel formato JSON legacy (giunti mancanti come [None, None, None])."""
+    joints_3d = {}
+    for frame, pts, ok in zip(skeleton.frames, np.asarray(skeleton.points), np.asarray(skeleton.valid)):
+        joints_3d[frame_key(frame)] = [p.tolist() if v else [None, None, None] for p, v in zip(pts, ok)]
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'skeleton_3d': joints_3d}, f, indent=2)
+
+
+# --- set di keypoints 2D ---
+
+def save_keypoints(path, image_ids, keypoints, meta=None):
+    _save_npz(path, {'image_ids': np.asarray(image_ids, dtype=np.int64),
+                     'keypoints': np.asarray(keypoints, dtype=np.float64),
+                     'meta':      np.array(json.dumps(meta or {}))})
+
+
+def load_keypoints(path=KEYPOINTS_PATH, mmap_mode=None):
+    """
+    Ritorna (image_ids (N,), keypoints (N,J,3), meta).
+    Accetta anche un file COCO .json (prima annotazione per immagine).
+    """
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        first = {}
+        for ann in data['annotations']:
+            first.setdefault(ann['image_id'], ann['keypoints'])
+        ids = np.array(list(first), dtype=np.int64)
+        kps = np.array([first[i] for i in first], dtype=np.float64).reshape(len(ids), -1, 3)
+        return ids, kps, {'source': os.path.basename(path)}
+    arrays = _load_npz(path, mmap_mode)
+    return arrays['image_ids'], arrays['keypoints'], json.loads(str(arrays['meta']))
+
+
+def keypoints_annotation(ann_id, image_id, kp, category_id):
+    """Annotazione COCO per una riga di keypoints (J, 3) (v=0 dove il punto è NaN)."""
+    kp = np.asarray(kp)
+    ok = ~np.isnan(kp[:, :2]).any(axis=1)
+    flat_kp = []
+    for (x, y, v), good in zip(kp, ok):
+        flat_kp.extend([float(x), float(y), int(v)] if good else [0.0, 0.0, 0])
+    if ok.any():
+        xs, ys = kp[ok, 0], kp[ok, 1]
+        x_min, y_min = float(xs.min()), float(ys.min())
+        w, h = float(xs.max() - xs.min()), float(ys.max() - ys.min())
+    else:
+        x_min = y_min = w = h = 0.0
+    return {
+        "id":           ann_id,
+        "image_id":     int(image_id),
+        "category_id":  category_id,
+        "bbox":         [x_min, y_min, w, h],
+        "area":         w * h,
+        "segmentation": [],
+        "iscrowd":      0,
+        "keypoints":    flat_kp
+    }
+
+
+def export_keypoints_coco(path, coco_template, image_ids, keypoints):
+    """
+    Scrive un file COCO con info/licenses/categories/images presi da
+    coco_template e un'annotazione per ogni riga di keypoints (v=2 dove
+    il punto è valido, 0 dove è NaN).
+    """
+    cat_id = coco_template['categories'][0]['id']
+    annotations = [keypoints_annotation(ann_id, img_id, kp, cat_id)
+                   for ann_id, (img_id, kp) in enumerate(zip(image_ids, np.asarray(keypoints)))]
+    out = {
+        "info":        coco_template.get('info', {}),
+        "licenses":    coco_template.get('licenses', []),
+        "categories":  coco_template['categories'],
+        "images":      coco_template['images'],
+        "annotations": annotations
+    }
+    with open(path, "w") as f:
+        json.dump(out, f, indent=2)
+    return len(annotations)
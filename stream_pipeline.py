@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+TRIANGOLAZIONE E RIPROIEZIONE IN STREAMING A MEMORIA LIMITATA
+
+Per sessioni lunghe (molte ore, molte camere) il file COCO non sta in
+memoria. Questo script:
+  1) legge le annotazioni in streaming (coco_stream.iter_coco), le
+     rettifica a lotti se l'input è quello originale (--rectify) e le
+     smista in bucket su disco per blocchi di frame (frame // chunk_frames);
+  2) elabora un bucket alla volta: triangola i frame del blocco, riproietta
+     nelle immagini del blocco, aggiorna le metriche di errore e accoda i
+     risultati a triangulated_3d_skeleton.npz / reprojected_keypoints.npz
+     (scritti a blocchi, stesso formato di skeleton_io);
+  3) con --coco riscrive i keypoints riproiettati in COCO un'annotazione
+     alla volta.
+La memoria di picco dipende da chunk_frames e dal numero di camere, non
+dalla durata della sessione. Gli id e i nomi delle immagini sono l'unica
+cosa tenuta per tutta la sessione (pochi byte per immagine).
+
+Esempio: python stream_pipeline.py --annotations _annotations.coco.json --rectify map --chunk_frames 500
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from camera_rig import CameraRig, CACHE_DIR
+from coco_index import parse_image_name, image_name
+from coco_stream import iter_coco, read_header, CocoStreamWriter
+from instrumentation import span, traced
+from rectified_annotations import rectify_coco
+from reprojection import RunningErrorStats, project_points, print_report
+from skeleton_io import (SKELETON_PATH, KEYPOINTS_PATH, SkeletonWriter, KeypointsWriter,
+                         load_keypoints, keypoints_annotation)
+from triangulation import triangulate, coco_skeleton_meta, RANSAC_THRESHOLD
+
+RECT_ANN_PATH = '_annotations.coco.rectified.json'
+CHUNK_FRAMES  = 1000          # frame per bucket
+RECTIFY_BATCH = 5000          # annotazioni rettificate per chiamata
+FLUSH_ROWS    = 20000         # righe tenute in memoria prima di scrivere i bucket
+
+
+class FrameBuckets:
+    """
+    Bucket su disco di righe [image_id, cam_id, frame, keypoints (J*3)]
+    raggruppate per blocco di frame; le righe vengono accodate a file
+    binari e scritte a intervalli di FLUSH_ROWS.
+    """
+
+    def __init__(self, directory, chunk_frames=CHUNK_FRAMES, flush_rows=FLUSH_ROWS):
+        self.directory    = directory
+        self.chunk_frames = chunk_frames
+        self.flush_rows   = flush_rows
+        self.row_size     = None
+        self._pending     = {}
+        self._n_pending   = 0
+
+    def _path(self, chunk):
+        return os.path.join(self.directory, f"chunk_{chunk:08d}.bin")
+
+    def add(self, image_id, cam_id, frame, keypoints):
+        row = np.concatenate(([image_id, cam_id, frame], np.asarray(keypoints, dtype=np.float64).ravel()))
+        if self.row_size is None:
+            self.row_size = len(row)
+        elif len(row) != self.row_size:
+            row = np.resize(row, self.row_size)     # annotazioni con meno keypoints: completate
+            row[3 + len(keypoints):] = 0
+        self._pending.setdefault(int(frame) // self.chunk_frames, []).append(row)
+        self._n_pending += 1
+        if self._n_pending >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        for chunk, rows in self._pending.items():
+            with open(self._path(chunk), 'ab') as f:
+                f.write(np.asarray(rows, dtype=np.float64).tobytes())
+        self._pending.clear()
+        self._n_pending = 0
+
+    def chunks(self):
+        """Genera (chunk, righe (N, row_size)) in ordine di frame."""
+        self.flush()
+        names = sorted(n for n in os.listdir(self.directory) if n.startswith('chunk_'))
+        for name in names:
+            rows = np.fromfile(os.path.join(self.directory, name), dtype=np.float64)
+            yield int(name[6:14]), rows.reshape(-1, self.row_size)
+
+
+def bucket_annotations(path, buckets, rig, rectify=None, rectify_batch=RECTIFY_BATCH):
+    """
+    Legge il COCO in streaming e riempie i bucket con la prima annotazione
+    di ogni immagine. Ritorna (categorie, numero di annotazioni).
+    Le immagini devono precedere le annotazioni, come nei file esportati.
+    """
+    images = {}      # image_id -> (cam_id, frame, immagine ridotta per la rettifica)
+    categories, batch, seen, count = [], [], set(), 0
+
+    def flush_batch():
+        if rectify:
+            imgs = {ann['image_id']: images[ann['image_id']][2] for ann in batch}
+            rectify_coco({'images': list(imgs.values()), 'annotations': batch}, rig, rectify)
+        for ann in batch:
+            cam_id, frame, _ = images[ann['image_id']]
+            buckets.add(ann['image_id'], cam_id, frame, ann['keypoints'])
+        batch.clear()
+
+    for key, value in iter_coco(path):
+        if key == 'categories':
+            categories.append(value)
+        elif key == 'images':
+            cam_id, frame = parse_image_name(image_name(value))
+            if cam_id is not None:
+                small = {k: value[k] for k in ('id', 'file_name', 'width', 'height') if k in value}
+                images[value['id']] = (cam_id, frame, small if rectify else None)
+        elif key == 'annotations':
+            img_id = value['image_id']
+            if img_id not in images or img_id in seen or images[img_id][0] not in rig:
+                continue
+            seen.add(img_id)
+            count += 1
+            batch.append({k: value[k] for k in ('id', 'image_id', 'keypoints', 'bbox') if k in value})
+            if len(batch) >= rectify_batch:
+                flush_batch()
+    flush_batch()
+    return categories, count
+
+
+def process_chunk(rows, rig, method, threshold, min_cams=2):
+    """
+    Triangola e riproietta un blocco di righe dei bucket.
+    Ritorna (frames, points (f, J, 3), extras, image_ids, keypoints (n, J, 3),
+    errors (n, J), cam_pos (n,), frame_pos (n,)).
+    """
+    _, order = np.unique(rows[:, 0], return_index=True)       # prima annotazione per immagine
+    rows = rows[np.sort(order)]
+    image_ids = rows[:, 0].astype(np.int64)
+    cams      = rows[:, 1].astype(np.int64)
+    frames_r  = rows[:, 2].astype(np.int64)
+    kps       = rows[:, 3:].reshape(len(rows), -1, 3)
+    J = kps.shape[1]
+
+    frames, frame_pos = np.unique(frames_r, return_inverse=True)
+    cam_pos = np.array([rig.index(c) for c in cams], dtype=np.int64)
+    obs = np.zeros((len(frames), len(rig.cam_ids), J, 3))
+    annotated = np.zeros((len(frames), len(rig.cam_ids)), dtype=bool)
+    obs[frame_pos, cam_pos] = kps
+    annotated[frame_pos, cam_pos] = True
+
+    keep = annotated.sum(axis=1) >= min_cams
+    points = np.full((len(frames), J, 3), np.nan)
+    extras = {}
+    if keep.any():
+        points[keep], fresh = triangulate(obs[keep], rig.P, method, threshold)
+        for name, arr in fresh.items():
+            extras[name] = np.zeros((len(frames),) + arr.shape[1:], dtype=arr.dtype)
+            extras[name][keep] = arr
+
+    # riproiezione delle immagini dei frame triangolati, una chiamata per camera
+    sel = keep[frame_pos]
+    proj = np.full((len(rows), J, 2), np.nan)
+    for c in np.unique(cam_pos[sel]):
+        idx = np.flatnonzero(sel & (cam_pos == c))
+        proj[idx] = project_points(points[frame_pos[idx]], rig, rig.cam_ids[c])
+    keypoints = np.concatenate((proj, np.full((len(rows), J, 1), 2.0)), axis=-1)[sel]
+    errors = np.linalg.norm(proj - kps[..., :2], axis=-1)
+    errors[kps[..., 2] <= 0] = np.nan
+    return (frames[keep], points[keep], {k: v[keep] for k, v in extras.items()},
+            image_ids[sel], keypoints, errors[sel], cam_pos[sel], frame_pos[sel])
+
+
+def export_coco_stream(coco_path, source_path, keypoints_path):
+    """Scrive il COCO dei keypoints riproiettati senza caricare né il sorgente né i keypoints."""
+    header = read_header(source_path)
+    cat_id = header['categories'][0]['id']
+    image_ids, keypoints, _ = load_keypoints(keypoints_path, mmap_mode='r')
+    writer = CocoStreamWriter(coco_path, {k: header.get(k, d) for k, d in
+                                          (('info', {}), ('licenses', []), ('categories', []))})
+    writer.begin('images')
+    for key, img in iter_coco(source_path):
+        if key == 'images':
+            writer.write(img)
+    writer.begin('annotations')
+    for ann_id, (img_id, kp) in enumerate(zip(image_ids, keypoints)):
+        writer.write(keypoints_annotation(ann_id, img_id, kp, cat_id))
+    writer.close()
+    return len(image_ids)
+
+
+def run_stream(annotations, rig, skeleton_path=SKELETON_PATH, keypoints_path=KEYPOINTS_PATH,
+               chunk_frames=CHUNK_FRAMES, rectify=None, method='svd', threshold=RANSAC_THRESHOLD,
+               frame_metrics=None):
+    """Esegue la pipeline a blocchi; ritorna le metriche globali (RunningErrorStats)."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='stream_', dir=CACHE_DIR)
+    try:
+        buckets = FrameBuckets(work_dir, chunk_frames)
+        with span('stream.bucket') as s:
+            categories, n_ann = bucket_annotations(annotations, buckets, rig, rectify)
+            s.add(annotations=n_ann)
+        meta = dict(coco_skeleton_meta({'categories': categories}), source=annotations,
+                    cam_ids=rig.cam_ids, calib_hash=rig.calib_hash, method=method)
+        num_joints = len(meta.get('keypoints', [])) or None
+
+        skel_writer = SkeletonWriter(skeleton_path)
+        kp_writer   = KeypointsWriter(keypoints_path)
+        stats = None
+        frame_f = open(frame_metrics, 'w') if frame_metrics else None
+        n_frames = 0
+        for chunk, rows in buckets.chunks():
+            with span('stream.process_chunk', rows=len(rows)):
+                frames, points, extras, image_ids, keypoints, errors, cam_pos, frame_pos = \
+                    process_chunk(rows, rig, method, threshold)
+            with span('stream.write', frames=len(frames), images=len(image_ids)):
+                skel_writer.write(points, frames, **extras)
+                kp_writer.write(image_ids, keypoints)
+            n_frames += len(frames)
+
+            # metriche per giunto/camera cumulative, per frame solo del blocco
+            all_frames = np.unique(rows[:, 2].astype(np.int64))
+            chunk_stats = RunningErrorStats(num_joints or errors.shape[1], rig.cam_ids, all_frames)
+            for c in np.unique(cam_pos):
+                sel = cam_pos == c
+                chunk_stats.update(c, frame_pos[sel], errors[sel])
+            if stats is None:
+                stats = RunningErrorStats(chunk_stats.joint.shape[0], rig.cam_ids, [])
+            stats.merge(chunk_stats)
+            if frame_f is not None:
+                for frame, n, mse, mpjpe in zip(all_frames, *chunk_stats.per_frame()):
+                    if n:
+                        frame_f.write(json.dumps({'frame': int(frame), 'count': int(n),
+                                                  'mse': float(mse), 'mpjpe': float(mpjpe)}) + '\n')
+            print(f"blocco {chunk}: {len(frames)} frame triangolati, {len(image_ids)} immagini riproiettate")
+        if frame_f is not None:
+            frame_f.close()
+
+        skel_writer.close(meta)
+        kp_writer.close({'skeleton': os.path.basename(skeleton_path), 'calib_hash': rig.calib_hash})
+        print(f"{n_ann} annotazioni, {n_frames} frame triangolati")
+        return stats
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@traced('stream_pipeline')
+def main():
+    parser = argparse.ArgumentParser(description='Triangolazione e riproiezione in streaming a blocchi di frame')
+    parser.add_argument('--annotations', default=RECT_ANN_PATH, help='File COCO (rettificato, o originale con --rectify)')
+    parser.add_argument('--rectify', choices=['map', 'analytic'], default=None,
+                        help="Rettifica le annotazioni durante la lettura (input originale)")
+    parser.add_argument('--skeleton', default=SKELETON_PATH, help='Scheletro 3D di output (.npz)')
+    parser.add_argument('--keypoints', default=KEYPOINTS_PATH, help='Keypoints riproiettati di output (.npz)')
+    parser.add_argument('--coco', nargs='?', const='reprojected_annotations.json', default=None,
+                        help='Esporta anche i keypoints riproiettati in COCO JSON')
+    parser.add_argument('--chunk_frames', type=int, default=CHUNK_FRAMES, help='Frame per blocco')
+    parser.add_argument('--method', choices=['svd', 'normal', 'robust'], default='svd', help='Solver DLT')
+    parser.add_argument('--threshold', type=float, default=RANSAC_THRESHOLD, help='Soglia inlier (solo robust)')
+    parser.add_argument('--frame_metrics', default=None, help='Metriche per frame in JSON lines')
+    args = parser.parse_args()
+
+    rig = CameraRig.load()
+    stats = run_stream(args.annotations, rig, args.skeleton, args.keypoints, args.chunk_frames,
+                       args.rectify, args.method, args.threshold, args.frame_metrics)
+    if stats is not None and stats.count:
+        print_report(stats)
+    if args.coco:
+        n = export_coco_stream(args.coco, args.annotations, args.keypoints)
+        print(f"scritte {n} annotazioni in {args.coco}")
+
+
+if __name__ == '__main__':
+    main()
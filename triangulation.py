@@ -1,72 +1,257 @@
-import json
-import os
-import cv2
+import argparse
+import itertools
 import numpy as np
 
+from camera_rig import CameraRig
+from coco_index import AnnotationIndex
+from instrumentation import span, traced
+from skeleton_io import Skeleton, save_skeleton, export_skeleton_json
+
 CALIB_DIR       = 'camera_data'
 RECT_ANN_PATH   = './_annotations.coco.rectified.json'
+OUTPUT_3D_PATH  = './triangulated_3d_skeleton.npz'
 OUTPUT_3D_JSON  = './triangulated_3d_skeleton.json'
 
-# 1) Carica annotazioni
-with open(RECT_ANN_PATH, 'r') as f:
-    data = json.load(f)
-
-# 2) Carica matrici di proiezione
-proj_matrices = {}
-for cam_folder in os.listdir(CALIB_DIR):
-    calib_file = os.path.join(CALIB_DIR, cam_folder, 'calib', 'camera_calib.json')
-    if not os.path.exists(calib_file): continue
-    calib = json.load(open(calib_file))
-    K      = np.array(calib['mtx'], dtype=np.float64)
-    rvec   = np.array(calib['rvecs'], dtype=np.float64).reshape(3,1)
-    R, _   = cv2.Rodrigues(rvec)
-    T      = np.array(calib['tvecs'], dtype=np.float64).reshape(3,1)
-    P      = K.dot(np.hstack((R, T)))
-    idx    = cam_folder.split('_')[-1]
-    proj_matrices[idx] = P
-
-# 3) Raggruppa per frame
-annotations_by_frame = {}
-for ann in data['annotations']:
-    img    = next(i for i in data['images'] if i['id'] == ann['image_id'])
-    parts  = img['file_name'].split('_')
-    cam    = parts[0].replace('out','')
-    frame  = parts[2]
-    key    = f"frame_{frame}"
-    annotations_by_frame.setdefault(key, {})[cam] = ann['keypoints']
-
-# 4) Triangola escludendo i punti occlusi (v<2)
-joints_3d = {}
-for frame_key, cams in annotations_by_frame.items():
-    if len(cams) < 2:
-        continue
-    kp_count = len(next(iter(cams.values()))) // 3
-    pts_3d   = []
-    for j in range(kp_count):
-        A = []
-        for cam_idx, kpts in cams.items():
-            x = kpts[3*j]
-            y = kpts[3*j+1]
-            v = kpts[3*j+2]
-            if v < 2:
-                continue
-            P = proj_matrices.get(cam_idx)
-            if P is None:
-                continue
-            A.append(x * P[2,:] - P[0,:])
-            A.append(y * P[2,:] - P[1,:])
-        A = np.array(A)
-        if A.shape[0] < 4:
-            pts_3d.append([None, None, None])
-        else:
-            _, _, VT = np.linalg.svd(A)
-            X        = VT[-1] / VT[-1,3]
-            pts_3d.append(X[:3].tolist())
-    joints_3d[frame_key] = pts_3d
-
-# 5) Salva il risultato
-os.makedirs(os.path.dirname(OUTPUT_3D_JSON), exist_ok=True)
-with open(OUTPUT_3D_JSON, 'w') as f:
-    json.dump({'skeleton_3d': joints_3d}, f, indent=2)
-
-print(f"Triangulated 3D skeleton saved to {OUTPUT_3D_JSON}")
+# soglia di riproiezione (pixel, immagini 4K rettificate) per gli inlier della modalità robusta
+RANSAC_THRESHOLD = 80.0
+# memoria di lavoro per blocco della modalità robusta; i temporanei (f, J, M, C)
+# occupano circa ROBUST_BYTES_PER_ITEM byte per elemento (err, proiezioni, maschere)
+ROBUST_CHUNK_BYTES    = 256 * 2**20
+ROBUST_BYTES_PER_ITEM = 128
+
+
+def build_observations(index, cam_ids):
+    """
+    Estrae dall'indice COCO le osservazioni di tutti i frame in un unico tensore.
+
+    Ritorna (frames, obs) con obs di forma (F, C, J, 3) = [x, y, v],
+    camere (int) nell'ordine di cam_ids. Le camere senza annotazione per un
+    frame hanno v=0; i frame visti da meno di 2 camere vengono scartati.
+    """
+    pos = [index.cam_ids.index(c) if c in index.cam_ids else -1 for c in cam_ids]
+    F, _, J, _ = index.keypoints.shape
+    obs = np.zeros((F, len(cam_ids), J, 3))
+    annotated = np.zeros((F, len(cam_ids)), dtype=bool)
+    for c, p in enumerate(pos):
+        if p >= 0:
+            obs[:, c] = index.keypoints[:, p]
+            annotated[:, c] = index.annotated[:, p]
+
+    keep = annotated.sum(axis=1) >= 2
+    return index.frames[keep], obs[keep]
+
+
+def triangulate_batch(obs, proj_matrices, min_visibility=2, method='svd', chunk_size=4096):
+    """
+    DLT vettorizzata su tutti i frame e giunti.
+
+    obs:           (F, C, J, 3) keypoints [x, y, v] per camera
+    proj_matrices: (C, 3, 4) matrici di proiezione, stesso ordine delle camere
+    Le osservazioni con v < min_visibility vengono mascherate azzerando le
+    righe corrispondenti di A, che non cambiano il suo spazio nullo.
+    method='svd' risolve con una SVD batched di A; method='normal' usa
+    l'autovettore minimo di A^T A (4x4), circa 2x più veloce.
+    Ritorna (F, J, 3); i giunti visti da meno di 2 camere sono NaN.
+    """
+    if method not in ('svd', 'normal'):
+        raise ValueError(f"Unknown triangulation method: {method}")
+    obs = np.asarray(obs, dtype=np.float64)
+    P   = np.asarray(proj_matrices, dtype=np.float64)
+    F, C, J, _ = obs.shape
+    out = np.full((F, J, 3), np.nan)
+
+    for s in range(0, F, chunk_size):
+        o     = obs[s:s+chunk_size].transpose(0, 2, 1, 3)      # (f, J, C, 3)
+        x     = o[..., 0, None]
+        y     = o[..., 1, None]
+        valid = o[..., 2] >= min_visibility                     # (f, J, C)
+
+        # righe x*P[2]-P[0] e y*P[2]-P[1] per ogni camera
+        A = np.stack((x * P[:, 2] - P[:, 0],
+                      y * P[:, 2] - P[:, 1]), axis=-2)          # (f, J, C, 2, 4)
+        A = A * valid[..., None, None]
+        A = A.reshape(A.shape[0], J, 2 * C, 4)
+
+        with span(f'triangulate.{method}_solve', points=A.shape[0] * J):
+            if method == 'svd':
+                _, _, VT = np.linalg.svd(A)
+                X = VT[..., -1, :]
+            else:
+                _, V = np.linalg.eigh(np.swapaxes(A, -1, -2) @ A)
+                X = V[..., :, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X3 = X[..., :3] / X[..., 3:]
+
+        solvable = valid.sum(axis=-1) >= 2
+        out[s:s+chunk_size][solvable] = X3[solvable]
+    return out
+
+
+def camera_subsets(num_cams, min_size=2):
+    """Maschere (M, C) di tutti i sottoinsiemi di almeno min_size camere (11 per 4 camere)."""
+    subsets = [c for k in range(min_size, num_cams + 1)
+               for c in itertools.combinations(range(num_cams), k)]
+    masks = np.zeros((len(subsets), num_cams), dtype=bool)
+    for m, cams in enumerate(subsets):
+        masks[m, list(cams)] = True
+    return masks
+
+
+def _dlt_normal(rows, weights):
+    """
+    Risolve la DLT pesata dalle righe per camera.
+    rows:    (..., C, 2, 4) righe x*P[2]-P[0], y*P[2]-P[1]
+    weights: (..., C) pesi (0 esclude la camera)
+    Ritorna i punti omogenei (..., 4), autovettore minimo di sum_c w_c A_c^T A_c.
+    """
+    N = np.einsum('...c,...cri,...crj->...ij', weights, rows, rows)
+    _, V = np.linalg.eigh(N)
+    return V[..., :, 0]
+
+
+def _reprojection_errors(X, P, xy):
+    """
+    Errore di riproiezione in pixel.
+    X: (..., 4) punti omogenei, P: (C, 3, 4), xy: (..., C, 2) osservazioni.
+    Ritorna (..., C).
+    """
+    p = np.einsum('cij,...j->...ci', P, X)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proj = p[..., :2] / p[..., 2:]
+    err = np.linalg.norm(proj - xy, axis=-1)
+    return np.where(np.isfinite(err), err, np.inf)
+
+
+def triangulate_robust(obs, proj_matrices, threshold=RANSAC_THRESHOLD, min_visibility=2,
+                       confidence=None, chunk_size=None):
+    """
+    Triangolazione robusta vettorizzata su tutti i frame e giunti.
+
+    Per ogni giunto risolve in blocco la DLT di tutti i sottoinsiemi di
+    almeno 2 camere visibili (camera_subsets), conta gli inlier con errore
+    di riproiezione < threshold e sceglie il sottoinsieme con più inlier
+    (a parità, errore troncato minore, come MSAC). Il punto viene poi
+    ricalcolato con una DLT pesata sugli inlier: peso = confidence *
+    1 / (1 + (err/threshold)^2).
+
+    obs:        (F, C, J, 3) keypoints [x, y, v] per camera
+    confidence: (F, C, J) confidenza delle osservazioni (default 1)
+    chunk_size: frame per blocco (default: da ROBUST_CHUNK_BYTES, il numero
+                di sottoinsiemi M cresce come 2^C)
+    Ritorna (points (F, J, 3), inliers (F, J, C) bool); i giunti con meno
+    di 2 inlier sono NaN.
+    """
+    obs = np.asarray(obs, dtype=np.float64)
+    P   = np.asarray(proj_matrices, dtype=np.float64)
+    F, C, J, _ = obs.shape
+    if confidence is None:
+        confidence = np.ones((F, C, J))
+    subsets = camera_subsets(C)                                  # (M, C)
+    if chunk_size is None:
+        per_frame = J * len(subsets) * C * ROBUST_BYTES_PER_ITEM
+        chunk_size = max(1, ROBUST_CHUNK_BYTES // max(per_frame, 1))
+    points  = np.full((F, J, 3), np.nan)
+    inliers = np.zeros((F, J, C), dtype=bool)
+
+    for s in range(0, F, chunk_size):
+        o     = obs[s:s+chunk_size].transpose(0, 2, 1, 3)        # (f, J, C, 3)
+        xy    = o[..., :2]
+        valid = o[..., 2] >= min_visibility                       # (f, J, C)
+        conf  = np.asarray(confidence[s:s+chunk_size], dtype=np.float64).transpose(0, 2, 1) * valid
+
+        rows = np.stack((o[..., 0, None] * P[:, 2] - P[:, 0],
+                         o[..., 1, None] * P[:, 2] - P[:, 1]), axis=-2)   # (f, J, C, 2, 4)
+
+        # 1) ipotesi: DLT di ogni sottoinsieme, tutte insieme (f, J, M, 4)
+        sub_w = valid[:, :, None, :] & subsets                   # (f, J, M, C)
+        usable = sub_w.sum(axis=-1) == subsets.sum(axis=-1)      # sottoinsiemi di sole camere visibili
+        X = _dlt_normal(rows[:, :, None], sub_w.astype(np.float64))
+
+        # 2) inlier di ogni ipotesi su tutte le camere visibili
+        err = _reprojection_errors(X, P, xy[:, :, None])         # (f, J, M, C)
+        inl = (err < threshold) & valid[:, :, None, :]
+        count = np.where(usable, inl.sum(axis=-1), -1)
+        cost  = np.where(valid[:, :, None, :], np.minimum(err, threshold), 0).sum(axis=-1)
+        # più inlier prima, poi costo troncato minore (cost <= C * threshold)
+        best = np.argmax(count - cost / (C * threshold + 1.0), axis=-1)     # (f, J)
+        best_inl = np.take_along_axis(inl, best[..., None, None], axis=2)[:, :, 0]     # (f, J, C)
+        best_err = np.take_along_axis(err, best[..., None, None], axis=2)[:, :, 0]
+        best_X   = np.take_along_axis(X, best[..., None, None], axis=2)[:, :, 0]         # (f, J, 4)
+
+        # 3) DLT pesata sugli inlier; dividendo per la profondità (P[2] X) dell'ipotesi
+        #    l'errore algebrico di ogni camera approssima quello in pixel
+        depth = np.abs(np.einsum('cj,...j->...c', P[:, 2], best_X))
+        w = conf * best_inl / (1.0 + (np.minimum(best_err, threshold) / threshold) ** 2)
+        w = w / np.maximum(depth, 1e-12) ** 2
+        Xw = _dlt_normal(rows, w)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X3 = Xw[..., :3] / Xw[..., 3:]
+
+        solvable = best_inl.sum(axis=-1) >= 2
+        points[s:s+chunk_size][solvable] = X3[solvable]
+        inliers[s:s+chunk_size] = best_inl & solvable[..., None]
+    return points, inliers
+
+
+def triangulate(obs, proj_matrices, method='svd', threshold=RANSAC_THRESHOLD):
+    """
+    Triangola con il metodo scelto ('svd', 'normal' o 'robust').
+    Ritorna (points (F, J, 3), extras) con extras da salvare nello scheletro
+    (per 'robust' la maschera degli inlier (F, J, C)).
+    """
+    with span(f'triangulate.{method}', frames=len(obs), points=len(obs) * np.shape(obs)[2]):
+        if method == 'robust':
+            points, inliers = triangulate_robust(obs, proj_matrices, threshold)
+            return points, {'inliers': inliers}
+        return triangulate_batch(obs, proj_matrices, method=method), {}
+
+
+def coco_skeleton_meta(data):
+    """Nomi dei giunti e collegamenti dalla categoria COCO con keypoints."""
+    for cat in data.get('categories', []):
+        if 'keypoints' in cat:
+            return {'keypoints': cat['keypoints'], 'skeleton': cat.get('skeleton', [])}
+    return {}
+
+
+@traced('triangulation')
+def main():
+    parser = argparse.ArgumentParser(description='Triangola lo scheletro 3D dalle annotazioni rettificate')
+    parser.add_argument('--annotations', default=RECT_ANN_PATH, help='File COCO rettificato')
+    parser.add_argument('--output', default=OUTPUT_3D_PATH, help='Scheletro 3D in formato .npz')
+    parser.add_argument('--json', nargs='?', const=OUTPUT_3D_JSON, default=None,
+                        help='Esporta anche nel formato JSON legacy (default: %(const)s)')
+    parser.add_argument('--method', choices=['svd', 'normal', 'robust'], default='svd',
+                        help="Solver DLT; 'robust' sceglie gli inlier tra i sottoinsiemi di camere")
+    parser.add_argument('--threshold', type=float, default=RANSAC_THRESHOLD,
+                        help='Soglia di riproiezione in pixel per gli inlier (solo --method robust)')
+    args = parser.parse_args()
+
+    # 1) Carica annotazioni
+    index = AnnotationIndex.load(args.annotations)
+
+    # 2) Carica matrici di proiezione
+    rig = CameraRig.load(CALIB_DIR)
+
+    # 3) Raggruppa per frame
+    frames, obs = build_observations(index, rig.cam_ids)
+
+    # 4) Triangola escludendo i punti occlusi (v<2)
+    pts_3d, extras = triangulate(obs, rig.P, args.method, args.threshold)
+    meta = dict(coco_skeleton_meta(index.data), source=args.annotations, cam_ids=rig.cam_ids,
+                calib_hash=rig.calib_hash, method=args.method)
+    if args.method == 'robust':
+        meta['threshold'] = args.threshold
+        print(f"Inlier: {extras['inliers'].sum()} / {int((obs[..., 2] >= 2).sum())} osservazioni")
+    skeleton = Skeleton(pts_3d, frames, meta=meta, **extras)
+
+    # 5) Salva il risultato
+    save_skeleton(args.output, skeleton)
+    print(f"Triangulated 3D skeleton saved to {args.output}")
+    if args.json:
+        export_skeleton_json(skeleton, args.json)
+        print(f"JSON export saved to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+CACHE DELLE MAPPE DI RETTIFICA
+
+Le mappe di undistortion (map_x, map_y) vengono calcolate una sola volta per
+(camera, risoluzione, hash della calibrazione), salvate in .npy e restituite
+come viste memory-mapped in sola lettura: ogni immagine/video della stessa
+camera condivide le stesse pagine, quindi la memoria resta costante.
+
+Tipi di mappa:
+  'rectify' -> cv2.initUndistortRectifyMap (usata da rectified_annotations.py)
+  'points'  -> cv2.undistortPoints sulla griglia dei pixel (usata da rectified_videos.py)
+"""
+
+import os
+import cv2
+import numpy as np
+
+from camera_rig import CACHE_DIR
+from instrumentation import span
+
+MAP_DIR   = os.path.join(CACHE_DIR, 'undistort_maps')
+MAP_KINDS = ('rectify', 'points')
+
+# mappe già aperte in questo processo: chiave -> (map_x, map_y)
+_open_maps = {}
+
+
+def map_path(rig, cam_id, size, kind='rectify', map_dir=MAP_DIR):
+    w, h = size
+    return os.path.join(map_dir, f"cam{cam_id}_{w}x{h}_{kind}_{rig.calib_hash[:16]}.npy")
+
+
+def _compute_maps(K, dist, size, kind, out, rows_per_chunk=256):
+    """Scrive le mappe (2, h, w) float32 in `out` (array o memmap)."""
+    w, h = size
+    if kind == 'rectify':
+        map_x, map_y = cv2.initUndistortRectifyMap(K, dist, None, K, (w, h), cv2.CV_32FC1)
+        out[0] = map_x
+        out[1] = map_y
+        return
+    # 'points': a blocchi di righe per non allocare 8M punti in una volta
+    xs = np.arange(w, dtype=np.float32)
+    for y0 in range(0, h, rows_per_chunk):
+        ys = np.arange(y0, min(y0 + rows_per_chunk, h), dtype=np.float32)
+        grid_x, grid_y = np.meshgrid(xs, ys)
+        pts = np.stack([grid_x, grid_y], axis=-1).reshape(-1, 1, 2)
+        und = cv2.undistortPoints(pts, K, dist, P=K).reshape(len(ys), w, 2)
+        out[0, y0:y0 + len(ys)] = und[..., 0]
+        out[1, y0:y0 + len(ys)] = und[..., 1]
+
+
+def get_undistort_maps(rig, cam_id, size=None, kind='rectify', map_dir=MAP_DIR):
+    """
+    Ritorna (map_x, map_y) float32 (h, w) memory-mapped per la camera.
+
+    size: (w, h); di default la risoluzione da metadata.json.
+    Le mappe vengono calcolate solo se non esiste già il file in cache.
+    """
+    if kind not in MAP_KINDS:
+        raise ValueError(f"Unknown map kind: {kind}")
+    if size is None:
+        size = rig.image_size(cam_id)
+    size = (int(size[0]), int(size[1]))
+    path = map_path(rig, cam_id, size, kind, map_dir)
+    if path in _open_maps:
+        return _open_maps[path]
+
+    if not os.path.isfile(path):
+        os.makedirs(map_dir, exist_ok=True)
+        K, dist, _, _ = rig.camera(cam_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                        shape=(2, size[1], size[0]))
+        with span('undistort_maps.compute', pixels=size[0] * size[1]):
+            _compute_maps(K, dist, size, kind, out)
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+
+    maps = np.load(path, mmap_mode='r')
+    _open_maps[path] = (maps[0], maps[1])
+    return _open_maps[path]
+
+
+def get_fixed_point_maps(rig, cam_id, size=None, kind='rectify', nearest=False, map_dir=MAP_DIR):
+    """
+    Ritorna (map1, map2) in formato fixed-point CV_16SC2 (cv2.convertMaps),
+    più compatto e più veloce in cv2.remap delle mappe float32. Con
+    nearest=True map2 è None (solo interpolazione INTER_NEAREST).
+    Anche queste mappe sono salvate in cache e memory-mapped.
+    """
+    if size is None:
+        size = rig.image_size(cam_id)
+    size = (int(size[0]), int(size[1]))
+    suffix = 'nn' if nearest else 'fx'
+    base = map_path(rig, cam_id, size, kind, map_dir)[:-len('.npy')]
+    paths = (f"{base}_{suffix}1.npy", f"{base}_{suffix}2.npy")
+    if paths[0] in _open_maps:
+        return _open_maps[paths[0]]
+
+    if not all(os.path.isfile(p) for p in paths[:1 if nearest else 2]):
+        map_x, map_y = get_undistort_maps(rig, cam_id, size, kind, map_dir)
+        map1, map2 = cv2.convertMaps(np.ascontiguousarray(map_x), np.ascontiguousarray(map_y),
+                                     cv2.CV_16SC2, nninterpolation=nearest)
+        for path, arr in zip(paths, (map1, map2)):
+            if nearest and arr is map2:
+                continue
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, arr)
+            os.replace(tmp_path, path)
+
+    map1 = np.load(paths[0], mmap_mode='r')
+    map2 = None if nearest else np.load(paths[1], mmap_mode='r')
+    _open_maps[paths[0]] = (map1, map2)
+    return _open_maps[paths[0]]
+
+
+def valid_roi(map_x, map_y):
+    """
+    Rettangolo (x, y, w, h) più grande, centrato sull'immagine, i cui pixel
+    campionano tutti all'interno del frame sorgente: ritagliando lì si
+    eliminano i bordi neri introdotti dalla rettifica.
+    """
+    h, w = map_x.shape
+    valid = (map_x >= 0) & (map_x <= w - 1) & (map_y >= 0) & (map_y <= h - 1)
+    cy, cx = h // 2, w // 2
+    row, col = np.flatnonzero(valid[cy]), np.flatnonzero(valid[:, cx])
+    if row.size == 0 or col.size == 0:
+        return 0, 0, 0, 0
+    x0, x1, y0, y1 = row[0], row[-1] + 1, col[0], col[-1] + 1
+    # restringe i lati che contengono ancora pixel non validi
+    while x0 < x1 and y0 < y1:
+        box = valid[y0:y1, x0:x1]
+        bad = [not box[0].all(), not box[-1].all(), not box[:, 0].all(), not box[:, -1].all()]
+        if not any(bad):
+            break
+        y0 += bad[0]; y1 -= bad[1]; x0 += bad[2]; x1 -= bad[3]
+    return int(x0), int(y0), int(max(x1 - x0, 0)), int(max(y1 - y0, 0))